@@ -1,32 +1,316 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, make_response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context, g, has_request_context, send_file
+from flask import make_response, session, get_flashed_messages
+from flask import before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 from dotenv import load_dotenv
-import requests
 import io
 import csv
+import zlib
 import secrets
+import shutil
+import socket
+import click
+import threading
+from collections import OrderedDict, deque
+from functools import wraps
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import math
+import json
+import base64
+import bisect
+import hashlib
+import re
+import unicodedata
 import logging
+import time
+from markupsafe import Markup
+import sqlite3
+from blinker import Namespace
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import object_session
+from sqlalchemy.schema import CreateColumn
 from werkzeug.security import generate_password_hash, check_password_hash
 
-# Configure logging
-logging.getLogger('werkzeug').setLevel(logging.ERROR)
-logging.getLogger('sqlalchemy.engine').setLevel(logging.ERROR)
-
 # Load environment variables
 load_dotenv()
 
+# Configure logging. Request and SQL timings are exported on /metrics and
+# slow statements go to the slow query log, so werkzeug's access log and
+# SQLAlchemy's per-statement log stay off.
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+logging.getLogger('sqlalchemy.engine').setLevel(logging.ERROR)
+
 def generate_secret_key():
     return secrets.token_hex(32)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', generate_secret_key())
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///pharmacy.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///pharmacy.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# SQLite connection tuning, applied to every new connection
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', -64 * 1024)),  # negative = KiB
+}
+if ':memory:' not in app.config['SQLALCHEMY_DATABASE_URI'] and app.config['SQLALCHEMY_DATABASE_URI'] != 'sqlite://':
+    # Connection pool sizing (in-memory SQLite keeps its single shared connection)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'),
+    }
+app.config['PRODUCTS_PER_PAGE'] = int(os.getenv('PRODUCTS_PER_PAGE', 50))
+app.config['MAX_PRODUCTS_PER_PAGE'] = 200
+app.config['STOCK_UPDATE_RETRIES'] = 5
+app.config['MAX_STOCK_BATCH_LINES'] = 20000
+app.config['LOT_FETCH_SIZE'] = 16
+app.config['EXPORT_CHUNK_SIZE'] = 2000
+app.config['TRANSACTIONS_PER_PAGE'] = 50
+app.config['TRANSACTION_ARCHIVE_DAYS'] = int(os.getenv('TRANSACTION_ARCHIVE_DAYS', 365))
+app.config['PRODUCT_CHOICES_TTL'] = 60
+app.config['LOCATION_CACHE_TTL'] = 300
+app.config['RESTOCK_WINDOW_DAYS'] = 60
+app.config['RESTOCK_SMOOTHING'] = 0.3
+app.config['RESTOCK_COVER_DAYS'] = 30
+app.config['RESTOCK_REPORT_TTL'] = 300
+app.config['BARCODE_INFO_URL'] = os.getenv('BARCODE_INFO_URL', 'https://world.openfoodfacts.org/api/v0/product/{barcode}.json')
+app.config['BARCODE_INFO_TIMEOUT'] = (3.05, 5)  # connect, read seconds
+app.config['BARCODE_INFO_HIT_TTL'] = timedelta(days=30)
+app.config['BARCODE_INFO_MISS_TTL'] = timedelta(days=1)
+app.config['BARCODE_INFO_CACHE_SIZE'] = 50000
+app.config['BARCODE_INFO_WORKERS'] = 8
+app.config['IMPORT_BATCH_SIZE'] = 1000
+app.config['IMPORT_MAX_REPORTED_ERRORS'] = 1000
+app.config['METRICS_CACHE_TTL'] = int(os.getenv('METRICS_CACHE_TTL', 30))
+app.config['ANALYTICS_CACHE_TTL'] = int(os.getenv('ANALYTICS_CACHE_TTL', 300))
+app.config['ANALYTICS_TURNOVER_DAYS'] = 90
+app.config['ALERT_HISTORY_SIZE'] = 1000
+app.config['ALERT_KEEPALIVE'] = 15
+app.config['ALERT_SWEEP_INTERVAL'] = 3600
+app.config['EXPIRY_WARNING_DAYS'] = 30
+app.config['SCANNER_CACHE_TTL'] = int(os.getenv('SCANNER_CACHE_TTL', 300))
+app.config['SCANNER_MAX_BATCH'] = 500
+app.config['SEARCH_VOCAB_TTL'] = 300
+app.config['SEARCH_TYPEAHEAD_LIMIT'] = 10
+app.config['SEARCH_MAX_RESULTS'] = 50
+app.config['SEARCH_RANK_WINDOW'] = 500
+app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 2))
+app.config['JOB_RESULTS_DIR'] = os.getenv('JOB_RESULTS_DIR') or os.path.join(app.instance_path, 'jobs')
+app.config['JOB_RESULT_TTL'] = timedelta(days=int(os.getenv('JOB_RESULT_TTL_DAYS', 7)))
+app.config['JOB_POLL_INTERVAL'] = 5  # seconds an idle worker waits before looking for jobs from other processes
+app.config['JOB_PROGRESS_INTERVAL'] = 1.0  # seconds between progress writes
+app.config['JOB_HEARTBEAT_INTERVAL'] = 30
+app.config['HTTP_CACHE_TTL'] = int(os.getenv('HTTP_CACHE_TTL', 30))
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.getenv('FRAGMENT_CACHE_SIZE', 256))
+app.config['USER_CACHE_SIZE'] = 1024
+app.config['USER_CACHE_TTL'] = 300
+app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', '1') not in ('0', 'false')
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+app.config['SLOW_QUERY_MS'] = float(os.getenv('SLOW_QUERY_MS', 100))
+app.config['LATENCY_BUCKETS'] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 db = SQLAlchemy(app)
+
+# In-process write notifications, sent after commit. Caches subscribe to these
+# instead of every write path having to know about every cache.
+#   products_changed(product_ids=[...] or None when unknown or many)
+#   stock_changed(movements=[(product_id, quantity, type, date)] or None,
+#                 changes=[{product_id, old_quantity, new_quantity, reorder_level}])
+inventory_signals = Namespace()
+products_changed = inventory_signals.signal('products-changed')
+stock_changed = inventory_signals.signal('stock-changed')
+
+def send_committed(signal, **kwargs):
+    # The write is already committed: a failing subscriber is logged, and the
+    # others still run, rather than turning it into an error for the caller
+    for receiver in signal.receivers_for(app):
+        try:
+            receiver(app, **kwargs)
+        except Exception:
+            app.logger.exception('%s subscriber %s failed', signal.name, getattr(receiver, '__name__', receiver))
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma, value in app.config['SQLITE_PRAGMAS'].items():
+        if value is not None and value != '':
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+    cursor.close()
+
+# Request instrumentation
+#
+# Flask request hooks and SQLAlchemy cursor events feed in-process
+# Prometheus-style histograms, exported as text on /metrics. Recording a
+# request costs a few perf_counter() calls and one short lock per series.
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+class Histogram:
+    """Cumulative histogram with one series per tuple of label values."""
+
+    def __init__(self, name, description, label_names, buckets):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        with self._lock:
+            snapshot = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for labels, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = format_labels(self.label_names + ('le',), labels + (format(bound, 'g') if bound != '+Inf' else bound,))
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {total:.6f}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {cumulative}')
+        return lines
+
+class Counter:
+    """Monotonic counter with one series per tuple of label values."""
+
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            snapshot = sorted(self._series.items())
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{format_labels(self.label_names, labels)} {value}' for labels, value in snapshot)
+        return lines
+
+class RequestMetrics:
+    def __init__(self, enabled, slow_query_ms, buckets):
+        self.enabled = enabled
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.requests = Counter('http_requests_total', 'HTTP requests by endpoint and status.', ('method', 'endpoint', 'status'))
+        self.request_duration = Histogram(
+            'http_request_duration_seconds', 'Time to produce a response, by endpoint.', ('method', 'endpoint'), buckets)
+        self.sql_statements = Histogram(
+            'http_request_sql_statements', 'SQL statements executed per request, by endpoint.', ('endpoint',),
+            (0, 1, 2, 3, 5, 10, 20, 50, 100, 500))
+        self.sql_duration = Histogram(
+            'http_request_sql_duration_seconds', 'Time spent executing SQL per request, by endpoint.', ('endpoint',), buckets)
+        self.template_duration = Histogram(
+            'template_render_duration_seconds', 'Jinja template render time, by template.', ('template',), buckets)
+        self.slow_queries = Counter(
+            'sql_slow_queries_total', 'SQL statements slower than the slow query threshold, by endpoint.', ('endpoint',))
+
+    def render(self):
+        lines = []
+        for metric in (self.requests, self.request_duration, self.sql_statements, self.sql_duration,
+                       self.template_duration, self.slow_queries):
+            lines.extend(metric.render())
+        return lines
+
+request_metrics = RequestMetrics(app.config['METRICS_ENABLED'], app.config['SLOW_QUERY_MS'], app.config['LATENCY_BUCKETS'])
+slow_query_log = logging.getLogger('pharmacy.slow_query')
+
+def current_endpoint():
+    return (request.endpoint or 'unmatched') if has_request_context() else 'none'
+
+@app.before_request
+def start_request_timer():
+    if request_metrics.enabled:
+        g.request_started = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def record_request_metrics(error=None):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    # Streamed bodies (CSV export, alert stream) are timed up to the start of the stream
+    elapsed = time.perf_counter() - started
+    endpoint = current_endpoint()
+    status = g.get('response_status', 500)
+    request_metrics.requests.inc((request.method, endpoint, status))
+    request_metrics.request_duration.observe((request.method, endpoint), elapsed)
+    request_metrics.sql_statements.observe((endpoint,), g.sql_statements)
+    request_metrics.sql_duration.observe((endpoint,), g.sql_seconds)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if request_metrics.enabled:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+        g.sql_seconds += elapsed
+    if elapsed >= request_metrics.slow_query_seconds:
+        endpoint = current_endpoint()
+        request_metrics.slow_queries.inc((endpoint,))
+        if executemany:
+            parameters = f'{len(parameters)} parameter sets, first {parameters[0]!r}' if parameters else parameters
+        slow_query_log.warning('%.1f ms in %s: %s; parameters: %.1000s',
+                               elapsed * 1000, endpoint, ' '.join(statement.split()), parameters)
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(context):
+    # after_cursor_execute does not run for failed statements
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    if request_metrics.enabled:
+        g.setdefault('template_started', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def record_template_render(sender, template, context, **extra):
+    started = g.get('template_started')
+    if started:
+        request_metrics.template_duration.observe((template.name,), time.perf_counter() - started.pop())
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -57,26 +341,3631 @@ class Product(db.Model):
     expiry_date = db.Column(db.Date)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     transactions = db.relationship('Transaction', backref='product', lazy=True)
+    lots = db.relationship('ProductLot', backref='product', lazy=True)
+
+    __table_args__ = (
+        db.Index('ix_product_name', 'name'),
+        db.Index('ix_product_category_name', 'category', 'name'),
+        db.Index('ix_product_expiry_date', 'expiry_date'),
+        # Partial index holding only low-stock rows, used by the dashboard
+        # and the low-stock filter on the product list
+        db.Index('ix_product_low_stock', 'name',
+                 sqlite_where=db.text('quantity <= reorder_level'),
+                 postgresql_where=db.text('quantity <= reorder_level')),
+    )
+
+class Location(db.Model):
+    # A branch or store room holding stock. Requests that name no location
+    # act on DEFAULT_LOCATION_ID, the single store of older databases.
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(20), unique=True, nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+DEFAULT_LOCATION_ID = 1
+
+class StockLevel(db.Model):
+    # Stock of one product at one location. Product.quantity stays the total
+    # over all locations; the reorder level starts as the product's and can
+    # be set per location.
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    reorder_level = db.Column(db.Integer, nullable=False, default=10)
+
+    __table_args__ = (
+        db.Index('ix_stock_level_product', 'product_id', 'location_id'),
+        # Only low-stock rows, so network-wide and per-location low-stock
+        # lists read a few thousand index entries, not every stock level
+        db.Index('ix_stock_level_low', 'location_id', 'product_id',
+                 sqlite_where=db.text('quantity <= reorder_level'),
+                 postgresql_where=db.text('quantity <= reorder_level')),
+    )
+
+class ProductLot(db.Model):
+    # Stock of one product received together, with its own expiry, held at
+    # one location. Product quantity is the sum of its lots, a stock level
+    # the sum of its lots at that location, and Product.expiry_date is the
+    # earliest expiry among lots still in stock anywhere.
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False,
+                            default=DEFAULT_LOCATION_ID, server_default=db.text(str(DEFAULT_LOCATION_ID)))
+    lot_number = db.Column(db.String(50))
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    expiry_date = db.Column(db.Date)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Both indexes only hold lots still in stock, so emptied lots cost
+        # nothing to FEFO allocation or to the expiry filters
+        db.Index('ix_product_lot_fefo', 'product_id', 'location_id', 'expiry_date', 'id',
+                 sqlite_where=db.text('quantity > 0'),
+                 postgresql_where=db.text('quantity > 0')),
+        db.Index('ix_product_lot_expiry', 'expiry_date', 'product_id', 'location_id',
+                 sqlite_where=db.text('quantity > 0'),
+                 postgresql_where=db.text('quantity > 0')),
+    )
+
+# Rendered inline rather than as a bound parameter so the planner can match
+# it against the predicate of the partial lot indexes
+LOT_IN_STOCK = ProductLot.quantity > db.literal_column('0')
+
+class Transaction(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    transaction_type = db.Column(db.String(20), nullable=False)  # 'in' or 'out'
+    date = db.Column(db.DateTime, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False,
+                            default=DEFAULT_LOCATION_ID, server_default=db.text(str(DEFAULT_LOCATION_ID)))
+    # Set on the 'out' and 'in' rows of a transfer between locations
+    transfer_id = db.Column(db.String(32))
+
+    __table_args__ = (
+        db.Index('ix_transaction_product_date', 'product_id', 'date'),
+        db.Index('ix_transaction_date_type', 'date', 'transaction_type'),
+        db.Index('ix_transaction_location_date', 'location_id', 'date'),
+    )
+
+class DailyProductMovement(db.Model):
+    # Per product, per (UTC) day totals of Transaction rows, maintained in the
+    # same transaction as every stock mutation
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    qty_in = db.Column(db.Integer, nullable=False, default=0)
+    qty_out = db.Column(db.Integer, nullable=False, default=0)
+    tx_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_daily_product_movement_day', 'day'),
+    )
+
+class DailyLocationMovement(db.Model):
+    # The same totals per location, for location-scoped dashboards and
+    # forecasts. Transfers between locations are left out of both rollups,
+    # as they are neither received nor dispensed stock.
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    qty_in = db.Column(db.Integer, nullable=False, default=0)
+    qty_out = db.Column(db.Integer, nullable=False, default=0)
+    tx_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_daily_location_movement_day', 'location_id', 'day'),
+    )
+
+class TransactionArchive(db.Model):
+    # One row per calendar month moved out of the transaction table; the rows
+    # themselves are in the table named by archive_table(month)
+    month = db.Column(db.Date, primary_key=True)  # first day of the month
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class BarcodeLookup(db.Model):
+    # Cached external barcode lookups, including misses
+    barcode = db.Column(db.String(50), primary_key=True)
+    found = db.Column(db.Boolean, nullable=False)
+    payload = db.Column(db.Text)
+    fetched_at = db.Column(db.DateTime, nullable=False)
+    last_used_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class Job(db.Model):
+    # Background jobs. The table is the queue: workers in any process claim
+    # queued rows, and result files live under JOB_RESULTS_DIR/<id>/
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded, failed, cancelled
+    params = db.Column(db.Text)  # JSON
+    user_id = db.Column(db.Integer)
+    progress = db.Column(db.Float)  # 0 to 1, or None when the total is unknown
+    message = db.Column(db.String(200))
+    result = db.Column(db.Text)  # JSON summary
+    result_file = db.Column(db.String(255))
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    worker = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_job_status_created', 'status', 'created_at'),
+        db.Index('ix_job_user_created', 'user_id', 'created_at'),
+    )
+
+# Schema migrations
+#
+# A new database is created straight from the models and stamped with the
+# latest version. An existing database is brought up to date by running, in
+# order, every migration newer than the version recorded in schema_version.
+# Migrations must be written against the schema as it was before them.
+MIGRATIONS = []
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+def create_indexes(conn, model, names):
+    for index in model.__table__.indexes:
+        if index.name in names:
+            index.create(conn, checkfirst=True)
+
+@migration(1, 'Indexes for hot product and transaction filters')
+def add_hot_filter_indexes(conn):
+    create_indexes(conn, Product, {
+        'ix_product_name', 'ix_product_category_name', 'ix_product_expiry_date', 'ix_product_low_stock'
+    })
+    create_indexes(conn, Transaction, {'ix_transaction_product_date', 'ix_transaction_date_type'})
+
+@migration(2, 'Daily stock movement rollup')
+def add_daily_product_movement(conn):
+    DailyProductMovement.__table__.create(conn, checkfirst=True)
+    # Not rebuild_daily_movements(), which reads the location columns added
+    # by migration 8
+    c = db.table('transaction', db.column('id'), db.column('product_id'), db.column('quantity'),
+                 db.column('transaction_type'), db.column('date')).c
+    day = db.func.date(c.date)
+    conn.execute(db.insert(DailyProductMovement.__table__).from_select(
+        ['product_id', 'day', 'qty_in', 'qty_out', 'tx_count'],
+        db.select(
+            c.product_id,
+            day,
+            db.func.sum(db.case((c.transaction_type == 'in', c.quantity), else_=0)),
+            db.func.sum(db.case((c.transaction_type == 'out', c.quantity), else_=0)),
+            db.func.count(c.id)
+        ).group_by(c.product_id, day)
+    ))
+
+@migration(3, 'Barcode lookup cache')
+def add_barcode_lookup(conn):
+    BarcodeLookup.__table__.create(conn, checkfirst=True)
+
+@migration(4, 'Product lots')
+def add_product_lots(conn):
+    ProductLot.__table__.create(conn, checkfirst=True)
+    # Existing stock becomes one lot per product
+    conn.execute(db.text(
+        'INSERT INTO product_lot (product_id, quantity, expiry_date, received_at) '
+        'SELECT id, quantity, expiry_date, created_at FROM product WHERE quantity > 0'
+    ))
+
+@migration(5, 'Transaction archive')
+def add_transaction_archive(conn):
+    TransactionArchive.__table__.create(conn, checkfirst=True)
+
+@migration(6, 'Product search index')
+def add_product_search(conn):
+    create_product_search(Product.__table__, conn)
+    conn.exec_driver_sql("INSERT INTO product_search (product_search) VALUES ('rebuild')")
+
+@migration(7, 'Background jobs')
+def add_jobs(conn):
+    Job.__table__.create(conn, checkfirst=True)
+
+def add_missing_columns(conn, table, names):
+    # Tables created by earlier migrations from the current models already
+    # have the columns
+    existing = {column['name'] for column in db.inspect(conn).get_columns(table.name)}
+    preparer = conn.dialect.identifier_preparer
+    for name in names:
+        if name not in existing:
+            column = CreateColumn(table.c[name]).compile(dialect=conn.dialect)
+            conn.execute(db.text(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {column}'))
+
+def create_default_location(conn):
+    if conn.execute(db.select(Location.id).where(Location.id == DEFAULT_LOCATION_ID)).first() is None:
+        conn.execute(db.insert(Location).values(id=DEFAULT_LOCATION_ID, code='MAIN', name='Main store'))
+
+@migration(8, 'Stock locations')
+def add_stock_locations(conn):
+    for model in (Location, StockLevel, DailyLocationMovement):
+        model.__table__.create(conn, checkfirst=True)
+    create_default_location(conn)
+    # Everything held so far is stock of the default location
+    add_missing_columns(conn, ProductLot.__table__, ['location_id'])
+    add_missing_columns(conn, Transaction.__table__, ['location_id', 'transfer_id'])
+    for table in all_transaction_tables(conn)[1:]:
+        add_missing_columns(conn, table, ['location_id', 'transfer_id'])
+    for name in ('ix_product_lot_fefo', 'ix_product_lot_expiry'):
+        conn.execute(db.text(f'DROP INDEX IF EXISTS {name}'))
+    create_indexes(conn, ProductLot, {'ix_product_lot_fefo', 'ix_product_lot_expiry'})
+    create_indexes(conn, Transaction, {'ix_transaction_location_date'})
+    backfill_stock_levels(conn)
+    rebuild_daily_movements(conn)
+
+def get_schema_version(conn):
+    if not db.inspect(conn).has_table('schema_version'):
+        return None
+    return conn.execute(db.text('SELECT version FROM schema_version')).scalar()
+
+def set_schema_version(conn, version):
+    conn.execute(db.text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    conn.execute(db.text('DELETE FROM schema_version'))
+    conn.execute(db.text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': version})
+
+def upgrade_database():
+    """Create or migrate the database schema. Returns the applied migrations."""
+    latest = MIGRATIONS[-1][0] if MIGRATIONS else 0
+    with db.engine.begin() as conn:
+        current = get_schema_version(conn)
+        if current is None:
+            if not db.inspect(conn).has_table('product'):
+                # Fresh database: build the current schema directly
+                db.metadata.create_all(conn)
+                create_default_location(conn)
+                set_schema_version(conn, latest)
+                return []
+            # Database created by db.create_all() before migrations existed
+            current = 0
+            set_schema_version(conn, current)
+
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        if version <= current:
+            continue
+        with db.engine.begin() as conn:
+            fn(conn)
+            set_schema_version(conn, version)
+        applied.append((version, description))
+    return applied
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create the database or apply pending schema migrations."""
+    applied = upgrade_database()
+    for version, description in applied:
+        print(f'Applied migration {version}: {description}')
+    with db.engine.connect() as conn:
+        print(f'Database schema is at version {get_schema_version(conn)}')
+
+# Conditional GETs
+#
+# Writes bump a counter per table through the signals: product for the
+# catalogue and stock levels, transaction for movements and user for the
+# names shown next to them. Pages built from those tables carry an ETag and
+# Last-Modified derived from the counters, and a request whose validators
+# still match gets a 304 before the view runs, with no query and no render.
+# The counters are per process, so the ETag also changes every
+# HTTP_CACHE_TTL seconds; that bounds how long a write made by another
+# process can hide behind a 304.
+class DataVersions:
+    """Per-table write counters, with the time of the last write to each table in this process."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # Counters are per process and restart from zero, so the nonce keeps
+        # another worker's (or an earlier run's) ETags from ever matching
+        self.nonce = secrets.token_hex(4)
+        self._versions = {}  # table -> (counter, time of last write)
+        self._lock = threading.Lock()
+
+    def bump(self, *tables):
+        now = time.time()
+        with self._lock:
+            for table in tables:
+                self._versions[table] = (self._versions.get(table, (0, 0))[0] + 1, now)
+
+    def validators(self, tables):
+        """Return (key, etag, last_modified) for a response built from ``tables``.
+
+        ``key`` changes whenever the ETag does, so it can also key server-side
+        caches of what the response is built from.
+        """
+        epoch = int(time.time() // self.ttl)
+        with self._lock:
+            versions = [self._versions.get(table, (0, 0)) for table in tables]
+        # The date covers pages with "expiring soon" and "last 30 days" figures
+        key = f'{self.nonce}:{epoch}:{datetime.now().date()}:' + ','.join(
+            f'{table}={counter}' for table, (counter, _) in zip(tables, versions)
+        )
+        modified = max([epoch * self.ttl] + [written for _, written in versions])
+        return key, hashlib.blake2b(key.encode(), digest_size=8).hexdigest(), \
+            datetime.fromtimestamp(int(modified), timezone.utc)
+
+data_versions = DataVersions(app.config['HTTP_CACHE_TTL'])
+
+@products_changed.connect
+def bump_product_version(sender, **kwargs):
+    data_versions.bump('product')
+
+@stock_changed.connect
+def bump_stock_versions(sender, **kwargs):
+    data_versions.bump('product', 'transaction')
+
+def conditional_view(*tables):
+    """Answer a GET with 304 Not Modified, without running the view, while ``tables`` are unchanged."""
+    def decorate(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Flashed messages are part of the page
+            if '_flashes' in session:
+                return view(*args, **kwargs)
+            _, etag, modified = data_versions.validators(tables)
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = request.if_modified_since is not None and modified <= request.if_modified_since
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or get_flashed_messages():
+                    return response
+            response.set_etag(etag, weak=True)
+            response.last_modified = modified
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorate
+
+class FragmentCache:
+    """LRU cache of rendered page fragments.
+
+    Callers put DataVersions.validators() keys in their cache keys, so a
+    write leaves the old entries unreachable until they age out.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        if not self.size:
+            return render()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        entry = render()
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'size': self.size}
+
+product_table_fragments = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+# Session user cache
+class SessionUser(UserMixin):
+    """Detached snapshot of a User row, used as current_user."""
+
+    def __init__(self, id, username, role):
+        self.id = id
+        self.username = username
+        self.role = role
+
+class UserCache:
+    """Bounded LRU cache of SessionUser snapshots, each kept at most ``ttl`` seconds.
+
+    Saves the user query Flask-Login would otherwise run on every
+    authenticated request. Entries are dropped when their User row is updated
+    or deleted through the ORM in this process; the TTL bounds how long a
+    change made by another process goes unnoticed. A size of 0 disables it.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        row = db.session.query(User.id, User.username, User.role).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        user = SessionUser(*row)
+        with self._lock:
+            # Skip caching a row read before a concurrent invalidation
+            if self.size and generation == self._generation:
+                self._entries[user_id] = (now + self.ttl, user)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids or list(self._entries):
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'ttl': self.ttl}
+
+user_cache = UserCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def track_user_changes(mapper, connection, target):
+    object_session(target).info.setdefault('changed_users', set()).add(target.id)
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_changed_users(session):
+    # After the commit, so a concurrent request cannot cache the old row again
+    changed = session.info.pop('changed_users', None)
+    if changed:
+        user_cache.invalidate(*changed)
+        data_versions.bump('user')
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_users(session):
+    session.info.pop('changed_users', None)
+
+@login_manager.user_loader
+def load_user(user_id):
+    return user_cache.get(int(user_id))
+
+# Stock mutation service
+class StockError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def is_lock_error(error):
+    message = str(error.orig).lower()
+    return 'locked' in message or 'busy' in message
+
+def apply_stock_movement(product_id, quantity, transaction_type, user_id, expiry_date=None, lot_number=None,
+                         location_id=DEFAULT_LOCATION_ID):
+    """Atomically move stock in or out of a product at a location and record the transaction.
+
+    The quantity changes are conditional UPDATEs, of the stock level at the
+    location and then of the product total, so concurrent workers can
+    neither lose updates nor oversell. Stock in is added to a lot at the
+    location with the given expiry and lot number; stock out is taken from
+    the location's lots first expiry first out. The lots and the Transaction
+    row are written in the same unit of work. Returns the new total quantity,
+    the lots moved and the new quantity at the location.
+    """
+    if transaction_type == 'in':
+        stmt = db.update(Product).where(
+            Product.id == product_id
+        ).values(quantity=Product.quantity + quantity)
+    else:
+        stmt = db.update(Product).where(
+            Product.id == product_id,
+            Product.quantity >= quantity
+        ).values(quantity=Product.quantity - quantity)
+    stmt = stmt.execution_options(synchronize_session=False)
+
+    retries = app.config['STOCK_UPDATE_RETRIES']
+    for attempt in range(retries):
+        try:
+            location_quantity = move_location_stock(
+                location_id, product_id, quantity if transaction_type == 'in' else -quantity
+            )
+            row = None
+            if location_quantity is not None:
+                if db.engine.dialect.update_returning:
+                    row = db.session.execute(stmt.returning(Product.quantity, Product.reorder_level)).first()
+                else:
+                    result = db.session.execute(stmt)
+                    if result.rowcount:
+                        row = db.session.query(Product.quantity, Product.reorder_level).filter(Product.id == product_id).first()
+
+            if row is None:
+                db.session.rollback()
+                if db.session.get(Product, product_id) is None:
+                    raise StockError('Product not found', 404)
+                raise StockError('Insufficient stock')
+
+            now = datetime.utcnow()
+            if transaction_type == 'in':
+                lots = list(receive_lots({(product_id, expiry_date, lot_number): quantity}, now, location_id).values())
+                if expiry_date:
+                    refresh_product_expiry([product_id])
+            else:
+                lots = allocate_lots({product_id: quantity}, location_id)[product_id]
+                if any(lot['remaining'] == 0 for lot in lots):
+                    refresh_product_expiry([product_id])
+            db.session.add(Transaction(
+                product_id=product_id,
+                quantity=quantity,
+                transaction_type=transaction_type,
+                date=now,
+                user_id=user_id,
+                location_id=location_id
+            ))
+            movement = (product_id, quantity, transaction_type, now)
+            record_daily_movements([movement], location_id)
+            db.session.commit()
+            break
+        except IntegrityError:
+            # Another worker opened the stock level first; it is there now
+            db.session.rollback()
+            if attempt == retries - 1:
+                raise StockError('Stock changed concurrently, please retry', 409)
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_lock_error(e) or attempt == retries - 1:
+                raise
+            time.sleep(0.01 * 2 ** attempt)
+
+    new_quantity, reorder_level = row
+    old_quantity = new_quantity - quantity if transaction_type == 'in' else new_quantity + quantity
+    send_committed(stock_changed, movements=[movement], changes=[{
+        'product_id': product_id,
+        'old_quantity': old_quantity,
+        'new_quantity': new_quantity,
+        'reorder_level': reorder_level
+    }])
+    return new_quantity, lots, location_quantity
+
+def move_location_stock(location_id, product_id, delta):
+    """Add ``delta`` to a product's stock level at a location and return the new level.
+
+    A removal is guarded like the product update and returns None instead
+    of taking the level below zero. Stock received at a location without a
+    stock level for the product opens one there.
+    """
+    table = StockLevel.__table__
+    where = (table.c.location_id == location_id, table.c.product_id == product_id)
+    stmt = db.update(table).where(*where)
+    if delta < 0:
+        stmt = stmt.where(table.c.quantity >= -delta)
+    stmt = stmt.values(quantity=table.c.quantity + delta)
+
+    for attempt in range(2):
+        if db.engine.dialect.update_returning:
+            level = db.session.execute(stmt.returning(table.c.quantity)).scalar()
+        else:
+            level = None
+            if db.session.execute(stmt).rowcount:
+                level = db.session.execute(db.select(table.c.quantity).where(*where)).scalar()
+        # Products written straight to the product table have no stock
+        # levels until their first movement
+        if level is not None or attempt or not backfill_stock_levels(db.session, [product_id]):
+            break
+
+    if level is None and delta > 0:
+        opened = db.session.execute(db.insert(table).from_select(
+            ['location_id', 'product_id', 'quantity', 'reorder_level'],
+            db.select(
+                db.literal(location_id), Product.id, db.literal(delta), db.func.coalesce(Product.reorder_level, 0)
+            ).where(Product.id == product_id)
+        ))
+        if opened.rowcount:
+            level = delta
+    return level
+
+def backfill_stock_levels(conn, product_ids=None):
+    """Give products without any stock level one at the default location holding all their stock.
+
+    Products added through the app get theirs when they are created; this
+    covers databases from before locations and rows written straight to the
+    product table. ``conn`` is a connection or the session. Returns the
+    number of stock levels created.
+    """
+    table = StockLevel.__table__
+    select = db.select(
+        db.literal(DEFAULT_LOCATION_ID),
+        Product.id,
+        db.func.coalesce(Product.quantity, 0),
+        db.func.coalesce(Product.reorder_level, 0)
+    ).where(~db.exists().where(table.c.product_id == Product.id))
+    created = 0
+    for chunk in [None] if product_ids is None else chunked(product_ids):
+        stmt = select if chunk is None else select.where(Product.id.in_(chunk))
+        created += conn.execute(db.insert(table).from_select(
+            ['location_id', 'product_id', 'quantity', 'reorder_level'], stmt
+        )).rowcount
+    return created
+
+def record_daily_movements(movements, location_id=DEFAULT_LOCATION_ID):
+    """Add (product_id, quantity, transaction_type, date) movements at a location to the daily rollups.
+
+    Runs in the caller's session so the rollups commit or roll back together
+    with the Transaction rows they summarise.
+    """
+    totals = {}
+    for product_id, quantity, transaction_type, date in movements:
+        row = totals.setdefault((product_id, date.date()), [0, 0, 0])
+        row[0 if transaction_type == 'in' else 1] += quantity
+        row[2] += 1
+    if not totals:
+        return
+
+    rows = [
+        {'product_id': pid, 'day': day, 'qty_in': qty_in, 'qty_out': qty_out, 'tx_count': tx_count}
+        for (pid, day), (qty_in, qty_out, tx_count) in totals.items()
+    ]
+    add_to_rollup(DailyProductMovement.__table__, rows)
+    add_to_rollup(DailyLocationMovement.__table__, [dict(row, location_id=location_id) for row in rows])
+
+_rollup_upserts = {}
+
+def rollup_upsert(table):
+    # Spelled out as text and built once: SQLAlchemy does not cache the
+    # compiled form of an ON CONFLICT insert, and compiling it on every
+    # movement took longer than running it. SQLite and PostgreSQL share
+    # the syntax.
+    stmt = _rollup_upserts.get(table.name)
+    if stmt is None:
+        columns = [column.name for column in table.columns]
+        keys = [column.name for column in table.primary_key.columns]
+        stmt = db.text(
+            f"INSERT INTO {table.name} ({', '.join(columns)}) VALUES ({', '.join(':' + name for name in columns)}) "
+            f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+            + ', '.join(f'{name} = {table.name}.{name} + excluded.{name}' for name in columns if name not in keys)
+        ).bindparams(*(db.bindparam(column.name, type_=column.type) for column in table.columns))
+        _rollup_upserts[table.name] = stmt
+    return stmt
+
+def add_to_rollup(table, rows):
+    keys = [column for column in table.primary_key.columns]
+    if db.engine.dialect.name in ('sqlite', 'postgresql'):
+        db.session.execute(rollup_upsert(table), rows)
+        return
+
+    for row in rows:
+        result = db.session.execute(
+            db.update(table).where(
+                *(key == row[key.name] for key in keys)
+            ).values(
+                qty_in=table.c.qty_in + row['qty_in'],
+                qty_out=table.c.qty_out + row['qty_out'],
+                tx_count=table.c.tx_count + row['tx_count']
+            )
+        )
+        if not result.rowcount:
+            db.session.execute(db.insert(table), row)
+
+def rebuild_daily_movements(conn, since=None):
+    """Recompute the daily rollups from live and archived transactions, optionally from a given day on."""
+    for table in (DailyProductMovement.__table__, DailyLocationMovement.__table__):
+        keys = [column.name for column in table.primary_key.columns if column.name != 'day']
+        delete = db.delete(table)
+        if since:
+            delete = delete.where(table.c.day >= since)
+        conn.execute(delete)
+        # Archive months and the live table never share a day, so each source
+        # can be grouped on its own
+        for source in all_transaction_tables(conn):
+            c = source.c
+            group = [c[key] for key in keys] + [db.func.date(c.date)]
+            select = db.select(
+                *group,
+                db.func.sum(db.case((c.transaction_type == 'in', c.quantity), else_=0)),
+                db.func.sum(db.case((c.transaction_type == 'out', c.quantity), else_=0)),
+                db.func.count(c.id)
+            ).where(c.transfer_id.is_(None)).group_by(*group)
+            if since:
+                select = select.where(c.date >= datetime.combine(since, datetime.min.time()))
+            conn.execute(db.insert(table).from_select(
+                keys + ['day', 'qty_in', 'qty_out', 'tx_count'], select
+            ))
+
+@app.cli.command('rebuild-rollups')
+@click.option('--since', help='Only rebuild days on or after this date (YYYY-MM-DD)')
+def rebuild_rollups_command(since):
+    """Rebuild the daily stock movement rollups from the transactions table."""
+    if since:
+        since = datetime.strptime(since, '%Y-%m-%d').date()
+    with db.engine.begin() as conn:
+        rebuild_daily_movements(conn, since)
+        rows = conn.execute(db.select(db.func.count()).select_from(DailyProductMovement.__table__)).scalar()
+    print(f'Daily movement rollup rebuilt ({rows} rows)')
+
+def parse_stock_line(data):
+    # Validate input data
+    if not isinstance(data, dict):
+        raise StockError('Invalid request data')
+
+    if 'quantity' not in data or 'operation' not in data:
+        raise StockError('Missing required fields')
+
+    try:
+        quantity = int(data['quantity'])
+    except (ValueError, TypeError):
+        raise StockError('Invalid quantity value')
+    if quantity <= 0:
+        raise StockError('Quantity must be greater than 0')
+
+    operation = str(data['operation']).strip().lower()
+    if operation not in ['add', 'remove']:
+        raise StockError('Invalid operation. Use "add" or "remove"')
+
+    return quantity, operation
+
+def parse_lot_fields(data):
+    expiry_date = None
+    if data.get('expiry_date'):
+        try:
+            expiry_date = datetime.strptime(str(data['expiry_date']).strip(), '%Y-%m-%d').date()
+        except ValueError:
+            raise StockError('Invalid expiry date format. Use YYYY-MM-DD')
+    lot_number = str(data['lot_number']).strip() if data.get('lot_number') else None
+    return expiry_date, lot_number or None
+
+def lot_to_dict(lot_id, lot_number, expiry_date, quantity, remaining):
+    return {
+        'lot_id': lot_id,
+        'lot_number': lot_number,
+        'expiry_date': expiry_date.strftime('%Y-%m-%d') if expiry_date else None,
+        'quantity': quantity,
+        'remaining': remaining
+    }
+
+def in_stock_lots(product_ids, *criteria, limit=None):
+    """Yield in-stock lots of the given products, in FEFO order per product.
+
+    At most ``limit`` lots per product are read. A single product is one range
+    scan of ix_product_lot_fefo that stops after ``limit`` lots; several are
+    read in one statement per chunk, ranked per product by a window function.
+    """
+    columns = (ProductLot.id, ProductLot.product_id, ProductLot.lot_number, ProductLot.expiry_date, ProductLot.quantity)
+    order = (ProductLot.expiry_date, ProductLot.id)
+    product_ids = list(product_ids)
+    if len(product_ids) == 1:
+        yield from db.session.execute(db.select(*columns).where(
+            ProductLot.product_id == product_ids[0], LOT_IN_STOCK, *criteria
+        ).order_by(*order).limit(limit))
+        return
+    for chunk in chunked(product_ids):
+        ranked = db.select(
+            *columns,
+            db.func.row_number().over(partition_by=ProductLot.product_id, order_by=order).label('rank')
+        ).where(ProductLot.product_id.in_(chunk), LOT_IN_STOCK, *criteria).subquery()
+        stmt = db.select(*(ranked.c[column.key] for column in columns))
+        if limit:
+            stmt = stmt.where(ranked.c.rank <= limit)
+        yield from db.session.execute(stmt.order_by(ranked.c.product_id, ranked.c.expiry_date, ranked.c.id))
+
+def receive_lots(receipts, received_at=None, location_id=DEFAULT_LOCATION_ID):
+    """Add stock received at a location to lots and return the lot moved for each receipt.
+
+    ``receipts`` maps (product_id, expiry_date, lot_number) to a quantity.
+    Each receipt is added to the location's in-stock lot with the same
+    expiry and lot number if there is one, otherwise it opens a new lot.
+    """
+    received_at = received_at or datetime.utcnow()
+    keys = list(receipts)
+    existing = {}
+    if keys:
+        expiries = {expiry_date for _, expiry_date, _ in keys}
+        same_expiry = ProductLot.expiry_date.in_([expiry_date for expiry_date in expiries if expiry_date])
+        if None in expiries:
+            same_expiry = db.or_(same_expiry, ProductLot.expiry_date.is_(None))
+        for lot in in_stock_lots({product_id for product_id, _, _ in keys}, same_expiry,
+                                 ProductLot.location_id == location_id):
+            existing.setdefault((lot.product_id, lot.expiry_date, lot.lot_number), lot)
+        existing = {key: existing[key] for key in keys if key in existing}
+
+    lot_table = ProductLot.__table__
+    additions = [{'b_id': existing[key].id, 'b_add': receipts[key]} for key in keys if key in existing]
+    if additions:
+        db.session.execute(db.update(lot_table).where(
+            lot_table.c.id == db.bindparam('b_id')
+        ).values(quantity=lot_table.c.quantity + db.bindparam('b_add')), additions)
+    opened = [key for key in keys if key not in existing]
+    new_ids = {}
+    if opened:
+        new_ids = dict(zip(opened, db.session.execute(db.insert(ProductLot).returning(ProductLot.id, sort_by_parameter_order=True), [
+            {
+                'product_id': product_id,
+                'location_id': location_id,
+                'expiry_date': expiry_date,
+                'lot_number': lot_number,
+                'quantity': receipts[(product_id, expiry_date, lot_number)],
+                'received_at': received_at
+            }
+            for product_id, expiry_date, lot_number in opened
+        ]).scalars().all()))
+
+    moved = {}
+    for key in keys:
+        if key in existing:
+            lot_id, remaining = existing[key].id, existing[key].quantity + receipts[key]
+        else:
+            lot_id, remaining = new_ids[key], receipts[key]
+        moved[key] = lot_to_dict(lot_id, key[2], key[1], receipts[key], remaining)
+    return moved
+
+def allocate_lots(removals, location_id=DEFAULT_LOCATION_ID):
+    """Take stock out of a location's lots, first expiry first out, and return the lots taken from per product.
+
+    ``removals`` maps product ids to quantities. In-stock lots are read a page
+    at a time in expiry order, dated lots before undated ones, so a single
+    removal only reads the lots it consumes (plus the rest of one short page)
+    from ix_product_lot_fefo however many lots the product has. Must run after the
+    stock levels themselves were updated, which serialises concurrent
+    movements of the same product at the location.
+    """
+    fetch = app.config['LOT_FETCH_SIZE']
+    lot_table = ProductLot.__table__
+    take_update = db.update(lot_table).where(
+        lot_table.c.id == db.bindparam('b_id')
+    ).values(quantity=lot_table.c.quantity - db.bindparam('b_take'))
+
+    allocations = {product_id: [] for product_id in removals}
+    remaining = {product_id: quantity for product_id, quantity in removals.items() if quantity > 0}
+    for dated in (True, False):
+        pending = list(remaining)
+        while pending:
+            pages = {product_id: [] for product_id in pending}
+            for lot in in_stock_lots(
+                pending,
+                ProductLot.expiry_date.isnot(None) if dated else ProductLot.expiry_date.is_(None),
+                ProductLot.location_id == location_id,
+                limit=fetch
+            ):
+                pages[lot.product_id].append(lot)
+
+            takes = []
+            next_pending = []
+            for product_id, lots in pages.items():
+                for lot in lots:
+                    take = min(lot.quantity, remaining[product_id])
+                    takes.append({'b_id': lot.id, 'b_take': take})
+                    allocations[product_id].append(
+                        lot_to_dict(lot.id, lot.lot_number, lot.expiry_date, take, lot.quantity - take)
+                    )
+                    remaining[product_id] -= take
+                    if not remaining[product_id]:
+                        del remaining[product_id]
+                        break
+                else:
+                    # A full page was used up: more lots may follow
+                    if len(lots) == fetch:
+                        next_pending.append(product_id)
+            if takes:
+                db.session.execute(take_update, takes)
+            pending = next_pending
+
+    for product_id, short in remaining.items():
+        app.logger.warning('Product %s lots at location %s are %s short of its stock level', product_id, location_id, short)
+    return allocations
+
+def refresh_product_expiry(product_ids):
+    """Set Product.expiry_date to the earliest expiry among each product's in-stock lots."""
+    earliest = db.select(db.func.min(ProductLot.expiry_date)).where(
+        ProductLot.product_id == Product.id,
+        LOT_IN_STOCK,
+        ProductLot.expiry_date.isnot(None)
+    ).scalar_subquery()
+    for chunk in chunked(product_ids):
+        db.session.execute(db.update(Product).where(Product.id.in_(chunk)).values(
+            expiry_date=earliest
+        ).execution_options(synchronize_session=False))
+
+def chunked(items, size=500):
+    # Keep IN lists below SQLite's bound-parameter limit
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def apply_stock_batch(lines, user_id, location_id=DEFAULT_LOCATION_ID):
+    """Apply many stock movements at one location in one transaction and return per-line results.
+
+    Products are resolved by id or barcode in bulk, the lines are replayed in
+    order against the current quantities at the location, and the accepted
+    movements are written with a few executemany statements and a single
+    commit. Each product and stock level update is guarded by its previously
+    read quantity, so if another worker changed one of them in the meantime
+    the whole batch is re-read and retried.
+    """
+    results = [None] * len(lines)
+    parsed = []
+    for i, line in enumerate(lines):
+        try:
+            quantity, operation = parse_stock_line(line)
+            expiry_date, lot_number = parse_lot_fields(line)
+            product_id = line.get('product_id')
+            barcode = line.get('barcode')
+            if product_id is None and not barcode:
+                raise StockError('product_id or barcode is required')
+            if product_id is not None:
+                product_id = int(product_id)
+        except (ValueError, TypeError):
+            results[i] = {'line': i, 'status': 'error', 'error': 'Invalid product_id'}
+            continue
+        except StockError as e:
+            results[i] = {'line': i, 'status': 'error', 'error': str(e)}
+            continue
+        parsed.append((i, product_id, str(barcode) if barcode else None, quantity, operation, expiry_date, lot_number))
+
+    ids = {p[1] for p in parsed if p[1] is not None}
+    barcodes = {p[2] for p in parsed if p[1] is None}
+    product_table = Product.__table__
+    guarded_update = db.update(product_table).where(
+        product_table.c.id == db.bindparam('b_id'),
+        product_table.c.quantity == db.bindparam('b_old')
+    ).values(quantity=db.bindparam('b_new'))
+    level_table = StockLevel.__table__
+    guarded_level_update = db.update(level_table).where(
+        level_table.c.location_id == location_id,
+        level_table.c.product_id == db.bindparam('b_id'),
+        level_table.c.quantity == db.bindparam('b_old')
+    ).values(quantity=db.bindparam('b_new'))
+
+    retries = app.config['STOCK_UPDATE_RETRIES']
+    for attempt in range(retries):
+        try:
+            quantities = {}
+            reorder_levels = {}
+            by_barcode = {}
+            for chunk in chunked(ids):
+                for pid, qty, reorder_level in db.session.query(
+                        Product.id, Product.quantity, Product.reorder_level).filter(Product.id.in_(chunk)):
+                    quantities[pid] = qty
+                    reorder_levels[pid] = reorder_level
+            for chunk in chunked(barcodes):
+                for pid, barcode, qty, reorder_level in db.session.query(
+                        Product.id, Product.barcode, Product.quantity, Product.reorder_level).filter(
+                        Product.barcode.in_(chunk)):
+                    by_barcode[barcode] = pid
+                    quantities[pid] = qty
+                    reorder_levels[pid] = reorder_level
+            levels = {}
+            for healed in (False, True):
+                for chunk in chunked(set(quantities) - set(levels)):
+                    levels.update(db.session.query(StockLevel.product_id, StockLevel.quantity).filter(
+                        StockLevel.location_id == location_id, StockLevel.product_id.in_(chunk)))
+                if healed or len(levels) == len(quantities) or not backfill_stock_levels(
+                        db.session, set(quantities) - set(levels)):
+                    break
+
+            current = dict(quantities)
+            current_levels = dict(levels)
+            transactions = []
+            receipts = {}
+            removals = {}
+            now = datetime.utcnow()
+            for i, product_id, barcode, quantity, operation, expiry_date, lot_number in parsed:
+                if product_id is None:
+                    product_id = by_barcode.get(barcode)
+                if product_id not in current:
+                    results[i] = {'line': i, 'status': 'error', 'error': 'Product not found'}
+                    continue
+                if operation == 'remove' and current_levels.get(product_id, 0) < quantity:
+                    results[i] = {'line': i, 'product_id': product_id, 'status': 'error', 'error': 'Insufficient stock'}
+                    continue
+                current[product_id] = (current[product_id] or 0) + (quantity if operation == 'add' else -quantity)
+                current_levels[product_id] = current_levels.get(product_id, 0) + (
+                    quantity if operation == 'add' else -quantity)
+                if operation == 'add':
+                    key = (product_id, expiry_date, lot_number)
+                    receipts[key] = receipts.get(key, 0) + quantity
+                else:
+                    removals[product_id] = removals.get(product_id, 0) + quantity
+                transactions.append({
+                    'product_id': product_id,
+                    'quantity': quantity,
+                    'transaction_type': 'in' if operation == 'add' else 'out',
+                    'date': now,
+                    'user_id': user_id,
+                    'location_id': location_id
+                })
+                results[i] = {
+                    'line': i,
+                    'product_id': product_id,
+                    'status': 'ok',
+                    'new_quantity': current[product_id],
+                    'location_quantity': current_levels[product_id]
+                }
+
+            updates = [
+                {'b_id': pid, 'b_old': quantities[pid], 'b_new': qty}
+                for pid, qty in current.items() if qty != quantities[pid]
+            ]
+            level_updates = [
+                {'b_id': pid, 'b_old': levels[pid], 'b_new': qty}
+                for pid, qty in current_levels.items() if pid in levels and qty != levels[pid]
+            ]
+            updated = True
+            if updates:
+                updated = db.session.execute(guarded_update, updates).rowcount == len(updates)
+            if updated and level_updates:
+                updated = db.session.execute(guarded_level_update, level_updates).rowcount == len(level_updates)
+            if not updated:
+                # A concurrent movement changed one of the products; start over
+                db.session.rollback()
+                if attempt == retries - 1:
+                    raise StockError('Stock changed concurrently, please retry', 409)
+                continue
+            opened = [
+                {'location_id': location_id, 'product_id': pid, 'quantity': qty, 'reorder_level': reorder_levels[pid] or 0}
+                for pid, qty in current_levels.items() if pid not in levels
+            ]
+            if opened:
+                db.session.execute(db.insert(StockLevel), opened)
+            # Lots are moved per product rather than per line: receipts first,
+            # so removals later in the batch can draw on them, then one FEFO
+            # allocation per product
+            expiry_changed = {product_id for product_id, expiry_date, _ in receipts if expiry_date}
+            receive_lots(receipts, now, location_id)
+            for product_id, lots in allocate_lots(removals, location_id).items():
+                if any(lot['remaining'] == 0 for lot in lots):
+                    expiry_changed.add(product_id)
+            refresh_product_expiry(expiry_changed)
+
+            movements = [(t['product_id'], t['quantity'], t['transaction_type'], t['date']) for t in transactions]
+            if transactions:
+                db.session.execute(db.insert(Transaction), transactions)
+                record_daily_movements(movements, location_id)
+            db.session.commit()
+            break
+        except IntegrityError:
+            # Another worker opened one of the stock levels first
+            db.session.rollback()
+            if attempt == retries - 1:
+                raise StockError('Stock changed concurrently, please retry', 409)
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_lock_error(e) or attempt == retries - 1:
+                raise
+            time.sleep(0.01 * 2 ** attempt)
+
+    if movements:
+        send_committed(stock_changed, movements=movements, changes=[
+            {
+                'product_id': pid,
+                'old_quantity': quantities[pid],
+                'new_quantity': qty,
+                'reorder_level': reorder_levels[pid]
+            }
+            for pid, qty in current.items() if qty != quantities[pid]
+        ])
+    return results
+
+# Stock locations
+#
+# A location's stock of a product is a stock_level row, and lots carry the
+# location they are held at. Product.quantity and the daily product rollup
+# stay totals over all locations, so reports that do not ask for a location
+# read them as before. Network-wide questions are one indexed query over
+# stock_level rather than one per branch: ix_stock_level_low holds only the
+# low-stock rows, in (location, product) order. Location-scoped dashboards
+# and forecasts read the per-location rollup.
+_locations = {'expires': 0, 'maps': ({}, {})}
+
+def get_locations(refresh=False):
+    """Return ({id: (code, name)}, {code: id}), reloaded after LOCATION_CACHE_TTL seconds."""
+    if refresh or time.monotonic() >= _locations['expires']:
+        rows = db.session.query(Location.id, Location.code, Location.name).order_by(Location.id).all()
+        _locations['maps'] = (
+            {location_id: (code, name) for location_id, code, name in rows},
+            {code: location_id for location_id, code, _ in rows}
+        )
+        _locations['expires'] = time.monotonic() + app.config['LOCATION_CACHE_TTL']
+    return _locations['maps']
+
+def resolve_location(value):
+    """Return the id of a location given by code or id; no value means the default location.
+
+    Raises ValueError for an unknown location.
+    """
+    if value is None or not str(value).strip():
+        return DEFAULT_LOCATION_ID
+    value = str(value).strip()
+    # Reload once on a miss, for locations added by other processes
+    for refresh in (False, True):
+        by_id, by_code = get_locations(refresh)
+        if value in by_code:
+            return by_code[value]
+        if value.isdigit() and int(value) in by_id:
+            return int(value)
+    raise ValueError(f'Unknown location: {value}')
+
+def location_param(value):
+    try:
+        return resolve_location(value)
+    except ValueError as e:
+        raise StockError(str(e), 404)
+
+def location_to_dict(location_id, low_stock_count=None):
+    code, name = get_locations()[0].get(location_id, (None, None))
+    location = {'id': location_id, 'code': code, 'name': name}
+    if low_stock_count is not None:
+        location['low_stock_count'] = low_stock_count
+    return location
+
+def transfer_stock(product_id, quantity, from_location_id, to_location_id, user_id):
+    """Move stock of a product from one location to another as one atomic movement.
+
+    The source stock level gets the guarded decrement of a removal and the
+    destination's is incremented; the source lots are drawn first expiry
+    first out into lots with the same expiry and lot number at the
+    destination. Both legs are recorded as an 'out' and an 'in' Transaction
+    sharing a transfer_id, in one unit of work. Product totals and expiry
+    dates do not change and the rollups leave transfers out. Returns the
+    transfer with the new quantity at both locations and the lots moved.
+    """
+    if from_location_id == to_location_id:
+        raise StockError('Source and destination locations must differ')
+
+    retries = app.config['STOCK_UPDATE_RETRIES']
+    for attempt in range(retries):
+        try:
+            from_quantity = move_location_stock(from_location_id, product_id, -quantity)
+            if from_quantity is None:
+                db.session.rollback()
+                if db.session.get(Product, product_id) is None:
+                    raise StockError('Product not found', 404)
+                raise StockError('Insufficient stock')
+            to_quantity = move_location_stock(to_location_id, product_id, quantity)
+
+            now = datetime.utcnow()
+            taken = allocate_lots({product_id: quantity}, from_location_id)[product_id]
+            receipts = {}
+            for lot in taken:
+                expiry_date = datetime.strptime(lot['expiry_date'], '%Y-%m-%d').date() if lot['expiry_date'] else None
+                key = (product_id, expiry_date, lot['lot_number'])
+                receipts[key] = receipts.get(key, 0) + lot['quantity']
+            received = receive_lots(receipts, now, to_location_id)
+
+            transfer_id = secrets.token_hex(16)
+            db.session.execute(db.insert(Transaction), [
+                {
+                    'product_id': product_id,
+                    'quantity': quantity,
+                    'transaction_type': transaction_type,
+                    'date': now,
+                    'user_id': user_id,
+                    'location_id': location_id,
+                    'transfer_id': transfer_id
+                }
+                for transaction_type, location_id in (('out', from_location_id), ('in', to_location_id))
+            ])
+            db.session.commit()
+            break
+        except IntegrityError:
+            # Another worker opened the destination stock level first
+            db.session.rollback()
+            if attempt == retries - 1:
+                raise StockError('Stock changed concurrently, please retry', 409)
+        except OperationalError as e:
+            db.session.rollback()
+            if not is_lock_error(e) or attempt == retries - 1:
+                raise
+            time.sleep(0.01 * 2 ** attempt)
+
+    # Only location figures changed: no movements or total changes
+    send_committed(stock_changed, movements=[], changes=[])
+    return {
+        'transfer_id': transfer_id,
+        'product_id': product_id,
+        'quantity': quantity,
+        'from': dict(location_to_dict(from_location_id), quantity=from_quantity, lots=taken),
+        'to': dict(location_to_dict(to_location_id), quantity=to_quantity, lots=list(received.values()))
+    }
+
+def low_stock_levels(location_id=None, cursor=None, limit=100):
+    """Return one page of stock levels at or below their reorder level, and the next cursor.
+
+    Covers every location, or one, in (location, product) order. Pages are
+    range scans of the partial ix_stock_level_low index that seek past the
+    cursor, so the cost of a page does not depend on the number of
+    locations or products.
+    """
+    c = StockLevel.__table__.c
+    page = db.select(c.location_id, c.product_id, c.quantity, c.reorder_level).where(c.quantity <= c.reorder_level)
+    if location_id is not None:
+        page = page.where(c.location_id == location_id)
+    if cursor:
+        key, last_id = decode_cursor('low_stock', cursor)
+        try:
+            location = int(key)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor')
+        page = page.where(db.tuple_(c.location_id, c.product_id) > db.tuple_(location, last_id))
+    page = page.order_by(c.location_id, c.product_id).limit(limit + 1).subquery()
+    rows = db.session.execute(db.select(
+        page.c.location_id, page.c.product_id, Product.name, Product.category, page.c.quantity, page.c.reorder_level
+    ).join(Product, Product.id == page.c.product_id).order_by(page.c.location_id, page.c.product_id)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor('low_stock', rows[-1].location_id, rows[-1].product_id)
+    return rows, next_cursor
+
+def follow_product_reorder_levels(rows):
+    """Carry new product reorder levels over to the stock levels still using the old one.
+
+    ``rows`` are {'id', 'reorder_level'} dicts. Must run before the product
+    rows are updated; a reorder level set for one location is kept.
+    """
+    if not rows:
+        return
+    table = StockLevel.__table__
+    db.session.execute(db.update(table).where(
+        table.c.product_id == db.bindparam('b_id'),
+        table.c.reorder_level == db.select(Product.reorder_level).where(
+            Product.id == db.bindparam('b_id')
+        ).scalar_subquery()
+    ).values(reorder_level=db.bindparam('b_reorder_level')), [
+        {'b_id': row['id'], 'b_reorder_level': row['reorder_level']} for row in rows
+    ])
+
+# Transaction archive
+#
+# Transactions older than TRANSACTION_ARCHIVE_DAYS are moved out of the live
+# table a calendar month at a time, into one table per month clustered on
+# (date, id) and registered in TransactionArchive. The daily rollup is left
+# alone, so the dashboard and forecasts still cover the whole history. Every
+# archived month is older than every live row, so reading the live table and
+# then the archive months newest first gives one date-ordered sequence.
+archive_metadata = db.MetaData()
+_archive_tables_lock = threading.Lock()
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+def next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def archive_table(month):
+    """Return the Table holding the archived transactions of ``month``."""
+    name = f'transaction_archive_{month:%Y%m}'
+    with _archive_tables_lock:
+        table = archive_metadata.tables.get(name)
+        if table is None:
+            table = db.Table(
+                name, archive_metadata,
+                db.Column('date', db.DateTime, primary_key=True),
+                db.Column('id', db.Integer, primary_key=True),
+                db.Column('product_id', db.Integer, nullable=False),
+                db.Column('quantity', db.Integer, nullable=False),
+                db.Column('transaction_type', db.String(20), nullable=False),
+                db.Column('user_id', db.Integer, nullable=False),
+                db.Column('location_id', db.Integer, nullable=False,
+                          server_default=db.text(str(DEFAULT_LOCATION_ID))),
+                db.Column('transfer_id', db.String(32)),
+                db.Index(f'ix_{name}_product_date', 'product_id', 'date'),
+                info={'month': month.date()},
+                sqlite_with_rowid=False
+            )
+        return table
+
+def archived_months(conn, start=None, end=None):
+    """Archived months overlapping [start, end), newest first."""
+    months = conn.execute(
+        db.select(TransactionArchive.month).order_by(TransactionArchive.month.desc())
+    ).scalars()
+    return [
+        month for month in map(month_start, months)
+        if (end is None or month < end) and (start is None or next_month(month) > start)
+    ]
+
+def transaction_sources(conn, start=None, end=None):
+    """Yield the tables holding transactions dated in [start, end), newest first.
+
+    The live table comes first; the archive registry is only read if the
+    caller asks for more, so queries answered from live rows cost nothing
+    extra.
+    """
+    yield Transaction.__table__
+    for month in archived_months(conn, start, end):
+        yield archive_table(month)
+
+def all_transaction_tables(conn):
+    tables = [Transaction.__table__]
+    # Also called from migrations that run before the registry existed
+    if db.inspect(conn).has_table(TransactionArchive.__tablename__):
+        tables.extend(archive_table(month) for month in archived_months(conn))
+    return tables
+
+def delete_transactions(conn, column, value):
+    """Delete the live and archived transactions where ``column`` equals ``value``. Returns the row count."""
+    deleted = 0
+    for table in all_transaction_tables(conn):
+        count = conn.execute(db.delete(table).where(table.c[column] == value)).rowcount
+        if count and 'month' in table.info:
+            conn.execute(db.update(TransactionArchive).where(TransactionArchive.month == table.info['month']).values(
+                row_count=TransactionArchive.row_count - count
+            ))
+        deleted += count
+    return deleted
+
+def archive_transactions(before):
+    """Move transactions dated before the month of ``before`` into the monthly archive tables.
+
+    Each month is moved in its own database transaction. Returns
+    {month: rows moved}.
+    """
+    cutoff = month_start(before)
+    live = Transaction.__table__
+    columns = ['date', 'id', 'product_id', 'quantity', 'transaction_type', 'user_id', 'location_id', 'transfer_id']
+    moved = {}
+    while True:
+        with db.engine.begin() as conn:
+            oldest = conn.execute(db.select(db.func.min(live.c.date)).where(live.c.date < cutoff)).scalar()
+            if oldest is None:
+                return moved
+            month = month_start(oldest)
+            in_month = (live.c.date >= month, live.c.date < next_month(month))
+            table = archive_table(month)
+            table.create(conn, checkfirst=True)
+            conn.execute(table.insert().from_select(
+                columns, db.select(*(live.c[name] for name in columns)).where(*in_month)
+            ))
+            count = conn.execute(db.delete(live).where(*in_month)).rowcount
+            registered = conn.execute(db.update(TransactionArchive).where(
+                TransactionArchive.month == month.date()
+            ).values(row_count=TransactionArchive.row_count + count, archived_at=datetime.utcnow())).rowcount
+            if not registered:
+                conn.execute(db.insert(TransactionArchive).values(month=month.date(), row_count=count))
+        moved[month.date()] = count
+
+@app.cli.command('archive-transactions')
+@click.option('--days', type=int, help='Archive months entirely older than this many days '
+                                        '(default TRANSACTION_ARCHIVE_DAYS)')
+@click.option('--before', help='Archive months before the month of this date (YYYY-MM-DD)')
+def archive_transactions_command(days, before):
+    """Move old transactions out of the live table into monthly archive tables."""
+    if before:
+        before = datetime.strptime(before, '%Y-%m-%d')
+    else:
+        before = datetime.utcnow() - timedelta(days=days or app.config['TRANSACTION_ARCHIVE_DAYS'])
+    moved = archive_transactions(before)
+    for month, count in sorted(moved.items()):
+        print(f'{month:%Y-%m}: {count} transactions archived')
+    if not moved:
+        print(f'No transactions before {month_start(before):%Y-%m-%d} to archive')
+
+# Restock forecasting
+#
+# NumPy is imported inside the functions that use it, here and in the
+# inventory analytics, so processes that never build a forecast or a report
+# do not pay for loading it at startup.
+REORDER_SORTS = ('days_until_reorder', 'suggested_order', 'smoothed_daily', 'average_30d', 'name')
+
+def build_restock_forecast(window=None, alpha=None, cover_days=None):
+    """Forecast consumption and reorder points for the whole catalogue at once.
+
+    Daily stock-out totals for the last ``window`` days are read from the
+    daily rollup in one query into a products x days matrix, and moving
+    averages, simple exponential smoothing and days until the reorder level
+    are computed as array operations over every product. Returns a dict of
+    equally long NumPy arrays, one entry per product, ordered by product id.
+    """
+    import numpy as np
+
+    window = window or app.config['RESTOCK_WINDOW_DAYS']
+    alpha = alpha or app.config['RESTOCK_SMOOTHING']
+    cover_days = cover_days or app.config['RESTOCK_COVER_DAYS']
+
+    today = datetime.utcnow().date()
+    start = today - timedelta(days=window - 1)
+    day_index = {}
+    for i in range(window):
+        day = start + timedelta(days=i)
+        # SQLite hands the day back as text, other backends as a date
+        day_index[day] = day_index[day.isoformat()] = i
+
+    products = db.session.query(
+        Product.id, Product.name, Product.category, Product.quantity, Product.reorder_level
+    ).order_by(Product.id).all()
+    ids = np.fromiter((p[0] for p in products), dtype=np.int64, count=len(products))
+    quantity = np.fromiter((p[3] or 0 for p in products), dtype=np.float64, count=len(products))
+    reorder_level = np.fromiter((p[4] or 0 for p in products), dtype=np.float64, count=len(products))
+
+    demand = np.zeros((len(products), window), dtype=np.float64)
+    rows = db.session.execute(
+        db.select(
+            DailyProductMovement.product_id,
+            db.type_coerce(DailyProductMovement.day, db.String),
+            DailyProductMovement.qty_out
+        ).where(
+            DailyProductMovement.day >= start,
+            DailyProductMovement.day <= today,
+            DailyProductMovement.qty_out > 0
+        )
+    ).all()
+    if rows and len(ids):
+        row_ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        cols = np.fromiter((day_index[r[1]] for r in rows), dtype=np.int64, count=len(rows))
+        qty = np.fromiter((r[2] for r in rows), dtype=np.float64, count=len(rows))
+        positions = np.minimum(np.searchsorted(ids, row_ids), len(ids) - 1)
+        known = ids[positions] == row_ids  # skip rollups of deleted products
+        demand[positions[known], cols[known]] = qty[known]
+
+    average_7d = demand[:, -7:].mean(axis=1)
+    average_30d = demand[:, -30:].mean(axis=1)
+
+    # Simple exponential smoothing seeded with the first day, in closed form:
+    # level = (1 - a)^(n-1) * x0 + sum_k a * (1 - a)^(n-1-k) * x_k for k >= 1
+    exponents = np.arange(window - 1, -1, -1)
+    weights = alpha * (1 - alpha) ** exponents
+    weights[0] = (1 - alpha) ** (window - 1)
+    smoothed = demand @ weights
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_until_reorder = np.where(smoothed > 0, (quantity - reorder_level) / smoothed, np.inf)
+    days_until_reorder = np.maximum(days_until_reorder, 0)
+    suggested_order = np.ceil(smoothed * cover_days + np.maximum(reorder_level - quantity, 0))
+
+    return {
+        'id': ids,
+        'name': np.array([p[1] for p in products], dtype=object),
+        'category': np.array([p[2] for p in products], dtype=object),
+        'quantity': quantity,
+        'reorder_level': reorder_level,
+        'average_7d': average_7d,
+        'average_30d': average_30d,
+        'smoothed_daily': smoothed,
+        'days_until_reorder': days_until_reorder,
+        'suggested_order': suggested_order,
+        'generated_at': datetime.utcnow()
+    }
+
+_restock_forecast = {'expires': 0, 'forecast': None}
+_restock_forecast_lock = threading.Lock()
+
+def store_restock_forecast(forecast):
+    with _restock_forecast_lock:
+        _restock_forecast['forecast'] = forecast
+        _restock_forecast['expires'] = time.monotonic() + app.config['RESTOCK_REPORT_TTL']
+
+def get_restock_forecast():
+    # Built under the lock, so concurrent requests after expiry wait for one
+    # build instead of each running their own
+    with _restock_forecast_lock:
+        if _restock_forecast['forecast'] is None or time.monotonic() >= _restock_forecast['expires']:
+            _restock_forecast['forecast'] = build_restock_forecast()
+            _restock_forecast['expires'] = time.monotonic() + app.config['RESTOCK_REPORT_TTL']
+        return _restock_forecast['forecast']
+
+def reorder_report(forecast, sort='days_until_reorder', within=None, category=None):
+    """Return the row indexes of a forecast that need reordering, in report order.
+
+    Products are included when they are already at or below their reorder
+    level or are forecast to reach it within ``within`` days (by default
+    RESTOCK_COVER_DAYS).
+    """
+    import numpy as np
+
+    if within is None:
+        within = app.config['RESTOCK_COVER_DAYS']
+    due = (forecast['quantity'] <= forecast['reorder_level']) | (forecast['days_until_reorder'] <= within)
+    if category:
+        due &= forecast['category'] == category
+    rows = np.flatnonzero(due)
+
+    if sort == 'name':
+        order = sorted(rows, key=lambda i: (forecast['name'][i], forecast['id'][i]))
+        return np.array(order, dtype=np.int64)
+    if sort in ('suggested_order', 'smoothed_daily', 'average_30d'):
+        return rows[np.lexsort((forecast['id'][rows], -forecast[sort][rows]))]
+    return rows[np.lexsort((forecast['id'][rows], forecast['days_until_reorder'][rows]))]
+
+def reorder_row(forecast, i):
+    import numpy as np
+
+    days = forecast['days_until_reorder'][i]
+    return {
+        'product_id': int(forecast['id'][i]),
+        'name': forecast['name'][i],
+        'category': forecast['category'][i],
+        'quantity': int(forecast['quantity'][i]),
+        'reorder_level': int(forecast['reorder_level'][i]),
+        'average_7d': round(float(forecast['average_7d'][i]), 2),
+        'average_30d': round(float(forecast['average_30d'][i]), 2),
+        'smoothed_daily': round(float(forecast['smoothed_daily'][i]), 2),
+        'days_until_reorder': round(float(days)) if np.isfinite(days) else None,
+        'suggested_order': int(forecast['suggested_order'][i])
+    }
+
+def write_reorder_csv(forecast, rows, output):
+    writer = csv.writer(output)
+    fields = ['product_id', 'name', 'category', 'quantity', 'reorder_level', 'average_7d',
+              'average_30d', 'smoothed_daily', 'days_until_reorder', 'suggested_order']
+    writer.writerow(fields)
+    for i in rows:
+        row = reorder_row(forecast, i)
+        writer.writerow([row[f] for f in fields])
+
+@app.cli.command('reorder-report')
+@click.option('--output', type=click.File('w'), default='-', help='CSV file to write (default: stdout)')
+@click.option('--within', type=int, default=None, help='Include products reaching their reorder level within N days')
+@click.option('--sort', type=click.Choice(REORDER_SORTS), default='days_until_reorder')
+def reorder_report_command(output, within, sort):
+    """Write reorder suggestions for the whole catalogue as CSV."""
+    start = time.perf_counter()
+    forecast = build_restock_forecast()
+    rows = reorder_report(forecast, sort, within)
+    write_reorder_csv(forecast, rows, output)
+    click.echo(f'{len(rows)} of {len(forecast["id"])} products need reordering '
+               f'({time.perf_counter() - start:.2f}s)', err=True)
+
+# Barcode enrichment
+class BarcodeLookupError(Exception):
+    pass
+
+class BarcodeInfoClient:
+    """HTTP client for the external barcode database.
+
+    Uses one pooled requests.Session with strict timeouts, and coalesces
+    concurrent lookups of the same barcode into a single upstream request.
+    requests is imported here rather than at startup, since most processes
+    never look up a barcode.
+    """
+
+    def __init__(self, url, timeout, pool_size):
+        import requests
+
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, barcode):
+        """Return the product dict for a barcode, or None if upstream has no match."""
+        with self._lock:
+            future = self._inflight.get(barcode)
+            leader = future is None
+            if leader:
+                future = self._inflight[barcode] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = self._fetch(barcode)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[barcode]
+
+    def _fetch(self, barcode):
+        import requests
+
+        try:
+            response = self.session.get(self.url.format(barcode=barcode), timeout=self.timeout)
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise BarcodeLookupError(f'Barcode lookup failed: {e}')
+
+        if data.get('status') == 1 and data.get('product'):
+            product_data = data['product']
+            return {
+                'name': product_data.get('product_name', ''),
+                'category': product_data.get('categories', ''),
+                'description': product_data.get('generic_name', ''),
+                'brand': product_data.get('brands', ''),
+                'image_url': product_data.get('image_url', '')
+            }
+        return None
+
+_barcode_info_client = None
+_barcode_info_lock = threading.Lock()
+
+def get_barcode_info_client():
+    global _barcode_info_client
+    with _barcode_info_lock:
+        if _barcode_info_client is None:
+            _barcode_info_client = BarcodeInfoClient(
+                app.config['BARCODE_INFO_URL'],
+                app.config['BARCODE_INFO_TIMEOUT'],
+                app.config['BARCODE_INFO_WORKERS']
+            )
+        return _barcode_info_client
+
+def cached_barcode_info(lookup, now):
+    ttl = app.config['BARCODE_INFO_HIT_TTL'] if lookup.found else app.config['BARCODE_INFO_MISS_TTL']
+    return lookup.fetched_at + ttl > now
+
+def lookup_barcode_info(barcode, refresh=False):
+    """Return (found, product) for a barcode from the cache or the external database.
+
+    Hits and misses are cached in the barcode_lookup table; upstream errors
+    raise BarcodeLookupError and are not cached.
+    """
+    now = datetime.utcnow()
+    lookup = None if refresh else db.session.get(BarcodeLookup, barcode)
+    if lookup and cached_barcode_info(lookup, now):
+        # Only touch the LRU clock once an hour per barcode to keep hits read-only
+        if now - lookup.last_used_at > timedelta(hours=1):
+            lookup.last_used_at = now
+            db.session.commit()
+        return lookup.found, json.loads(lookup.payload) if lookup.payload else None
+
+    product = get_barcode_info_client().fetch(barcode)
+    store_barcode_info(barcode, product, now)
+    return product is not None, product
+
+_barcode_info_writes = [0]
+
+def store_barcode_info(barcode, product, now):
+    lookup = db.session.get(BarcodeLookup, barcode)
+    if lookup is None:
+        lookup = BarcodeLookup(barcode=barcode)
+        db.session.add(lookup)
+    lookup.found = product is not None
+    lookup.payload = json.dumps(product) if product is not None else None
+    lookup.fetched_at = lookup.last_used_at = now
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker cached the same barcode first
+        db.session.rollback()
+        return
+    with _barcode_info_lock:
+        _barcode_info_writes[0] += 1
+        evict = _barcode_info_writes[0] % 500 == 0
+    if evict:
+        evict_barcode_info()
+
+def evict_barcode_info():
+    """Trim the lookup cache to BARCODE_INFO_CACHE_SIZE, dropping least recently used entries."""
+    limit = app.config['BARCODE_INFO_CACHE_SIZE']
+    total = db.session.query(db.func.count(BarcodeLookup.barcode)).scalar()
+    if total <= limit:
+        return 0
+    cutoff = db.session.query(BarcodeLookup.last_used_at).order_by(
+        BarcodeLookup.last_used_at.desc()
+    ).offset(limit).limit(1).scalar()
+    deleted = BarcodeLookup.query.filter(BarcodeLookup.last_used_at <= cutoff).delete()
+    db.session.commit()
+    return deleted
+
+def prewarm_barcode_info(barcodes, workers=None):
+    """Fetch uncached barcodes with a bounded thread pool. Returns (hits, misses, errors)."""
+    workers = workers or app.config['BARCODE_INFO_WORKERS']
+    now = datetime.utcnow()
+    barcodes = list(dict.fromkeys(b for b in barcodes if b))
+    fresh = set()
+    for chunk in chunked(barcodes):
+        for lookup in BarcodeLookup.query.filter(BarcodeLookup.barcode.in_(chunk)):
+            if cached_barcode_info(lookup, now):
+                fresh.add(lookup.barcode)
+    pending = [b for b in barcodes if b not in fresh]
+
+    def fetch(barcode):
+        with app.app_context():
+            try:
+                found, _ = lookup_barcode_info(barcode, refresh=True)
+                return 'hit' if found else 'miss'
+            except BarcodeLookupError:
+                return 'error'
+
+    counts = {'hit': 0, 'miss': 0, 'error': 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for outcome in pool.map(fetch, pending):
+            counts[outcome] += 1
+    evict_barcode_info()
+    return counts['hit'], counts['miss'], counts['error']
+
+@app.cli.command('prewarm-barcodes')
+@click.argument('barcodes_file', type=click.File('r'))
+@click.option('--workers', type=int, default=None, help='Concurrent upstream requests')
+def prewarm_barcodes_command(barcodes_file, workers):
+    """Cache external product info for the barcodes listed in a file (one per line)."""
+    barcodes = [line.strip() for line in barcodes_file]
+    start = time.perf_counter()
+    hits, misses, errors = prewarm_barcode_info(barcodes, workers)
+    print(f'Fetched {hits + misses + errors} barcodes in {time.perf_counter() - start:.1f}s: '
+          f'{hits} found, {misses} not found, {errors} errors')
+
+# Product validation and bulk import
+class ProductDataError(Exception):
+    pass
+
+def parse_product_data(data):
+    """Validate a new product's fields and return them as Product keyword arguments."""
+    if not isinstance(data, dict):
+        raise ProductDataError('Invalid request data')
+
+    # Validate required fields
+    required_fields = ['name', 'category', 'unit_price', 'quantity', 'reorder_level']
+    for field in required_fields:
+        if field not in data or data[field] is None or not str(data[field]).strip():
+            raise ProductDataError(f'{field.title()} is required')
+
+    # Validate numeric fields
+    try:
+        unit_price = float(data['unit_price'])
+        quantity = int(data['quantity'])
+        reorder_level = int(data['reorder_level'])
+    except (ValueError, TypeError):
+        raise ProductDataError('Invalid numeric values provided')
+    if unit_price <= 0:
+        raise ProductDataError('Unit price must be greater than 0')
+    if quantity < 0:
+        raise ProductDataError('Quantity cannot be negative')
+    if reorder_level < 0:
+        raise ProductDataError('Reorder level cannot be negative')
+
+    # Validate expiry date
+    expiry_date = None
+    if data.get('expiry_date'):
+        try:
+            expiry_date = datetime.strptime(str(data['expiry_date']).strip(), '%Y-%m-%d').date()
+        except ValueError:
+            raise ProductDataError('Invalid expiry date format. Use YYYY-MM-DD')
+        if expiry_date < datetime.now().date():
+            raise ProductDataError('Expiry date cannot be in the past')
+
+    barcode = str(data['barcode']).strip() if data.get('barcode') else None
+    return {
+        'name': str(data['name']).strip(),
+        'category': str(data['category']).strip(),
+        'description': data.get('description') or '',
+        'unit_price': unit_price,
+        'quantity': quantity,
+        'reorder_level': reorder_level,
+        'barcode': barcode or None,
+        'expiry_date': expiry_date
+    }
+
+def iter_json_records(stream, chunk_size=65536):
+    """Yield objects from a JSON array or JSON Lines text stream without loading it whole."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+    while True:
+        # Skip array brackets, separators and whitespace between records
+        buffer = buffer.lstrip(' \t\r\n,[]')
+        if not buffer:
+            if eof:
+                return
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise ProductDataError('Malformed JSON input')
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        buffer = buffer[end:]
+        yield record
+
+def iter_import_records(stream, fmt):
+    if fmt == 'csv':
+        return csv.DictReader(stream)
+    if fmt == 'json':
+        return iter_json_records(stream)
+    raise ProductDataError('Unsupported format. Use "csv" or "json"')
+
+def import_products(records, upsert=False, dry_run=False, batch_size=None, summary=None, max_errors=None):
+    """Validate and insert (or upsert by barcode) products from an iterable of dicts.
+
+    Existing barcodes are preloaded in one query and checked in memory; valid
+    rows are written in executemany batches of ``batch_size``. Quantity and
+    expiry date are only set for new products, as their opening lot, since
+    stock changes on existing ones must go through stock movements. With ``dry_run`` nothing is written. Returns a summary
+    with a row-level error report (rows are numbered from 1) of the first ``max_errors``
+    (IMPORT_MAX_REPORTED_ERRORS) failed rows; every failure is counted, and
+    ``errors_truncated`` says whether the report stops short.
+
+    Each batch is committed on its own. Pass a ``summary`` dict to have the
+    counts kept in it as the import runs, so a caller still knows what was
+    committed if the import stops partway.
+    """
+    batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+    max_errors = app.config['IMPORT_MAX_REPORTED_ERRORS'] if max_errors is None else max_errors
+    start = time.perf_counter()
+    existing = dict(db.session.query(Product.barcode, Product.id).filter(Product.barcode.isnot(None)))
+    seen = set()
+    inserts, updates, errors = [], [], []
+    summary = summary if summary is not None else {}
+    summary.update({'rows': 0, 'inserted': 0, 'updated': 0, 'failed': 0})
+
+    def flush():
+        now = datetime.utcnow()
+        if not dry_run:
+            if inserts:
+                ids = db.session.execute(
+                    db.insert(Product).returning(Product.id, sort_by_parameter_order=True), inserts
+                ).scalars().all()
+                lots = [
+                    {'product_id': pid, 'quantity': fields['quantity'], 'expiry_date': fields['expiry_date'], 'received_at': now}
+                    for pid, fields in zip(ids, inserts) if fields['quantity'] > 0
+                ]
+                if lots:
+                    db.session.execute(db.insert(ProductLot), lots)
+                db.session.execute(db.insert(StockLevel), [
+                    {
+                        'location_id': DEFAULT_LOCATION_ID,
+                        'product_id': pid,
+                        'quantity': fields['quantity'],
+                        'reorder_level': fields['reorder_level']
+                    }
+                    for pid, fields in zip(ids, inserts)
+                ])
+            if updates:
+                follow_product_reorder_levels(updates)
+                db.session.execute(db.update(Product), updates)
+            db.session.commit()
+        summary['inserted'] += len(inserts)
+        summary['updated'] += len(updates)
+        inserts.clear()
+        updates.clear()
+
+    try:
+        for row_number, record in enumerate(records, start=1):
+            summary['rows'] += 1
+            try:
+                fields = parse_product_data(record)
+                barcode = fields['barcode']
+                if barcode in seen:
+                    raise ProductDataError('Duplicate barcode in import file')
+                if barcode:
+                    seen.add(barcode)
+                if barcode in existing:
+                    if not upsert:
+                        raise ProductDataError('Product with this barcode already exists')
+                    del fields['quantity'], fields['expiry_date']
+                    fields['id'] = existing[barcode]
+                    updates.append(fields)
+                else:
+                    inserts.append(fields)
+            except ProductDataError as e:
+                summary['failed'] += 1
+                if len(errors) < max_errors:
+                    errors.append({'row': row_number, 'barcode': (record or {}).get('barcode') if isinstance(record, dict) else None, 'error': str(e)})
+                continue
+            if len(inserts) + len(updates) >= batch_size:
+                flush()
+        flush()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        if summary['inserted'] or summary['updated']:
+            products_changed.send(app, product_ids=None)
+
+    elapsed = time.perf_counter() - start
+    summary.update({
+        'dry_run': dry_run,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(summary['rows'] / elapsed) if elapsed else None,
+        'errors': errors,
+        'errors_truncated': summary['failed'] > len(errors)
+    })
+    return summary
+
+@app.cli.command('import-products')
+@click.argument('source', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json']), default=None,
+              help='Input format (default: from the file extension)')
+@click.option('--upsert', is_flag=True, help='Update products whose barcode already exists')
+@click.option('--dry-run', is_flag=True, help='Validate only, write nothing')
+@click.option('--errors', 'errors_file', type=click.File('w'), default=None, help='Write the row-level error report as CSV')
+def import_products_command(source, fmt, upsert, dry_run, errors_file):
+    """Import products from a CSV or JSON (array or JSON Lines) file."""
+    fmt = fmt or ('json' if source.name.lower().endswith(('.json', '.jsonl', '.ndjson')) else 'csv')
+    summary = import_products(iter_import_records(source, fmt), upsert=upsert, dry_run=dry_run)
+    if errors_file:
+        writer = csv.writer(errors_file)
+        writer.writerow(['row', 'barcode', 'error'])
+        for error in summary['errors']:
+            writer.writerow([error['row'], error['barcode'], error['error']])
+    print(f"{'Validated' if dry_run else 'Imported'} {summary['rows']} rows in {summary['seconds']}s "
+          f"({summary['rows_per_second']} rows/sec): {summary['inserted']} inserted, "
+          f"{summary['updated']} updated, {summary['failed']} failed")
+    if errors_file and summary['errors_truncated']:
+        print(f"The error report lists the first {len(summary['errors'])} failed rows")
+
+# Dashboard metrics cache
+class MetricsCache:
+    """Process-local cache for dashboard aggregates.
+
+    Entries expire after ``ttl`` seconds as a fallback for writes made by other
+    processes; writes in this process invalidate or adjust them directly
+    through the products_changed and stock_changed signals.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+        return value
+
+    def update(self, key, fn):
+        # Replace a cached value with fn(value), keeping its expiry; fn returns
+        # None to drop the entry. Values are never mutated in place, since
+        # readers hold on to them outside the lock.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                value = fn(entry[1])
+                if value is None:
+                    del self._entries[key]
+                else:
+                    self._entries[key] = (entry[0], value)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys or list(self._entries):
+                self._entries.pop(key, None)
+        self.invalidate_scoped(*keys)
+
+    def invalidate_scoped(self, *keys):
+        # Drop the entries scoped under the keys, stored as (key, scope)
+        with self._lock:
+            for key in list(self._entries):
+                if isinstance(key, tuple) and (not keys or key[0] in keys):
+                    del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'ttl': self.ttl}
+
+metrics_cache = MetricsCache(app.config['METRICS_CACHE_TTL'])
+
+def compute_product_metrics(location_id=None):
+    # For a location, the products are those with a stock level there, with
+    # the location's quantities and reorder levels and lots
+    today = datetime.now().date()
+    if location_id is None:
+        quantity, reorder_level, scope, lot_scope = Product.quantity, Product.reorder_level, (), ()
+    else:
+        quantity, reorder_level = StockLevel.quantity, StockLevel.reorder_level
+        scope = (StockLevel.product_id == Product.id, StockLevel.location_id == location_id)
+        lot_scope = (ProductLot.location_id == location_id,)
+    low_stock_products = db.session.query(
+        Product.id, Product.name, quantity.label('quantity'), reorder_level.label('reorder_level')
+    ).filter(*scope, quantity <= reorder_level).order_by(Product.name).all()
+    categories = db.session.query(
+        Product.category, db.func.count(Product.id)
+    ).filter(*scope).group_by(Product.category).all()
+    return {
+        'day': today,
+        'total_products': db.session.query(db.func.count(Product.id)).filter(*scope).scalar(),
+        'low_stock_products': [dict(p._mapping) for p in low_stock_products],
+        'expiring_soon_count': db.session.query(db.func.count(db.distinct(ProductLot.product_id))).filter(
+            LOT_IN_STOCK,
+            *lot_scope,
+            ProductLot.expiry_date <= today + timedelta(days=30),
+            ProductLot.expiry_date > today
+        ).scalar(),
+        'category_labels': [c[0] for c in categories],
+        'category_data': [c[1] for c in categories]
+    }
+
+def compute_transaction_metrics(location_id=None):
+    # Transaction counts come from the daily rollup, whose days are UTC like
+    # Transaction.date
+    utc_today = datetime.utcnow().date()
+    if location_id is None:
+        rollup, scope = DailyProductMovement, ()
+    else:
+        rollup, scope = DailyLocationMovement, (DailyLocationMovement.location_id == location_id,)
+    history = db.session.query(
+        rollup.day,
+        db.func.sum(rollup.tx_count)
+    ).filter(
+        *scope,
+        rollup.day >= utc_today - timedelta(days=30)
+    ).group_by(
+        rollup.day
+    ).all()
+    return {
+        'day': utc_today,
+        'history': {day: int(count) for day, count in history}
+    }
+
+def get_dashboard_metrics(location_id=None):
+    # Metrics for one location are cached under (key, location_id) and
+    # dropped, rather than adjusted, on writes
+    products_key = 'products' if location_id is None else ('products', location_id)
+    transactions_key = 'transactions' if location_id is None else ('transactions', location_id)
+    products = metrics_cache.get(products_key, lambda: compute_product_metrics(location_id))
+    if products['day'] != datetime.now().date():
+        metrics_cache.invalidate(products_key)
+        products = metrics_cache.get(products_key, lambda: compute_product_metrics(location_id))
+    transactions = metrics_cache.get(transactions_key, lambda: compute_transaction_metrics(location_id))
+    if transactions['day'] != datetime.utcnow().date():
+        metrics_cache.invalidate(transactions_key)
+        transactions = metrics_cache.get(transactions_key, lambda: compute_transaction_metrics(location_id))
+
+    history = sorted(transactions['history'].items())
+    return {
+        'total_products': products['total_products'],
+        'low_stock_count': len(products['low_stock_products']),
+        'expiring_soon_count': products['expiring_soon_count'],
+        'todays_transactions': transactions['history'].get(transactions['day'], 0),
+        'low_stock_products': products['low_stock_products'],
+        'category_labels': products['category_labels'],
+        'category_data': products['category_data'],
+        'transaction_dates': [day.strftime('%Y-%m-%d') for day, _ in history],
+        'transaction_counts': [count for _, count in history]
+    }
+
+@products_changed.connect
+def invalidate_product_metrics(sender, **kwargs):
+    metrics_cache.invalidate('products')
+
+@stock_changed.connect
+def adjust_dashboard_metrics(sender, movements=None, changes=(), **kwargs):
+    if movements is None:
+        metrics_cache.invalidate('products', 'transactions')
+        return
+    metrics_cache.invalidate_scoped('products', 'transactions')
+
+    def add_movements(metrics):
+        history = dict(metrics['history'])
+        for _, _, _, date in movements:
+            day = date.date()
+            if day >= metrics['day'] - timedelta(days=30):
+                history[day] = history.get(day, 0) + 1
+        return dict(metrics, history=history)
+    metrics_cache.update('transactions', add_movements)
+
+    def adjust_low_stock(metrics):
+        quantities = {}
+        for change in changes:
+            reorder_level = change['reorder_level'] or 0
+            was_low = change['old_quantity'] <= reorder_level
+            is_low = change['new_quantity'] <= reorder_level
+            if was_low != is_low:
+                # The low-stock list gains or loses a product: recompute it
+                return None
+            if is_low:
+                quantities[change['product_id']] = change['new_quantity']
+        if not quantities:
+            return metrics
+        low_stock = [
+            dict(p, quantity=quantities[p['id']]) if p['id'] in quantities else p
+            for p in metrics['low_stock_products']
+        ]
+        return dict(metrics, low_stock_products=low_stock)
+    metrics_cache.update('products', adjust_low_stock)
+
+# Inventory analytics
+#
+# Valuation, expiry risk, stock aging and turnover reports. A snapshot holds
+# per-product figures in NumPy arrays, each filled by one set-based GROUP BY
+# query: stock and prices from product, in-stock lot quantities per expiry
+# bucket and per age bucket from product_lot, and window totals from the
+# daily rollup. Reports then sum the arrays by category or sort them, which
+# takes milliseconds over the whole catalogue.
+#
+# Writes in this process mark products dirty through the signals, and the
+# next read re-runs the same queries for just those products. Only the first
+# read waits for a full build. When the day changes, after
+# ANALYTICS_CACHE_TTL seconds (for writes made by other processes) or after
+# a change too broad to refresh product by product, the snapshot is rebuilt
+# in a background thread while reads keep using the current one.
+EXPIRY_RISK_BUCKETS = ((0, 'expired'), (30, '0-30 days'), (60, '31-60 days'), (90, '61-90 days'),
+                       (180, '91-180 days'))
+STOCK_AGE_BUCKETS = ((30, '0-30 days'), (90, '31-90 days'), (180, '91-180 days'), (365, '181-365 days'),
+                     (None, 'over 365 days'))
+TURNOVER_SORTS = ('days_of_cover', 'turnover', 'value', 'daily_out', 'name')
+PRODUCT_ARRAYS = ('name', 'category_code', 'quantity', 'unit_price', 'present', 'expiring', 'aging', 'qty_out', 'qty_in')
+
+def bucketed_lot_quantities(conditions, *criteria):
+    """SELECT product_id, then SUM(quantity) of the in-stock lots matching each condition, per product.
+
+    One row per product, grouped on product_id alone, so SQLite aggregates
+    in the order of the FEFO index instead of sorting.
+    """
+    lot = ProductLot.__table__.c
+    return db.select(lot.product_id, *(
+        db.func.sum(db.case((condition, lot.quantity), else_=0)) for condition in conditions
+    )).where(lot.quantity > db.literal_column('0'), *criteria).group_by(lot.product_id)
+
+def bucket_conditions(column, edges):
+    """Conditions for column <= edges[0], edges[0] < column <= edges[1], ...; a None edge is open-ended."""
+    conditions, previous = [], None
+    for edge in edges:
+        bounds = [column > previous] if previous is not None else []
+        if edge is not None:
+            bounds.append(column <= edge)
+        conditions.append(db.and_(*bounds) if len(bounds) > 1 else bounds[0])
+        previous = edge
+    return conditions
+
+def build_inventory_snapshot(turnover_days, product_ids=None, categories=None):
+    """Per-product analytics figures for every product, or only ``product_ids``.
+
+    Returns a dict of equally long arrays ordered by product id, plus the
+    category names that ``category_code`` indexes (``categories`` is
+    extended in place when given), and the day, window and build time the
+    figures are for. Runs on Core tables over one connection, since the
+    rows never become ORM objects.
+    """
+    import numpy as np
+
+    today = datetime.now().date()
+    utc_today = datetime.utcnow().date()
+    now = datetime.utcnow()
+    product, lot, movement = Product.__table__.c, ProductLot.__table__.c, DailyProductMovement.__table__.c
+
+    def only(column):
+        return (column.in_(product_ids),) if product_ids is not None else ()
+
+    expiry_buckets = bucket_conditions(
+        lot.expiry_date, [today + timedelta(days=days) for days, _ in EXPIRY_RISK_BUCKETS]
+    )
+    # Receipt date ranges oldest first, then reversed into STOCK_AGE_BUCKETS
+    # order; lots with no receipt date count as oldest
+    age_buckets = bucket_conditions(lot.received_at, [
+        now - timedelta(days=days) for days, _ in reversed(STOCK_AGE_BUCKETS) if days is not None
+    ] + [None])
+    age_buckets[0] = db.or_(age_buckets[0], lot.received_at.is_(None))
+    age_buckets.reverse()
+
+    with db.engine.connect() as conn:
+        products = conn.execute(db.select(
+            product.id, product.name, product.category, product.quantity, product.unit_price
+        ).where(*only(product.id)).order_by(product.id)).all()
+        expiring = conn.execute(bucketed_lot_quantities(
+            expiry_buckets,
+            lot.expiry_date <= today + timedelta(days=EXPIRY_RISK_BUCKETS[-1][0]),
+            *only(lot.product_id)
+        )).all()
+        aging = conn.execute(bucketed_lot_quantities(age_buckets, *only(lot.product_id))).all()
+        movements = conn.execute(db.select(
+            movement.product_id, db.func.sum(movement.qty_out), db.func.sum(movement.qty_in)
+        ).where(
+            movement.day >= utc_today - timedelta(days=turnover_days - 1),
+            movement.day <= utc_today,
+            *only(movement.product_id)
+        ).group_by(movement.product_id)).all()
+
+    ids = np.fromiter((p[0] for p in products), dtype=np.int64, count=len(products))
+
+    def fill(rows, width):
+        # rows are (product_id, value, ...); rows for products deleted
+        # between the queries are skipped
+        matrix = np.zeros((len(ids), width), dtype=np.float64)
+        if rows and len(ids):
+            row_ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+            values = np.array([r[1:] for r in rows], dtype=np.float64)
+            positions = np.minimum(np.searchsorted(ids, row_ids), len(ids) - 1)
+            known = ids[positions] == row_ids
+            matrix[positions[known]] = values[known]
+        return matrix
+
+    categories = [] if categories is None else categories
+    codes = {category: code for code, category in enumerate(categories)}
+    for _, _, category, _, _ in products:
+        if category not in codes:
+            codes[category] = len(categories)
+            categories.append(category)
+    window = fill(movements, 2)
+
+    return {
+        'id': ids,
+        'name': np.array([p[1] for p in products], dtype=object),
+        'category_code': np.fromiter((codes[p[2]] for p in products), dtype=np.int64, count=len(products)),
+        'categories': categories,
+        'quantity': np.fromiter((p[3] or 0 for p in products), dtype=np.float64, count=len(products)),
+        'unit_price': np.fromiter((p[4] or 0 for p in products), dtype=np.float64, count=len(products)),
+        'present': np.ones(len(products), dtype=bool),
+        'expiring': fill(expiring, len(EXPIRY_RISK_BUCKETS)),
+        'aging': fill(aging, len(STOCK_AGE_BUCKETS)),
+        'qty_out': window[:, 0],
+        'qty_in': window[:, 1],
+        'day': today,
+        'utc_day': utc_today,
+        'turnover_days': turnover_days,
+        'generated_at': now,
+        'refreshed_at': now
+    }
+
+def refresh_inventory_snapshot(snapshot, product_ids):
+    """Return (a copy of ``snapshot`` with the given products recomputed, whether some were not in it).
+
+    Products the snapshot has never seen are left for the next full build.
+    """
+    import numpy as np
+
+    ids = snapshot['id']
+    wanted = np.array(sorted(product_ids), dtype=np.int64)
+    positions = np.minimum(np.searchsorted(ids, wanted), max(len(ids) - 1, 0))
+    known = (ids[positions] == wanted) if len(ids) else np.zeros(len(wanted), dtype=bool)
+    positions = positions[known]
+
+    refreshed = dict(snapshot, refreshed_at=datetime.utcnow(), categories=list(snapshot['categories']))
+    for key in PRODUCT_ARRAYS:
+        refreshed[key] = snapshot[key].copy()
+    # Products that no longer exist drop out of every report
+    refreshed['present'][positions] = False
+    for chunk in chunked(wanted[known].tolist()):
+        part = build_inventory_snapshot(snapshot['turnover_days'], chunk, refreshed['categories'])
+        found = np.searchsorted(ids, part['id'])
+        for key in PRODUCT_ARRAYS:
+            refreshed[key][found] = part[key]
+    return refreshed, not known.all()
+
+class InventoryAnalytics:
+    """Holds the current analytics snapshot and the products changed since it was taken.
+
+    Snapshots are never modified in place, since readers use them outside
+    the lock; a refresh makes new arrays.
+    """
+
+    def __init__(self, ttl, turnover_days):
+        self.ttl = ttl
+        self.turnover_days = turnover_days
+        self.hits = 0
+        self.misses = 0
+        self._snapshot = None
+        self._expires = 0
+        self._dirty = set()
+        self._stale = False
+        self._changed_during_build = None
+        self._rebuilding = False
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+    def mark_dirty(self, product_ids):
+        """Queue products for a refresh, or the whole snapshot for a rebuild when ``product_ids`` is None."""
+        with self._lock:
+            if product_ids is None:
+                self._stale = True
+                return
+            self._dirty.update(product_ids)
+            if self._changed_during_build is not None:
+                self._changed_during_build.update(product_ids)
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def _build(self, only_if_missing=False):
+        with self._build_lock:
+            if only_if_missing:
+                with self._lock:
+                    if self._snapshot is not None:
+                        return self._snapshot
+            with self._lock:
+                self._changed_during_build = set()
+                self._stale = False
+            try:
+                snapshot = build_inventory_snapshot(self.turnover_days)
+            finally:
+                with self._lock:
+                    changed, self._changed_during_build = self._changed_during_build, None
+            with self._lock:
+                self._snapshot = snapshot
+                self._expires = time.monotonic() + self.ttl
+                # Everything committed before the build started is in it
+                self._dirty = changed
+            return snapshot
+
+    def _rebuild_in_background(self):
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+
+        def run():
+            with app.app_context():
+                try:
+                    self._build()
+                except Exception as e:
+                    app.logger.warning('Analytics snapshot rebuild failed: %s', e)
+                finally:
+                    with self._lock:
+                        self._rebuilding = False
+
+        threading.Thread(target=run, name='analytics-rebuild', daemon=True).start()
+
+    def get(self):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None:
+                expired = (
+                    self._stale or time.monotonic() >= self._expires
+                    or snapshot['day'] != datetime.now().date() or snapshot['utc_day'] != datetime.utcnow().date()
+                )
+                dirty, self._dirty = self._dirty, set()
+                if not dirty and not expired:
+                    self.hits += 1
+                    return snapshot
+            self.misses += 1
+
+        if snapshot is None:
+            return self._build(only_if_missing=True)
+        if dirty and len(dirty) > len(snapshot['id']) // 4:
+            expired, dirty = True, set()  # cheaper to rebuild than to refresh
+        if dirty:
+            refreshed, unknown = refresh_inventory_snapshot(snapshot, dirty)
+            expired = expired or unknown
+            with self._lock:
+                if self._snapshot is snapshot:
+                    self._snapshot = snapshot = refreshed
+        if expired:
+            self._rebuild_in_background()
+        return snapshot
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._snapshot['id']) if self._snapshot is not None else 0
+            return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'ttl': self.ttl}
+
+inventory_analytics = InventoryAnalytics(app.config['ANALYTICS_CACHE_TTL'], app.config['ANALYTICS_TURNOVER_DAYS'])
+
+@products_changed.connect
+def mark_changed_products_for_analytics(sender, product_ids=None, **kwargs):
+    inventory_analytics.mark_dirty(product_ids)
+
+@stock_changed.connect
+def mark_stock_changes_for_analytics(sender, movements=None, changes=(), **kwargs):
+    if movements is None:
+        inventory_analytics.mark_dirty(None)
+        return
+    inventory_analytics.mark_dirty(
+        {movement[0] for movement in movements} | {change['product_id'] for change in changes}
+    )
+
+def snapshot_times(snapshot):
+    return {
+        'generated_at': snapshot['generated_at'].strftime('%Y-%m-%d %H:%M:%S'),
+        'refreshed_at': snapshot['refreshed_at'].strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+def sum_by_category(snapshot, *columns):
+    """Product counts and per-category sums of each column (1-D or 2-D arrays), indexed by category code."""
+    import numpy as np
+
+    present = snapshot['present']
+    codes = snapshot['category_code'][present]
+    size = len(snapshot['categories'])
+    sums = []
+    for column in columns:
+        values = column[present]
+        if values.ndim == 1:
+            sums.append(np.bincount(codes, weights=values, minlength=size))
+        else:
+            sums.append(np.stack([
+                np.bincount(codes, weights=values[:, i], minlength=size) for i in range(values.shape[1])
+            ], axis=1))
+    return np.bincount(codes, minlength=size), sums
+
+def valuation_report(snapshot):
+    import numpy as np
+
+    categories = snapshot['categories']
+    counts, (units, values) = sum_by_category(snapshot, snapshot['quantity'], snapshot['quantity'] * snapshot['unit_price'])
+    total = float(values.sum())
+    order = sorted(np.flatnonzero(counts), key=lambda c: (-values[c], categories[c] or ''))
+    return dict(snapshot_times(snapshot), **{
+        'total_products': int(counts.sum()),
+        'total_units': int(units.sum()),
+        'total_value': round(total, 2),
+        'categories': [
+            {
+                'category': categories[c],
+                'products': int(counts[c]),
+                'units': int(units[c]),
+                'value': round(float(values[c]), 2),
+                'share': round(float(values[c]) / total, 4) if total else 0.0
+            }
+            for c in order
+        ]
+    })
+
+def bucket_report(snapshot, key, buckets, ranked, top):
+    """Units and value per bucket, overall and by category, and the ``top`` products by value in the ``ranked`` buckets."""
+    import numpy as np
+
+    units = snapshot[key]
+    values = units * snapshot['unit_price'][:, None]
+    counts, (category_units, category_values) = sum_by_category(snapshot, units, values)
+    labels = [label for _, label in buckets]
+    present = snapshot['present']
+    ranked_value = np.where(present, values[:, ranked].sum(axis=1), 0)
+    candidates = np.flatnonzero(ranked_value > 0)
+    order = candidates[np.lexsort((snapshot['id'][candidates], -ranked_value[candidates]))][:top]
+    categories = snapshot['categories']
+    return dict(snapshot_times(snapshot), **{
+        'buckets': [
+            {'bucket': label, 'units': int(units[present, i].sum()), 'value': round(float(values[present, i].sum()), 2)}
+            for i, label in enumerate(labels)
+        ],
+        'categories': [
+            {
+                'category': categories[c],
+                'units': dict(zip(labels, (int(u) for u in category_units[c]))),
+                'value': dict(zip(labels, (round(float(v), 2) for v in category_values[c])))
+            }
+            for c in sorted(np.flatnonzero(counts), key=lambda c: categories[c] or '')
+        ],
+        'products': [
+            {
+                'product_id': int(snapshot['id'][i]),
+                'name': snapshot['name'][i],
+                'category': categories[snapshot['category_code'][i]],
+                'value': round(float(ranked_value[i]), 2),
+                'units': dict(zip(labels, (int(u) for u in units[i])))
+            }
+            for i in order
+        ]
+    })
+
+def expiry_risk_report(snapshot, top=20):
+    # Products are ranked by the value of stock expired or expiring within 90 days
+    report = bucket_report(snapshot, 'expiring', EXPIRY_RISK_BUCKETS, [
+        i for i, (days, _) in enumerate(EXPIRY_RISK_BUCKETS) if days <= 90
+    ], top)
+    report['value_at_risk'] = round(sum(bucket['value'] for bucket in report['buckets']), 2)
+    return report
+
+def stock_aging_report(snapshot, top=20):
+    # Products are ranked by the value of stock received more than 180 days ago
+    return bucket_report(snapshot, 'aging', STOCK_AGE_BUCKETS, [
+        i for i, (days, _) in enumerate(STOCK_AGE_BUCKETS) if days is None or days > 180
+    ], top)
+
+def turnover_figures(snapshot):
+    """Per-product stock value, daily outflow, average stock, annualised turnover and days of cover."""
+    import numpy as np
+
+    window = snapshot['turnover_days']
+    quantity, qty_out, qty_in = snapshot['quantity'], snapshot['qty_out'], snapshot['qty_in']
+    daily_out = qty_out / window
+    # Average stock over the window, from the stock now and at its start
+    average = (quantity + np.maximum(quantity - qty_in + qty_out, 0)) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        turnover = np.where(average > 0, qty_out / average * 365 / window, np.nan)
+        days_of_cover = np.where(daily_out > 0, quantity / daily_out, np.inf)
+    return {
+        'value': quantity * snapshot['unit_price'],
+        'daily_out': daily_out,
+        'average': average,
+        'turnover': turnover,
+        'days_of_cover': days_of_cover
+    }
+
+def turnover_report(snapshot, sort='days_of_cover', category=None, limit=100, offset=0):
+    """Turnover and days of cover per product over the window, with catalogue totals.
+
+    Products without any stock out in the window have no days of cover and
+    sort last; they are also counted, with their stock value, as idle.
+    """
+    import numpy as np
+
+    figures = turnover_figures(snapshot)
+    window = snapshot['turnover_days']
+    price = snapshot['unit_price']
+    present = snapshot['present']
+    categories = snapshot['categories']
+    selected = present
+    if category:
+        code = categories.index(category) if category in categories else -1
+        selected = present & (snapshot['category_code'] == code)
+    rows = np.flatnonzero(selected)
+    ids = snapshot['id'][rows]
+    if sort == 'name':
+        ordered = rows[np.lexsort((ids, snapshot['name'][rows].astype(str)))]
+    elif sort == 'days_of_cover':
+        ordered = rows[np.lexsort((ids, figures['days_of_cover'][rows]))]
+    else:
+        ordered = rows[np.lexsort((ids, -np.nan_to_num(figures[sort][rows], nan=-1.0)))]
+
+    cost_out = float((snapshot['qty_out'] * price)[present].sum())
+    average_value = float((figures['average'] * price)[present].sum())
+    idle = present & (snapshot['qty_out'] == 0) & (snapshot['quantity'] > 0)
+
+    def row(i):
+        cover = figures['days_of_cover'][i]
+        turnover = figures['turnover'][i]
+        return {
+            'product_id': int(snapshot['id'][i]),
+            'name': snapshot['name'][i],
+            'category': categories[snapshot['category_code'][i]],
+            'quantity': int(snapshot['quantity'][i]),
+            'unit_price': round(float(price[i]), 2),
+            'value': round(float(figures['value'][i]), 2),
+            'units_out': int(snapshot['qty_out'][i]),
+            'daily_out': round(float(figures['daily_out'][i]), 2),
+            'days_of_cover': round(float(cover), 1) if np.isfinite(cover) else None,
+            'turnover': round(float(turnover), 2) if np.isfinite(turnover) else None
+        }
+
+    return dict(snapshot_times(snapshot), **{
+        'window_days': window,
+        'stock_value': round(float(figures['value'][present].sum()), 2),
+        'cost_of_goods_out': round(cost_out, 2),
+        'turnover': round(cost_out / average_value * 365 / window, 2) if average_value else None,
+        'idle_products': int(idle.sum()),
+        'idle_value': round(float(figures['value'][idle].sum()), 2),
+        'total': len(ordered),
+        'products': [row(i) for i in ordered[offset:offset + limit]]
+    })
+
+# Low-stock and expiry alerts
+class AlertBroker:
+    """In-process pub/sub for alert events, shared by every connected client.
+
+    Events go into one bounded, sequence-numbered log and waiting clients are
+    woken through a single condition variable, so publishing costs the same
+    however many clients are connected. Each client keeps its own position in
+    the log, which also lets a reconnecting EventSource resume from
+    Last-Event-ID. Waiting uses threading primitives only, so under gevent or
+    eventlet (e.g. gunicorn -k gevent) idle clients cost a greenlet each.
+    Events are per process: run one worker, or one broker per worker with
+    sticky clients.
+    """
+
+    def __init__(self, history):
+        self._events = deque(maxlen=history)
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    @property
+    def last_id(self):
+        return self._seq
+
+    def publish(self, event_type, data):
+        with self._cond:
+            self._seq += 1
+            self._events.append((self._seq, event_type, json.dumps(data)))
+            self._cond.notify_all()
+
+    def wait(self, after, timeout):
+        """Return the events after sequence number ``after``, waiting up to ``timeout`` seconds."""
+        with self._cond:
+            if self._seq <= after:
+                self._cond.wait(timeout)
+            first = self._seq - len(self._events) + 1
+            return list(islice(self._events, max(0, after + 1 - first), None))
+
+alert_broker = AlertBroker(app.config['ALERT_HISTORY_SIZE'])
+
+@stock_changed.connect
+def publish_stock_alerts(sender, changes=(), **kwargs):
+    crossings = []
+    for change in changes:
+        # A product without a reorder level is low once it runs out, as at its locations
+        reorder_level = change['reorder_level'] or 0
+        was_low = change['old_quantity'] <= reorder_level
+        is_low = change['new_quantity'] <= reorder_level
+        if was_low != is_low:
+            crossings.append((dict(change, reorder_level=reorder_level), is_low))
+    if not crossings:
+        return
+    names = dict(db.session.query(Product.id, Product.name).filter(
+        Product.id.in_([change['product_id'] for change, _ in crossings])))
+    for change, is_low in crossings:
+        alert_broker.publish('low_stock' if is_low else 'restocked', {
+            'product_id': change['product_id'],
+            'name': names.get(change['product_id']),
+            'quantity': change['new_quantity'],
+            'reorder_level': change['reorder_level']
+        })
+
+# Expiry alerts are swept by a thread in each process that serves alert
+# streams, not by a background job: a job worker may run in another process,
+# whose broker has no clients and whose sweep boundary the web process never sees
+_expiry_sweep = {'boundary': None, 'thread': None}
+_expiry_sweep_lock = threading.Lock()
+
+def sweep_expiry_alerts():
+    """Publish an alert for each in-stock lot whose expiry date entered the warning window since the last sweep."""
+    boundary = datetime.now().date() + timedelta(days=app.config['EXPIRY_WARNING_DAYS'])
+    with _expiry_sweep_lock:
+        last = _expiry_sweep['boundary'] or boundary - timedelta(days=1)
+        _expiry_sweep['boundary'] = boundary
+    if last >= boundary:
+        return 0
+    lots = db.session.query(
+        ProductLot.product_id, Product.name, ProductLot.lot_number, ProductLot.quantity, ProductLot.expiry_date
+    ).join(Product, Product.id == ProductLot.product_id).filter(
+        LOT_IN_STOCK,
+        ProductLot.expiry_date > last,
+        ProductLot.expiry_date <= boundary
+    ).order_by(ProductLot.expiry_date).all()
+    for product_id, name, lot_number, quantity, expiry_date in lots:
+        alert_broker.publish('expiring_soon', {
+            'product_id': product_id,
+            'name': name,
+            'lot_number': lot_number,
+            'quantity': quantity,
+            'expiry_date': expiry_date.strftime('%Y-%m-%d')
+        })
+    return len(lots)
+
+def start_expiry_sweeper():
+    with _expiry_sweep_lock:
+        if _expiry_sweep['thread'] is not None:
+            return
+
+        def run():
+            while True:
+                with app.app_context():
+                    try:
+                        sweep_expiry_alerts()
+                    except Exception as e:
+                        app.logger.warning('Expiry sweep failed: %s', e)
+                time.sleep(app.config['ALERT_SWEEP_INTERVAL'])
+
+        _expiry_sweep['thread'] = threading.Thread(target=run, name='expiry-sweeper', daemon=True)
+        _expiry_sweep['thread'].start()
+
+def format_alert_stream(last_id):
+    keepalive = app.config['ALERT_KEEPALIVE']
+    yield 'retry: 5000\n\n'
+    while True:
+        events = alert_broker.wait(last_id, keepalive)
+        if not events:
+            yield ': keepalive\n\n'
+            continue
+        for seq, event_type, data in events:
+            yield f'id: {seq}\nevent: {event_type}\ndata: {data}\n\n'
+            last_id = seq
+
+# Product listing helpers
+PRODUCT_SORTS = ('name', 'expiry')
+
+def product_to_dict(product):
+    return {
+        'id': product.id,
+        'name': product.name,
+        'category': product.category,
+        'description': product.description,
+        'unit_price': product.unit_price,
+        'quantity': product.quantity,
+        'reorder_level': product.reorder_level,
+        'barcode': product.barcode,
+        'expiry_date': product.expiry_date.strftime('%Y-%m-%d') if product.expiry_date else None
+    }
+
+def encode_cursor(kind, key, last_id):
+    # The cursor carries the sort key of the last row on the page so the next
+    # page can seek past it instead of counting an OFFSET.
+    payload = json.dumps([kind, key, last_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(kind, cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_kind, key, last_id = json.loads(base64.urlsafe_b64decode(padded))
+        last_id = int(last_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if cursor_kind != kind:
+        raise ValueError('Cursor does not match sort order')
+    return key, last_id
+
+def parse_product_filters(args):
+    sort = args.get('sort', 'name')
+    if sort not in PRODUCT_SORTS:
+        sort = 'name'
+    try:
+        limit = int(args.get('limit', app.config['PRODUCTS_PER_PAGE']))
+    except ValueError:
+        limit = app.config['PRODUCTS_PER_PAGE']
+    return {
+        'sort': sort,
+        'category': args.get('category') or None,
+        'q': (args.get('q') or '').strip() or None,
+        'low_stock': args.get('low_stock') in ('1', 'true', 'on'),
+        'expiring': args.get('expiring') in ('1', 'true', 'on'),
+        'cursor': args.get('cursor') or None,
+        'limit': max(1, min(limit, app.config['MAX_PRODUCTS_PER_PAGE']))
+    }
+
+def paginate_products(sort='name', category=None, q=None, low_stock=False, expiring=False, cursor=None, limit=50):
+    """Return one page of products and the cursor for the next page.
+
+    Pages are fetched with a keyset (seek) predicate on (name, id) or
+    (expiry_date, id), so every page costs the same as the first one.
+    """
+    query = Product.query
+    today = datetime.now().date()
+
+    if category:
+        query = query.filter(Product.category == category)
+    if q:
+        query = query.filter(product_search_filter(q))
+    if low_stock:
+        query = query.filter(Product.quantity <= Product.reorder_level)
+    if expiring:
+        # Any in-stock lot expiring within 30 days, found through the lot expiry index
+        query = query.filter(Product.id.in_(db.select(ProductLot.product_id).where(
+            LOT_IN_STOCK,
+            ProductLot.expiry_date <= today + timedelta(days=30),
+            ProductLot.expiry_date > today
+        )))
+
+    if sort == 'expiry':
+        if cursor:
+            key, last_id = decode_cursor(sort, cursor)
+            if key is not None and not isinstance(key, str):
+                raise ValueError('Invalid cursor')
+            if key is not None:
+                key = datetime.strptime(key, '%Y-%m-%d').date()
+            if key is None:
+                # Products without an expiry date sort last
+                query = query.filter(Product.expiry_date.is_(None), Product.id > last_id)
+            else:
+                query = query.filter(db.or_(
+                    Product.expiry_date > key,
+                    db.and_(Product.expiry_date == key, Product.id > last_id),
+                    Product.expiry_date.is_(None)
+                ))
+        query = query.order_by(Product.expiry_date.asc().nulls_last(), Product.id.asc())
+    else:
+        if cursor:
+            key, last_id = decode_cursor(sort, cursor)
+            if not isinstance(key, str):
+                raise ValueError('Invalid cursor')
+            query = query.filter(db.tuple_(Product.name, Product.id) > db.tuple_(key, last_id))
+        query = query.order_by(Product.name.asc(), Product.id.asc())
+
+    products = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(products) > limit:
+        products = products[:limit]
+        last = products[-1]
+        if sort == 'expiry':
+            next_cursor = encode_cursor(sort, last.expiry_date.isoformat() if last.expiry_date else None, last.id)
+        else:
+            next_cursor = encode_cursor(sort, last.name, last.id)
+    return products, next_cursor
+
+# Scanner lookups
+class BarcodeIndex:
+    """Barcode to product summary map serving scanner lookups from memory.
+
+    Every barcoded product is loaded with one projected query on first use,
+    and again every ``ttl`` seconds as a fallback for writes made by other
+    processes. Each summary is serialised to JSON once, together with an ETag
+    derived from it. Writes in this process drop the affected entries through
+    the products_changed and stock_changed signals, and barcodes missing from
+    the map are looked up in the database, so changed and newly added
+    products are served fresh on their next scan.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # barcode -> (json, etag)
+        self._barcodes = {}  # product id -> barcode
+        self._expires = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _query():
+        return db.session.query(
+            Product.id, Product.name, Product.category, Product.description, Product.unit_price,
+            Product.quantity, Product.reorder_level, Product.barcode, Product.expiry_date
+        )
+
+    @staticmethod
+    def _entry(row):
+        body = json.dumps(product_to_dict(row), separators=(',', ':'))
+        return body, hashlib.blake2b(body.encode(), digest_size=8).hexdigest()
+
+    def _store(self, rows, generation):
+        entries = [(row.id, row.barcode, self._entry(row)) for row in rows]
+        with self._lock:
+            # Skip rows read before a concurrent invalidation
+            if generation == self._generation:
+                for product_id, barcode, entry in entries:
+                    self._entries[barcode] = entry
+                    self._barcodes[product_id] = barcode
+        return {barcode: entry for _, barcode, entry in entries}
+
+    def _refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._expires:
+                return
+            # Other requests keep using the current map while one reloads it
+            self._expires = now + self.ttl
+            generation = self._generation
+        rows = self._query().filter(Product.barcode.isnot(None)).all()
+        entries = {row.barcode: self._entry(row) for row in rows}
+        with self._lock:
+            if generation == self._generation:
+                self._entries = entries
+                self._barcodes = {row.id: row.barcode for row in rows}
+
+    def get_many(self, barcodes):
+        """Return {barcode: (json, etag) or None}, reading only unknown barcodes from the database."""
+        self._refresh()
+        found = {}
+        missing = []
+        for barcode in barcodes:
+            entry = self._entries.get(barcode)
+            if entry:
+                found[barcode] = entry
+            else:
+                missing.append(barcode)
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+        if missing:
+            generation = self._generation
+            for chunk in chunked(missing):
+                found.update(self._store(self._query().filter(Product.barcode.in_(chunk)).all(), generation))
+        return {barcode: found.get(barcode) for barcode in barcodes}
+
+    def get(self, barcode):
+        return self.get_many([barcode])[barcode]
+
+    def invalidate(self, product_ids=None):
+        with self._lock:
+            self._generation += 1
+            if product_ids is None:
+                self._expires = 0
+                return
+            for product_id in product_ids:
+                barcode = self._barcodes.pop(product_id, None)
+                if barcode:
+                    self._entries.pop(barcode, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'ttl': self.ttl}
+
+barcode_index = BarcodeIndex(app.config['SCANNER_CACHE_TTL'])
+
+@products_changed.connect
+def invalidate_barcode_index(sender, product_ids=None, **kwargs):
+    barcode_index.invalidate(product_ids)
+
+@stock_changed.connect
+def invalidate_barcode_quantities(sender, changes=(), **kwargs):
+    # Quantity and, through the lots, expiry may have changed
+    if changes:
+        barcode_index.invalidate([change['product_id'] for change in changes])
+
+def conditional_json(body, etag):
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+# Product search
+#
+# An SQLite FTS5 index over name, category, description and barcode. It is an
+# external-content table over product, kept in step by triggers, so every
+# write path (the API, bulk import, sample data) updates it in the same
+# transaction. Stock movements only set quantity and expiry_date and do not
+# fire the triggers. Other databases fall back to LIKE matching.
+#
+# Only the first SEARCH_RANK_WINDOW matches are ranked, so a short prefix
+# matching most of the catalogue costs no more than a selective query; the
+# window only changes the order when there are more matches than it holds.
+SEARCH_COLUMNS = ('name', 'category', 'description', 'barcode')
+SEARCH_WEIGHTS = (10.0, 2.0, 1.0, 5.0)  # bm25 weights, in SEARCH_COLUMNS order
+SEARCH_MAX_TERMS = 8
+
+def product_search_ddl():
+    columns = ', '.join(SEARCH_COLUMNS)
+    new = ', '.join(f'new.{c}' for c in SEARCH_COLUMNS)
+    old = ', '.join(f'old.{c}' for c in SEARCH_COLUMNS)
+    delete_old = f"INSERT INTO product_search (product_search, rowid, {columns}) VALUES ('delete', old.id, {old});"
+    insert_new = f'INSERT INTO product_search (rowid, {columns}) VALUES (new.id, {new});'
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5({columns}, content='product', "
+        f"content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS product_search_vocab USING fts5vocab(product_search, 'row')",
+        f'CREATE TRIGGER IF NOT EXISTS product_search_insert AFTER INSERT ON product BEGIN {insert_new} END',
+        f'CREATE TRIGGER IF NOT EXISTS product_search_delete AFTER DELETE ON product BEGIN {delete_old} END',
+        f'CREATE TRIGGER IF NOT EXISTS product_search_update AFTER UPDATE OF {columns} ON product '
+        f'BEGIN {delete_old} {insert_new} END',
+    ]
+
+def create_product_search(target, conn, **kw):
+    if conn.dialect.name == 'sqlite':
+        for statement in product_search_ddl():
+            conn.exec_driver_sql(statement)
+
+def drop_product_search(target, conn, **kw):
+    # The triggers go with the product table
+    if conn.dialect.name == 'sqlite':
+        conn.exec_driver_sql('DROP TABLE IF EXISTS product_search_vocab')
+        conn.exec_driver_sql('DROP TABLE IF EXISTS product_search')
+
+event.listen(Product.__table__, 'after_create', create_product_search)
+event.listen(Product.__table__, 'before_drop', drop_product_search)
+
+def search_terms(text):
+    # Same folding as the unicode61 tokenizer: lower case, no diacritics
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return re.findall(r'\w+', text)[:SEARCH_MAX_TERMS]
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance between a and b, or limit + 1 once it is known to exceed limit."""
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+class SearchVocabulary:
+    """Indexed terms, for telling typed prefixes from typos and suggesting corrections.
+
+    Loaded from the fts5vocab table on first use and again every ``ttl``
+    seconds, or as soon as this process changes a product. Corrections are
+    memoised per term until the next reload, since typeahead sends the same
+    prefixes over and over.
+    """
+
+    def __init__(self, ttl, corrections=3):
+        self.ttl = ttl
+        self.corrections = corrections
+        self.hits = 0
+        self.misses = 0
+        self._terms = []  # sorted
+        self._by_initial = {}  # first character -> [(term, documents)]
+        self._memo = {}
+        self._expires = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._expires:
+                return
+            self._expires = now + self.ttl
+            generation = self._generation
+        # Terms starting with a digit (barcodes, strengths) sort before 'a'
+        # and are only ever matched as prefixes
+        rows = db.session.execute(db.text("SELECT term, doc FROM product_search_vocab WHERE term >= 'a'")).all()
+        by_initial = {}
+        for term, documents in rows:
+            by_initial.setdefault(term[0], []).append((term, documents))
+        with self._lock:
+            if generation == self._generation:
+                self._terms = sorted(term for term, _ in rows)
+                self._by_initial = by_initial
+                self._memo = {}
+
+    def has_prefix(self, prefix):
+        self._refresh()
+        terms = self._terms
+        i = bisect.bisect_left(terms, prefix)
+        return i < len(terms) and terms[i].startswith(prefix)
+
+    def similar(self, term):
+        """Indexed terms whose start is within one or two edits of ``term``, best first."""
+        self._refresh()
+        memo = self._memo
+        if term in memo:
+            with self._lock:
+                self.hits += 1
+            return memo[term]
+        with self._lock:
+            self.misses += 1
+        matches = []
+        if len(term) >= 3:
+            # Typos in the first letter are rare, and skipping them keeps
+            # the scan to one bucket
+            limit = 1 if len(term) <= 4 else 2
+            for candidate, documents in self._by_initial.get(term[0], ()):
+                distance = edit_distance(term, candidate[:len(term)], limit)
+                if distance <= limit:
+                    matches.append((distance, -documents, candidate))
+        memo[term] = [candidate for _, _, candidate in sorted(matches)[:self.corrections]]
+        return memo[term]
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._expires = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._terms), 'ttl': self.ttl}
+
+search_vocabulary = SearchVocabulary(app.config['SEARCH_VOCAB_TTL'])
+
+@products_changed.connect
+def invalidate_search_vocabulary(sender, **kwargs):
+    search_vocabulary.invalidate()
+
+def fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+def build_search_query(text):
+    """Turn typed text into an FTS5 MATCH expression and a suggested correction.
+
+    Every term matches as a prefix ("paracet 500" finds "Paracetamol
+    500mg"). A term that starts no indexed word also matches its closest
+    indexed words. Returns (expression or None when there are no terms,
+    suggested text or None).
+    """
+    terms = search_terms(text)
+    if not terms:
+        return None, None
+    parts, suggested, corrected = [], [], False
+    for term in terms:
+        options = [fts_phrase(term) + '*']
+        if not term[0].isdigit() and not search_vocabulary.has_prefix(term):
+            # Still try the prefix: the vocabulary may be older than the index
+            similar = search_vocabulary.similar(term)
+            options.extend(fts_phrase(candidate) for candidate in similar)
+            if similar:
+                corrected = True
+                term = similar[0]
+        parts.append(options[0] if len(options) == 1 else '(' + ' OR '.join(options) + ')')
+        suggested.append(term)
+    return ' AND '.join(parts), ' '.join(suggested) if corrected else None
+
+def like_search_filter(text):
+    # Fallback without FTS5: every term must appear in the name, category or barcode
+    return db.and_(*(
+        db.or_(*(column.ilike(f'%{term}%') for column in (Product.name, Product.category, Product.barcode)))
+        for term in search_terms(text)
+    ))
+
+def product_search_filter(text):
+    """A criterion restricting Product rows to those matching ``text``."""
+    if db.engine.dialect.name != 'sqlite':
+        return like_search_filter(text)
+    expression, _ = build_search_query(text)
+    if expression is None:
+        return db.true()
+    return Product.id.in_(
+        db.select(db.literal_column('rowid')).select_from(db.table('product_search')).where(
+            db.text('product_search MATCH :search').bindparams(search=expression)
+        )
+    )
+
+def search_products(text, limit=10):
+    """Return (rows, suggestion): products matching ``text``, best first, and a suggested correction."""
+    columns = (Product.id, Product.name, Product.category, Product.barcode, Product.quantity, Product.unit_price)
+    text = text.strip()
+    if text.isdigit():
+        # A scanned or typed barcode prefix: a range on the unique barcode
+        # index, rather than expanding the prefix over every indexed barcode
+        upper = text[:-1] + chr(ord(text[-1]) + 1)
+        return db.session.query(*columns).filter(
+            Product.barcode >= text, Product.barcode < upper
+        ).order_by(Product.barcode).limit(limit).all(), None
+    if db.engine.dialect.name != 'sqlite':
+        if not search_terms(text):
+            return [], None
+        return db.session.query(*columns).filter(like_search_filter(text)).order_by(
+            Product.name
+        ).limit(limit).all(), None
+    expression, suggestion = build_search_query(text)
+    if expression is None:
+        return [], None
+    hits = db.select(db.literal_column('rowid'), db.literal_column('rank')).select_from(
+        db.table('product_search')
+    ).where(
+        db.text('product_search MATCH :search AND rank MATCH :ranking').bindparams(
+            search=expression, ranking=f"bm25({', '.join(str(w) for w in SEARCH_WEIGHTS)})"
+        )
+    ).limit(app.config['SEARCH_RANK_WINDOW']).subquery()
+    rows = db.session.execute(
+        db.select(*columns).join(hits, Product.id == hits.c.rowid).order_by(hits.c.rank).limit(limit)
+    ).all()
+    return rows, suggestion
+
+# Background jobs
+#
+# Exports, imports, forecasts and barcode lookups can run outside the
+# request that asked for them. The job table is the queue: a submit inserts
+# a queued row and wakes this process's workers, and a worker in any process
+# claims a row with a conditional UPDATE, so no broker is needed and
+# `flask run-jobs` can serve the queue from a separate process (set
+# JOB_WORKERS=0 in the web processes). Handlers report progress through
+# their JobContext; every report also checks for a cancel request. Result
+# files are written under JOB_RESULTS_DIR/<job id>/ and removed, with the
+# job, JOB_RESULT_TTL after it finishes. A running job whose worker stops
+# heartbeating is marked failed rather than run twice, since an import
+# cannot safely be repeated.
+JOB_HANDLERS = {}
+JOB_STATUSES = ('queued', 'running', 'succeeded', 'failed', 'cancelled')
+JOB_INPUT_FILE = 'input'
+
+def job_handler(kind, validate=None):
+    """Register ``fn(ctx, params)`` for a job kind.
+
+    ``validate(params)`` runs at submit time and returns the params to store
+    or raises ValueError; the handler returns a JSON-serialisable summary.
+    """
+    def register(fn):
+        JOB_HANDLERS[kind] = (fn, validate)
+        return fn
+    return register
+
+class JobCancelled(Exception):
+    pass
+
+def job_directory(job_id):
+    return os.path.join(app.config['JOB_RESULTS_DIR'], job_id)
+
+class JobContext:
+    """What a running handler gets: its parameters, a result directory and progress reporting."""
+
+    def __init__(self, runner, job_id, params):
+        self.runner = runner
+        self.job_id = job_id
+        self.params = params
+        self.result_file = None
+        # Kept as the job's result if it is cancelled or fails, for handlers
+        # whose work up to that point stays done
+        self.partial_result = None
+        self._next_report = 0
+
+    @property
+    def directory(self):
+        return job_directory(self.job_id)
+
+    def path(self, filename):
+        """Path to write the job's downloadable result to."""
+        os.makedirs(self.directory, exist_ok=True)
+        self.result_file = filename
+        return os.path.join(self.directory, filename)
+
+    def progress(self, done=None, total=None, message=None):
+        """Record progress, at most every JOB_PROGRESS_INTERVAL seconds. Raises JobCancelled when cancelled."""
+        if self.runner.cancelled_here(self.job_id):
+            raise JobCancelled()
+        now = time.monotonic()
+        if now < self._next_report:
+            return
+        self._next_report = now + app.config['JOB_PROGRESS_INTERVAL']
+        fraction = min(done / total, 1.0) if total else None
+        if self.runner.report(self.job_id, fraction, message):
+            raise JobCancelled()
+
+class JobRunner:
+    """A pool of worker threads serving the job table.
+
+    Threads rather than processes: the heavy parts of every job run in
+    SQLite, NumPy or socket calls that release the GIL, and threads share
+    the app's engine and caches.
+    """
+
+    def __init__(self, workers, poll_interval, heartbeat_interval):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self._threads = []
+        self._running = set()
+        self._cancelled = set()
+        self._pending = threading.Semaphore(0)
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._threads = [
+                threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            self._threads.append(threading.Thread(target=self._housekeep, name='job-housekeeping', daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def wake(self):
+        self._pending.release()
+
+    def cancelled_here(self, job_id):
+        with self._lock:
+            return job_id in self._cancelled
+
+    def cancel(self, job_id):
+        """Cancel a queued job outright, or ask a running one to stop at its next progress report."""
+        now = datetime.utcnow()
+        table = Job.__table__
+        with self._lock:
+            if job_id in self._running:
+                self._cancelled.add(job_id)
+        with db.engine.begin() as conn:
+            conn.execute(db.update(table).where(table.c.id == job_id, table.c.status == 'queued').values(
+                status='cancelled', cancel_requested=True, finished_at=now))
+            conn.execute(db.update(table).where(table.c.id == job_id, table.c.status == 'running').values(
+                cancel_requested=True))
+
+    def report(self, job_id, fraction, message):
+        """Write progress and a heartbeat. Returns True if the job has been asked to stop."""
+        table = Job.__table__
+        values = {'heartbeat_at': datetime.utcnow()}
+        if fraction is not None:
+            values['progress'] = fraction
+        if message is not None:
+            values['message'] = message[:200]
+        # On its own connection, so it never joins the handler's transaction
+        with db.engine.begin() as conn:
+            conn.execute(db.update(table).where(table.c.id == job_id).values(**values))
+            return conn.execute(db.select(table.c.cancel_requested).where(table.c.id == job_id)).scalar()
+
+    def _claim(self):
+        table = Job.__table__
+        while True:
+            with db.engine.begin() as conn:
+                job = conn.execute(
+                    db.select(table.c.id, table.c.kind, table.c.params).where(
+                        table.c.status == 'queued'
+                    ).order_by(table.c.created_at).limit(1)
+                ).first()
+                if job is None:
+                    return None
+                now = datetime.utcnow()
+                claimed = conn.execute(
+                    db.update(table).where(table.c.id == job.id, table.c.status == 'queued').values(
+                        status='running', worker=self.name, started_at=now, heartbeat_at=now)
+                ).rowcount
+            if claimed:
+                return job
+            # Another worker got there first
+
+    def _run(self, job):
+        ctx = JobContext(self, job.id, json.loads(job.params or '{}'))
+        with self._lock:
+            self._running.add(job.id)
+        result = error = None
+        try:
+            if job.kind not in JOB_HANDLERS:
+                raise ValueError(f'Unknown job kind: {job.kind}')
+            handler, _ = JOB_HANDLERS[job.kind]
+            result = handler(ctx, ctx.params)
+            status = 'succeeded'
+        except JobCancelled:
+            status = 'cancelled'
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception('Job %s (%s) failed', job.id, job.kind)
+            status, error = 'failed', str(e) or type(e).__name__
+        finally:
+            with self._lock:
+                self._running.discard(job.id)
+                self._cancelled.discard(job.id)
+        if status != 'succeeded':
+            shutil.rmtree(ctx.directory, ignore_errors=True)
+        table = Job.__table__
+        if status != 'succeeded':
+            result = ctx.partial_result or None
+        values = {
+            'status': status,
+            'finished_at': datetime.utcnow(),
+            'result': json.dumps(result) if result is not None else None,
+            'result_file': ctx.result_file if status == 'succeeded' else None,
+            'error': error
+        }
+        if status == 'succeeded':
+            values['progress'] = 1.0
+        with db.engine.begin() as conn:
+            conn.execute(db.update(table).where(table.c.id == job.id).values(**values))
+
+    def _work(self):
+        while True:
+            self._pending.acquire(timeout=self.poll_interval)
+            while True:
+                with app.app_context():
+                    try:
+                        job = self._claim()
+                    except Exception as e:
+                        app.logger.warning('Claiming a job failed: %s', e)
+                        break
+                    if job is None:
+                        break
+                    self._run(job)
+
+    def _housekeep(self):
+        while True:
+            with app.app_context():
+                try:
+                    self.housekeep()
+                except Exception as e:
+                    app.logger.warning('Job housekeeping failed: %s', e)
+            time.sleep(self.heartbeat_interval)
+
+    def housekeep(self):
+        """Heartbeat this process's running jobs, fail abandoned ones and purge expired results."""
+        table = Job.__table__
+        now = datetime.utcnow()
+        with self._lock:
+            running = list(self._running)
+        with db.engine.begin() as conn:
+            if running:
+                conn.execute(db.update(table).where(table.c.id.in_(running)).values(heartbeat_at=now))
+            conn.execute(db.update(table).where(
+                table.c.status == 'running',
+                table.c.heartbeat_at < now - timedelta(seconds=4 * self.heartbeat_interval)
+            ).values(status='failed', error='Worker stopped before the job finished', finished_at=now))
+            expired = conn.execute(db.select(table.c.id).where(
+                table.c.finished_at < now - app.config['JOB_RESULT_TTL']
+            )).scalars().all()
+            for chunk in chunked(expired):
+                conn.execute(db.delete(table).where(table.c.id.in_(chunk)))
+        for job_id in expired:
+            shutil.rmtree(job_directory(job_id), ignore_errors=True)
+        return len(expired)
+
+job_runner = JobRunner(
+    app.config['JOB_WORKERS'], app.config['JOB_POLL_INTERVAL'], app.config['JOB_HEARTBEAT_INTERVAL']
+)
+
+def submit_job(kind, params, user_id, upload=None):
+    """Queue a job and return its row. ``upload`` is a binary stream saved as the job's input file.
+
+    Raises ValueError for an unknown kind or invalid params.
+    """
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f'Unknown job kind. Use one of: {", ".join(sorted(JOB_HANDLERS))}')
+    _, validate = JOB_HANDLERS[kind]
+    params = validate(params) if validate else params
+    job_id = secrets.token_hex(16)
+    if upload is not None:
+        os.makedirs(job_directory(job_id), exist_ok=True)
+        with open(os.path.join(job_directory(job_id), JOB_INPUT_FILE), 'wb') as f:
+            shutil.copyfileobj(upload, f)
+    job = Job(id=job_id, kind=kind, status='queued', params=json.dumps(params), user_id=user_id)
+    db.session.add(job)
+    db.session.commit()
+    job_runner.start()
+    job_runner.wake()
+    return job
+
+def job_to_dict(job):
+    def timestamp(value):
+        return value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'params': json.loads(job.params) if job.params else {},
+        'progress': round(job.progress, 3) if job.progress is not None else None,
+        'message': job.message,
+        'result': json.loads(job.result) if job.result else None,
+        'result_url': url_for('download_job_result', job_id=job.id) if job.result_file else None,
+        'error': job.error,
+        'cancel_requested': job.cancel_requested,
+        'created_at': timestamp(job.created_at),
+        'started_at': timestamp(job.started_at),
+        'finished_at': timestamp(job.finished_at)
+    }
+
+def job_accepted(job):
+    return jsonify(job_to_dict(job)), 202, {'Location': url_for('get_job', job_id=job.id)}
+
+def validate_export_params(params):
+    params = {key: str(value) for key, value in params.items() if key in ('date', 'from', 'to', 'type', 'product', 'gzip')}
+    parse_transaction_filters(params)
+    return params
+
+@job_handler('export_transactions', validate=validate_export_params)
+def run_export_job(ctx, params):
+    filters = parse_transaction_filters(params)
+    compress = params.get('gzip') in ('1', 'true')
+    total = 0
+    with db.engine.connect() as conn:
+        for table in transaction_sources(conn, filters['start'], filters['end']):
+            total += conn.execute(
+                apply_transaction_filters(db.select(db.func.count()).select_from(table), filters, table.c)
+            ).scalar()
+    written = [0]
+
+    def progress(rows):
+        written[0] += rows
+        ctx.progress(written[0], total, f'{written[0]:,} of {total:,} rows')
+
+    with open(ctx.path(export_filename(compress)), 'wb') as output:
+        for chunk in stream_transactions_csv(export_statements(filters), compress, progress):
+            output.write(chunk)
+    return {'rows': written[0]}
+
+def validate_import_params(params):
+    fmt = params.get('format') or ('json' if str(params.get('filename', '')).lower().endswith(
+        ('.json', '.jsonl', '.ndjson')) else 'csv')
+    if fmt not in ('csv', 'json'):
+        raise ValueError('format must be csv or json')
+    return {
+        'format': fmt,
+        'filename': params.get('filename'),
+        'upsert': str(params.get('upsert')).lower() in ('1', 'true'),
+        'dry_run': str(params.get('dry_run')).lower() in ('1', 'true')
+    }
+
+@job_handler('import_products', validate=validate_import_params)
+def run_import_job(ctx, params):
+    path = os.path.join(ctx.directory, JOB_INPUT_FILE)
+    if not os.path.exists(path):
+        raise ProductDataError('The job has no input file')
+    size = os.path.getsize(path)
+    with open(path, 'rb') as raw:
+        stream = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+
+        def records():
+            for row_number, record in enumerate(iter_import_records(stream, params['format']), start=1):
+                if row_number % 100 == 0:
+                    ctx.progress(raw.tell(), size, f'{row_number:,} rows read')
+                yield record
+
+        summary = ctx.partial_result = {}
+        try:
+            import_products(records(), upsert=params['upsert'], dry_run=params['dry_run'], summary=summary)
+        except Exception:
+            # Batches committed before the stop stay in the database
+            if not params['dry_run'] and (summary.get('inserted') or summary.get('updated')):
+                ctx.runner.report(ctx.job_id, None, f"Stopped after {summary['inserted']:,} products inserted "
+                                                    f"and {summary['updated']:,} updated")
+            raise
+    os.remove(path)
+    errors = summary.pop('errors')
+    if errors:
+        with open(ctx.path('import_errors.csv'), 'w', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(['row', 'barcode', 'error'])
+            writer.writerows((error['row'], error['barcode'], error['error']) for error in errors)
+    return summary
+
+def validate_reorder_params(params):
+    sort = params.get('sort', 'days_until_reorder')
+    if sort not in REORDER_SORTS:
+        raise ValueError(f'Invalid sort. Use one of: {", ".join(REORDER_SORTS)}')
+    within = params.get('within')
+    return {
+        'sort': sort,
+        'within': int(within) if within not in (None, '') else None,
+        'category': params.get('category') or None
+    }
+
+@job_handler('reorder_report', validate=validate_reorder_params)
+def run_reorder_job(ctx, params):
+    ctx.progress(message='Building forecast')
+    forecast = build_restock_forecast()
+    # Serve the report endpoint from this forecast too
+    store_restock_forecast(forecast)
+    rows = reorder_report(forecast, params['sort'], params['within'], params['category'])
+    ctx.progress(message='Writing report')
+    with open(ctx.path('reorder_report.csv'), 'w', newline='') as output:
+        write_reorder_csv(forecast, rows, output)
+    return {'products': len(forecast['id']), 'due': len(rows)}
 
-class Transaction(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
-    transaction_type = db.Column(db.String(20), nullable=False)  # 'in' or 'out'
-    date = db.Column(db.DateTime, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+def validate_barcode_params(params):
+    barcodes = params.get('barcodes')
+    if not isinstance(barcodes, list) or not barcodes:
+        raise ValueError('Expected a non-empty list of barcodes')
+    if len(barcodes) > app.config['SCANNER_MAX_BATCH']:
+        raise ValueError(f"At most {app.config['SCANNER_MAX_BATCH']} barcodes per job")
+    return {'barcodes': list(dict.fromkeys(str(b) for b in barcodes)), 'refresh': bool(params.get('refresh'))}
 
-@login_manager.user_loader
-def load_user(user_id):
-    return db.session.get(User, int(user_id))
+@job_handler('barcode_info', validate=validate_barcode_params)
+def run_barcode_info_job(ctx, params):
+    barcodes = params['barcodes']
+
+    def fetch(barcode):
+        with app.app_context():
+            try:
+                return barcode, lookup_barcode_info(barcode, refresh=params['refresh']), None
+            except BarcodeLookupError as e:
+                return barcode, (False, None), str(e)
+
+    products, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=app.config['BARCODE_INFO_WORKERS']) as pool:
+        futures = [pool.submit(fetch, barcode) for barcode in barcodes]
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                barcode, (found, product), error = future.result()
+                products[barcode] = product
+                if error:
+                    errors[barcode] = error
+                ctx.progress(done, len(barcodes), f'{done} of {len(barcodes)} barcodes')
+        except JobCancelled:
+            for future in futures:
+                future.cancel()
+            raise
+    return {'products': {barcode: products[barcode] for barcode in barcodes}, 'errors': errors}
+
+@app.cli.command('run-jobs')
+@click.option('--workers', type=int, default=None, help='Worker threads (default: JOB_WORKERS)')
+def run_jobs_command(workers):
+    """Run background job workers in this process until interrupted."""
+    job_runner.workers = workers or job_runner.workers or 1
+    job_runner.start()
+    print(f'Running {job_runner.workers} job workers as {job_runner.name}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
 
 # Routes
+def render_product_table(filters):
+    """Return (rendered table rows, next page cursor, categories) for the products page."""
+    products, next_cursor = paginate_products(**filters)
+    categories = [c[0] for c in db.session.query(Product.category).distinct().order_by(Product.category) if c[0]]
+    rows = Markup(render_template('product_rows.html', products=products, today=datetime.now().date()))
+    return rows, next_cursor, categories
+
 @app.route('/')
 @login_required
+@conditional_view('product')
 def index():
-    products = Product.query.all()
-    today = datetime.now().date()
-    return render_template('products.html', products=products, today=today)
+    filters = parse_product_filters(request.args)
+    key, _, _ = data_versions.validators(('product',))
+    try:
+        rows, next_cursor, categories = product_table_fragments.get(
+            (key, tuple(sorted(filters.items()))), lambda: render_product_table(filters)
+        )
+    except ValueError:
+        flash('Invalid page cursor, showing the first page', 'warning')
+        filters['cursor'] = None
+        rows, next_cursor, categories = render_product_table(filters)
+    return render_template('products.html',
+        product_rows=rows,
+        categories=categories,
+        filters=filters,
+        next_cursor=next_cursor
+    )
 
 @app.route('/stock/in/<int:product_id>', methods=['GET', 'POST'])
 @login_required
@@ -88,19 +3977,14 @@ def stock_in(product_id):
             if quantity <= 0:
                 flash('Quantity must be greater than 0', 'danger')
             else:
-                product.quantity += quantity
-                transaction = Transaction(
-                    product_id=product_id,
-                    quantity=quantity,
-                    transaction_type='in',
-                    user_id=current_user.id
-                )
-                db.session.add(transaction)
-                db.session.commit()
+                expiry_date, lot_number = parse_lot_fields(request.form)
+                apply_stock_movement(product_id, quantity, 'in', current_user.id, expiry_date, lot_number)
                 flash('Stock updated successfully', 'success')
                 return redirect(url_for('dashboard'))
         except ValueError:
             flash('Invalid quantity', 'danger')
+        except StockError as e:
+            flash(str(e), 'danger')
     return render_template('stock_in.html', product=product)
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -129,68 +4013,106 @@ def add_product():
     try:
         data = request.get_json()
         
-        # Validate required fields
-        required_fields = ['name', 'category', 'unit_price', 'quantity', 'reorder_level']
-        for field in required_fields:
-            if field not in data or not str(data[field]).strip():
-                return jsonify({'error': f'{field.title()} is required'}), 400
-        
-        # Validate numeric fields
-        try:
-            unit_price = float(data['unit_price'])
-            quantity = int(data['quantity'])
-            reorder_level = int(data['reorder_level'])
-            
-            if unit_price <= 0:
-                return jsonify({'error': 'Unit price must be greater than 0'}), 400
-            if quantity < 0:
-                return jsonify({'error': 'Quantity cannot be negative'}), 400
-            if reorder_level < 0:
-                return jsonify({'error': 'Reorder level cannot be negative'}), 400
-                
-        except ValueError:
-            return jsonify({'error': 'Invalid numeric values provided'}), 400
-        
-        # Validate expiry date
-        expiry_date = None
-        if data.get('expiry_date'):
-            try:
-                expiry_date = datetime.strptime(data['expiry_date'], '%Y-%m-%d').date()
-                if expiry_date < datetime.now().date():
-                    return jsonify({'error': 'Expiry date cannot be in the past'}), 400
-            except ValueError:
-                return jsonify({'error': 'Invalid expiry date format. Use YYYY-MM-DD'}), 400
+        fields = parse_product_data(data)
         
         # Check if barcode already exists
-        if data.get('barcode'):
-            existing_product = Product.query.filter_by(barcode=data['barcode']).first()
+        if fields['barcode']:
+            existing_product = Product.query.filter_by(barcode=fields['barcode']).first()
             if existing_product:
                 return jsonify({'error': 'Product with this barcode already exists'}), 400
         
-        new_product = Product(
-            name=data['name'],
-            category=data['category'],
-            description=data.get('description', ''),
-            unit_price=unit_price,
-            quantity=quantity,
-            reorder_level=reorder_level,
-            barcode=data.get('barcode'),
-            expiry_date=expiry_date
-        )
+        new_product = Product(**fields)
+        if new_product.quantity:
+            new_product.lots.append(ProductLot(quantity=new_product.quantity, expiry_date=new_product.expiry_date))
         
         db.session.add(new_product)
+        db.session.flush()
+        backfill_stock_levels(db.session, [new_product.id])
         db.session.commit()
+        products_changed.send(app, product_ids=[new_product.id])
         
         return jsonify({
             'message': 'Product added successfully',
             'id': new_product.id
         })
         
+    except ProductDataError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
-        print(f"Error adding product: {str(e)}")  # For debugging
+        app.logger.exception('Error adding product')
         return jsonify({'error': 'An error occurred while adding the product'}), 400
 
+@app.route('/api/products/import', methods=['POST'])
+@login_required
+def import_products_upload():
+    try:
+        upload = request.files.get('file')
+        if request.args.get('async') in ('1', 'true'):
+            params = dict(request.args, filename=upload.filename if upload else None)
+            job = submit_job('import_products', params, current_user.id, upload.stream if upload else request.stream)
+            return job_accepted(job)
+        fmt = request.args.get('format')
+        if not fmt:
+            name = upload.filename if upload else ''
+            is_json = name.lower().endswith(('.json', '.jsonl', '.ndjson')) or request.mimetype in (
+                'application/json', 'application/x-ndjson')
+            fmt = 'json' if is_json else 'csv'
+        raw = upload.stream if upload else request.stream
+        stream = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+
+        summary = import_products(
+            iter_import_records(stream, fmt),
+            upsert=request.args.get('upsert') in ('1', 'true'),
+            dry_run=request.args.get('dry_run') in ('1', 'true')
+        )
+        return jsonify(summary)
+    except ProductDataError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/products', methods=['GET'])
+@login_required
+@conditional_view('product')
+def list_products():
+    filters = parse_product_filters(request.args)
+    try:
+        products, next_cursor = paginate_products(**filters)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'products': [product_to_dict(p) for p in products],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/products/search', methods=['GET'])
+@login_required
+def search_products_typeahead():
+    try:
+        limit = int(request.args.get('limit', app.config['SEARCH_TYPEAHEAD_LIMIT']))
+    except ValueError:
+        limit = app.config['SEARCH_TYPEAHEAD_LIMIT']
+    limit = max(1, min(limit, app.config['SEARCH_MAX_RESULTS']))
+    text = request.args.get('q', '')
+    rows, suggestion = search_products(text, limit)
+    return jsonify({
+        'query': text,
+        'suggestion': suggestion,
+        'products': [
+            {
+                'id': row.id,
+                'name': row.name,
+                'category': row.category,
+                'barcode': row.barcode,
+                'quantity': row.quantity,
+                'unit_price': row.unit_price
+            }
+            for row in rows
+        ]
+    })
+
 @app.route('/api/products/<int:product_id>', methods=['PUT'])
 @login_required
 def update_product(product_id):
@@ -202,13 +4124,16 @@ def update_product(product_id):
         product.category = data.get('category', product.category)
         product.description = data.get('description', product.description)
         product.unit_price = float(data.get('unit_price', product.unit_price))
-        product.reorder_level = int(data.get('reorder_level', product.reorder_level))
+        reorder_level = int(data.get('reorder_level', product.reorder_level))
+        if reorder_level != product.reorder_level:
+            follow_product_reorder_levels([{'id': product_id, 'reorder_level': reorder_level}])
+        product.reorder_level = reorder_level
         product.barcode = data.get('barcode', product.barcode)
-        
-        if data.get('expiry_date'):
-            product.expiry_date = datetime.strptime(data['expiry_date'], '%Y-%m-%d').date()
-        
+        # Quantity and expiry date follow the lots and are changed through
+        # stock movements, so both are ignored here
+
         db.session.commit()
+        products_changed.send(app, product_ids=[product_id])
         return jsonify({'message': 'Product updated successfully'})
     except Exception as e:
         db.session.rollback()
@@ -218,51 +4143,50 @@ def update_product(product_id):
 @login_required
 def update_stock(product_id):
     try:
-        product = Product.query.get_or_404(product_id)
         data = request.get_json()
         
-        # Validate input data
-        if not isinstance(data, dict):
-            return jsonify({'error': 'Invalid request data'}), 400
-            
-        if 'quantity' not in data or 'operation' not in data:
-            return jsonify({'error': 'Missing required fields'}), 400
-            
-        try:
-            quantity = int(data['quantity'])
-            if quantity <= 0:
-                return jsonify({'error': 'Quantity must be greater than 0'}), 400
-        except (ValueError, TypeError):
-            return jsonify({'error': 'Invalid quantity value'}), 400
-            
-        operation = str(data['operation']).strip().lower()
-        
-        if operation not in ['add', 'remove']:
-            return jsonify({'error': 'Invalid operation. Use "add" or "remove"'}), 400
-        
-        if operation == 'add':
-            product.quantity += quantity
-            transaction_type = 'in'
-        else:  # operation == 'remove'
-            if product.quantity < quantity:
-                return jsonify({'error': 'Insufficient stock'}), 400
-            product.quantity -= quantity
-            transaction_type = 'out'
-        
-        # Record transaction
-        transaction = Transaction(
-            product_id=product_id,
-            quantity=quantity,
-            transaction_type=transaction_type,
-            user_id=current_user.id
+        quantity, operation = parse_stock_line(data)
+        expiry_date, lot_number = parse_lot_fields(data)
+        location_id = location_param(data.get('location'))
+        transaction_type = 'in' if operation == 'add' else 'out'
+        new_quantity, lots, location_quantity = apply_stock_movement(
+            product_id, quantity, transaction_type, current_user.id, expiry_date, lot_number, location_id
         )
-        db.session.add(transaction)
-        db.session.commit()
         
         return jsonify({
             'message': f'Stock {operation}ed successfully',
-            'new_quantity': product.quantity
+            'new_quantity': new_quantity,
+            'location_id': location_id,
+            'location_quantity': location_quantity,
+            'lots': lots
+        })
+    except StockError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/stock/batch', methods=['POST'])
+@login_required
+def update_stock_batch():
+    try:
+        data = request.get_json()
+        lines = data.get('lines') if isinstance(data, dict) else data
+        if not isinstance(lines, list) or not lines:
+            return jsonify({'error': 'Expected a non-empty list of lines'}), 400
+        if len(lines) > app.config['MAX_STOCK_BATCH_LINES']:
+            return jsonify({'error': f"At most {app.config['MAX_STOCK_BATCH_LINES']} lines per batch"}), 400
+
+        location_id = location_param(data.get('location') if isinstance(data, dict) else None)
+        results = apply_stock_batch(lines, current_user.id, location_id)
+        applied = sum(1 for r in results if r['status'] == 'ok')
+        return jsonify({
+            'applied': applied,
+            'failed': len(results) - applied,
+            'results': results
         })
+    except StockError as e:
+        return jsonify({'error': str(e)}), e.status_code
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 400
@@ -273,39 +4197,226 @@ def delete_product(product_id):
     try:
         product = Product.query.get_or_404(product_id)
         
-        # Delete associated transactions first
-        Transaction.query.filter_by(product_id=product_id).delete()
+        # Delete associated live and archived transactions, rollups, lots and stock levels first
+        delete_transactions(db.session.connection(), 'product_id', product_id)
+        DailyProductMovement.query.filter_by(product_id=product_id).delete()
+        DailyLocationMovement.query.filter_by(product_id=product_id).delete()
+        ProductLot.query.filter_by(product_id=product_id).delete()
+        StockLevel.query.filter_by(product_id=product_id).delete()
         
         # Now delete the product
         db.session.delete(product)
         db.session.commit()
+        products_changed.send(app, product_ids=[product_id])
+        stock_changed.send(app, movements=None, changes=[])
         
         return jsonify({'message': 'Product deleted successfully'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 400
 
+@app.route('/api/products/<int:product_id>/lots', methods=['GET'])
+@login_required
+def list_product_lots(product_id):
+    Product.query.get_or_404(product_id)
+    query = db.session.query(
+        ProductLot.id, ProductLot.location_id, ProductLot.lot_number, ProductLot.expiry_date, ProductLot.quantity
+    ).filter(
+        ProductLot.product_id == product_id,
+        LOT_IN_STOCK
+    )
+    if request.args.get('location'):
+        try:
+            query = query.filter(ProductLot.location_id == resolve_location(request.args['location']))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 404
+    lots = query.order_by(ProductLot.expiry_date.asc().nulls_last(), ProductLot.id).all()
+    # In the order removals at each location will consume them
+    return jsonify({'lots': [
+        {
+            'lot_id': lot_id,
+            'location_id': location_id,
+            'lot_number': lot_number,
+            'expiry_date': expiry_date.strftime('%Y-%m-%d') if expiry_date else None,
+            'quantity': quantity
+        }
+        for lot_id, location_id, lot_number, expiry_date, quantity in lots
+    ]})
+
+@app.route('/api/locations', methods=['GET'])
+@login_required
+def list_locations():
+    # Low-stock counts for every location in one pass over ix_stock_level_low
+    low_stock = dict(db.session.query(StockLevel.location_id, db.func.count()).filter(
+        StockLevel.quantity <= StockLevel.reorder_level
+    ).group_by(StockLevel.location_id).all())
+    return jsonify({'locations': [
+        location_to_dict(location_id, low_stock.get(location_id, 0))
+        for location_id in get_locations(refresh=True)[0]
+    ]})
+
+@app.route('/api/locations', methods=['POST'])
+@login_required
+def add_location():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Only administrators can add locations'}), 403
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Invalid request data'}), 400
+    code = str(data.get('code') or '').strip()
+    name = str(data.get('name') or '').strip()
+    if not code or not name:
+        return jsonify({'error': 'Code and name are required'}), 400
+    if len(code) > 20 or len(name) > 100:
+        return jsonify({'error': 'Code is limited to 20 characters and name to 100'}), 400
+    try:
+        location = Location(code=code, name=name)
+        db.session.add(location)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'A location with this code already exists'}), 400
+    get_locations(refresh=True)
+    return jsonify(location_to_dict(location.id)), 201
+
+@app.route('/api/products/<int:product_id>/stock-levels', methods=['GET'])
+@login_required
+def list_stock_levels(product_id):
+    product = Product.query.get_or_404(product_id)
+    levels = db.session.query(StockLevel.location_id, StockLevel.quantity, StockLevel.reorder_level).filter(
+        StockLevel.product_id == product_id
+    ).order_by(StockLevel.location_id).all()
+    return jsonify({
+        'product_id': product_id,
+        'quantity': product.quantity,
+        'stock_levels': [
+            dict(location_to_dict(location_id), quantity=quantity, reorder_level=reorder_level,
+                 low_stock=quantity <= reorder_level)
+            for location_id, quantity, reorder_level in levels
+        ]
+    })
+
+@app.route('/api/products/<int:product_id>/stock-levels/<location>', methods=['PUT'])
+@login_required
+def set_stock_level_reorder(product_id, location):
+    try:
+        location_id = location_param(location)
+        data = request.get_json()
+        try:
+            reorder_level = int(data['reorder_level'])
+        except (KeyError, TypeError, ValueError):
+            raise StockError('Invalid reorder level')
+        if reorder_level < 0:
+            raise StockError('Reorder level cannot be negative')
+
+        table = StockLevel.__table__
+        update = db.update(table).where(
+            table.c.location_id == location_id,
+            table.c.product_id == product_id
+        ).values(reorder_level=reorder_level)
+        if not db.session.execute(update).rowcount:
+            if db.session.get(Product, product_id) is None:
+                raise StockError('Product not found', 404)
+            # A location that has not held the product yet
+            if not backfill_stock_levels(db.session, [product_id]) or not db.session.execute(update).rowcount:
+                db.session.execute(db.insert(table).values(
+                    location_id=location_id, product_id=product_id, quantity=0, reorder_level=reorder_level
+                ))
+        db.session.commit()
+        # Low-stock lists may gain or lose the product
+        stock_changed.send(app, movements=[], changes=[])
+        return jsonify({'message': 'Reorder level updated', 'location_id': location_id, 'reorder_level': reorder_level})
+    except StockError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/stock/transfer', methods=['POST'])
+@login_required
+def transfer_stock_between_locations():
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict):
+            raise StockError('Invalid request data')
+        if 'product_id' not in data or 'quantity' not in data or not data.get('from') or not data.get('to'):
+            raise StockError('Missing required fields')
+        try:
+            product_id = int(data['product_id'])
+            quantity = int(data['quantity'])
+        except (ValueError, TypeError):
+            raise StockError('Invalid product_id or quantity value')
+        if quantity <= 0:
+            raise StockError('Quantity must be greater than 0')
+
+        transfer = transfer_stock(
+            product_id, quantity, location_param(data['from']), location_param(data['to']), current_user.id
+        )
+        return jsonify(dict(transfer, message='Stock transferred successfully'))
+    except StockError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/stock/low', methods=['GET'])
+@login_required
+def list_low_stock_levels():
+    try:
+        location_id = resolve_location(request.args['location']) if request.args.get('location') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    try:
+        rows, next_cursor = low_stock_levels(location_id, request.args.get('cursor') or None, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'stock_levels': [
+            dict(location_to_dict(row.location_id), product_id=row.product_id, product_name=row.name,
+                 category=row.category, quantity=row.quantity, reorder_level=row.reorder_level)
+            for row in rows
+        ],
+        'next_cursor': next_cursor
+    })
+
 @app.route('/api/products/<int:product_id>/predict_restock', methods=['GET'])
 @login_required
 def predict_restock(product_id):
     try:
         product = Product.query.get_or_404(product_id)
+        location = request.args.get('location')
         
-        # Get last 30 days transactions
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        transactions = Transaction.query.filter(
-            Transaction.product_id == product_id,
-            Transaction.date >= thirty_days_ago
-        ).all()
+        # Sum the last 30 days of stock out from the daily rollup, the
+        # location's when one is given
+        thirty_days_ago = datetime.utcnow().date() - timedelta(days=29)
+        if location:
+            location_id = location_param(location)
+            rollup = DailyLocationMovement
+            scope = (DailyLocationMovement.location_id == location_id,)
+            level = db.session.query(StockLevel.quantity, StockLevel.reorder_level).filter(
+                StockLevel.location_id == location_id,
+                StockLevel.product_id == product_id
+            ).first()
+            current_stock, reorder_level = level if level else (0, product.reorder_level)
+        else:
+            rollup, scope = DailyProductMovement, ()
+            current_stock, reorder_level = product.quantity, product.reorder_level
+        total_out = db.session.query(
+            db.func.coalesce(db.func.sum(rollup.qty_out), 0)
+        ).filter(
+            *scope,
+            rollup.product_id == product_id,
+            rollup.day >= thirty_days_ago
+        ).scalar()
         
         # Calculate daily average consumption
-        total_out = sum(t.quantity for t in transactions if t.transaction_type == 'out')
         daily_avg = total_out / 30
         
         # Predict days until reorder level
         if daily_avg > 0:
-            current_stock = product.quantity
-            days_until_reorder = (current_stock - product.reorder_level) / daily_avg
+            days_until_reorder = (current_stock - reorder_level) / daily_avg
             suggested_order = math.ceil(daily_avg * 30)  # 30 days supply
             
             return jsonify({
@@ -318,51 +4429,115 @@ def predict_restock(product_id):
                 'message': 'Insufficient transaction data for prediction'
             })
             
+    except StockError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/reports/reorder', methods=['GET'])
+@login_required
+def get_reorder_report():
+    try:
+        sort = request.args.get('sort', 'days_until_reorder')
+        if sort not in REORDER_SORTS:
+            return jsonify({'error': f'Invalid sort. Use one of: {", ".join(REORDER_SORTS)}'}), 400
+        within = request.args.get('within', type=int)
+        limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+        offset = max(0, request.args.get('offset', 0, type=int))
+
+        forecast = get_restock_forecast()
+        rows = reorder_report(forecast, sort, within, request.args.get('category'))
+        return jsonify({
+            'generated_at': forecast['generated_at'].strftime('%Y-%m-%d %H:%M:%S'),
+            'total': len(rows),
+            'products': [reorder_row(forecast, i) for i in rows[offset:offset + limit]]
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
+@app.route('/api/analytics/valuation', methods=['GET'])
+@login_required
+def get_valuation_report():
+    return jsonify(valuation_report(inventory_analytics.get()))
+
+@app.route('/api/analytics/expiry-risk', methods=['GET'])
+@login_required
+def get_expiry_risk_report():
+    top = max(0, min(request.args.get('top', 20, type=int), 1000))
+    return jsonify(expiry_risk_report(inventory_analytics.get(), top))
+
+@app.route('/api/analytics/stock-aging', methods=['GET'])
+@login_required
+def get_stock_aging_report():
+    top = max(0, min(request.args.get('top', 20, type=int), 1000))
+    return jsonify(stock_aging_report(inventory_analytics.get(), top))
+
+@app.route('/api/analytics/turnover', methods=['GET'])
+@login_required
+def get_turnover_report():
+    sort = request.args.get('sort', 'days_of_cover')
+    if sort not in TURNOVER_SORTS:
+        return jsonify({'error': f'Invalid sort. Use one of: {", ".join(TURNOVER_SORTS)}'}), 400
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    return jsonify(turnover_report(
+        inventory_analytics.get(), sort, request.args.get('category'), limit, offset
+    ))
+
 @app.route('/api/products/barcode/<barcode>', methods=['GET'])
 @login_required
 def get_product_by_barcode(barcode):
     try:
-        product = Product.query.filter_by(barcode=barcode).first()
-        if product:
-            return jsonify({
-                'product': {
-                    'id': product.id,
-                    'name': product.name,
-                    'category': product.category,
-                    'description': product.description,
-                    'unit_price': product.unit_price,
-                    'quantity': product.quantity,
-                    'reorder_level': product.reorder_level,
-                    'barcode': product.barcode,
-                    'expiry_date': product.expiry_date.strftime('%Y-%m-%d') if product.expiry_date else None
-                }
-            })
+        entry = barcode_index.get(barcode)
+        if entry:
+            body, etag = entry
+            return conditional_json(f'{{"product":{body}}}', etag)
         return jsonify({'product': None})
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
+@app.route('/api/products/barcodes', methods=['GET', 'POST'])
+@login_required
+def get_products_by_barcodes():
+    # GET ?barcodes=a,b,c can be revalidated with If-None-Match; POST takes
+    # {"barcodes": [...]} for lists too long for a URL
+    try:
+        if request.method == 'GET':
+            barcodes = [b for b in request.args.get('barcodes', '').split(',') if b]
+        else:
+            data = request.get_json(silent=True)
+            barcodes = data.get('barcodes') if isinstance(data, dict) else data
+        if not isinstance(barcodes, list) or not barcodes:
+            return jsonify({'error': 'Expected a non-empty list of barcodes'}), 400
+        if len(barcodes) > app.config['SCANNER_MAX_BATCH']:
+            return jsonify({'error': f"At most {app.config['SCANNER_MAX_BATCH']} barcodes per request"}), 400
+
+        entries = barcode_index.get_many(list(dict.fromkeys(str(b) for b in barcodes)))
+        body = ','.join(
+            f'{json.dumps(barcode)}:{entry[0] if entry else "null"}' for barcode, entry in entries.items()
+        )
+        etag = hashlib.blake2b(
+            ''.join(f'{barcode}={entry[1] if entry else ""};' for barcode, entry in entries.items()).encode(),
+            digest_size=8
+        ).hexdigest()
+        return conditional_json(f'{{"products":{{{body}}}}}', etag)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/api/products/barcode/<barcode>/info', methods=['GET'])
 @login_required
 def get_product_info_by_barcode(barcode):
     try:
-        # Fetch product information from Open Food Facts API
-        response = requests.get(f'https://world.openfoodfacts.org/api/v0/product/{barcode}.json')
-        data = response.json()
+        if request.args.get('async') in ('1', 'true'):
+            params = {'barcodes': [barcode], 'refresh': request.args.get('refresh') in ('1', 'true')}
+            return job_accepted(submit_job('barcode_info', params, current_user.id))
+        # Fetch product information from the cache or Open Food Facts API
+        found, product = lookup_barcode_info(barcode)
         
-        if data['status'] == 1 and data['product']:
-            product_data = data['product']
+        if found:
             return jsonify({
                 'success': True,
-                'product': {
-                    'name': product_data.get('product_name', ''),
-                    'category': product_data.get('categories', ''),
-                    'description': product_data.get('generic_name', ''),
-                    'brand': product_data.get('brands', ''),
-                    'image_url': product_data.get('image_url', '')
-                }
+                'product': product
             })
         
         return jsonify({
@@ -370,6 +4545,11 @@ def get_product_info_by_barcode(barcode):
             'message': 'Product not found in database'
         })
         
+    except BarcodeLookupError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 502
     except Exception as e:
         return jsonify({
             'success': False,
@@ -378,177 +4558,421 @@ def get_product_info_by_barcode(barcode):
 
 @app.route('/dashboard')
 @login_required
+@conditional_view('product', 'transaction')
 def dashboard():
-    today = datetime.now().date()
-    thirty_days_ago = today - timedelta(days=30)
-    
-    # Get summary statistics
-    total_products = Product.query.count()
-    low_stock_products = Product.query.filter(Product.quantity <= Product.reorder_level).all()
-    low_stock_count = len(low_stock_products)
-    expiring_soon_count = Product.query.filter(
-        Product.expiry_date <= today + timedelta(days=30),
-        Product.expiry_date > today
-    ).count()
-    todays_transactions = Transaction.query.filter(
-        Transaction.date >= today
-    ).count()
-    
-    # Get category statistics
-    categories = db.session.query(Product.category, db.func.count(Product.id)).group_by(Product.category).all()
-    category_labels = [c[0] for c in categories]
-    category_data = [c[1] for c in categories]
-    
-    # Get transaction history
-    transaction_history = db.session.query(
-        Transaction.date,  # Use Transaction.date directly instead of db.func.date()
-        db.func.count(Transaction.id)
-    ).filter(
-        Transaction.date >= thirty_days_ago
-    ).group_by(
-        db.func.date(Transaction.date)  # Keep the grouping by date
-    ).all()
-    
-    transaction_dates = [t[0].strftime('%Y-%m-%d') for t in transaction_history]
-    transaction_counts = [t[1] for t in transaction_history]
-    
-    return render_template('dashboard.html',
-        total_products=total_products,
-        low_stock_count=low_stock_count,
-        expiring_soon_count=expiring_soon_count,
-        todays_transactions=todays_transactions,
-        low_stock_products=low_stock_products,
-        category_labels=category_labels,
-        category_data=category_data,
-        transaction_dates=transaction_dates,
-        transaction_counts=transaction_counts
+    location = None
+    if request.args.get('location'):
+        try:
+            location = location_to_dict(resolve_location(request.args['location']))
+        except ValueError:
+            flash('Unknown location', 'danger')
+    return render_template('dashboard.html', location=location,
+                           **get_dashboard_metrics(location['id'] if location else None))
+
+@app.route('/api/alerts/stream')
+@login_required
+def alert_stream():
+    start_expiry_sweeper()
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or alert_broker.last_id)
+    except ValueError:
+        last_id = alert_broker.last_id
+    # An ID from before a restart or from another worker can be ahead of this
+    # broker; resume from its newest event rather than skip the next ones
+    last_id = min(last_id, alert_broker.last_id)
+    # Not wrapped in stream_with_context: the request context (and its database
+    # session) is released once headers are sent, so idle clients hold no connection
+    return Response(format_alert_stream(last_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/dashboard/metrics')
+@login_required
+def dashboard_metrics():
+    location_id = None
+    if request.args.get('location'):
+        try:
+            location_id = resolve_location(request.args['location'])
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 404
+    metrics = get_dashboard_metrics(location_id)
+    metrics['location_id'] = location_id
+    metrics['cache'] = metrics_cache.stats()
+    metrics['scanner_cache'] = barcode_index.stats()
+    metrics['user_cache'] = user_cache.stats()
+    metrics['search_vocabulary'] = search_vocabulary.stats()
+    metrics['analytics'] = inventory_analytics.stats()
+    metrics['fragment_cache'] = product_table_fragments.stats()
+    return jsonify(metrics)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    elif not current_user.is_authenticated:
+        # Without a token, only logged-in administrators see the metrics
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    elif current_user.role != 'admin':
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    lines = request_metrics.render()
+    caches = {
+        'dashboard': metrics_cache, 'scanner': barcode_index, 'user': user_cache, 'search': search_vocabulary,
+        'analytics': inventory_analytics, 'fragment': product_table_fragments
+    }
+    for field, kind, description in (
+        ('hits', 'counter', 'Cache hits.'),
+        ('misses', 'counter', 'Cache misses.'),
+        ('entries', 'gauge', 'Entries currently cached.')
+    ):
+        name = f'app_cache_{field}_total' if kind == 'counter' else f'app_cache_{field}'
+        lines.extend([f'# HELP {name} {description}', f'# TYPE {name} {kind}'])
+        lines.extend(f'{name}{{cache="{cache}"}} {c.stats()[field]}' for cache, c in caches.items())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+def get_visible_job(job_id):
+    job = db.session.get(Job, job_id)
+    if job is None or (job.user_id != current_user.id and current_user.role != 'admin'):
+        return None
+    return job
+
+@app.route('/api/jobs', methods=['POST'])
+@login_required
+def create_job():
+    # JSON {"kind": ..., "params": {...}}, or a multipart form with kind,
+    # a file and the params as fields for jobs that take an upload
+    try:
+        if request.files:
+            upload = request.files.get('file')
+            kind = request.form.get('kind')
+            params = {key: value for key, value in request.form.items() if key != 'kind'}
+            params['filename'] = upload.filename if upload else None
+            job = submit_job(kind, params, current_user.id, upload.stream if upload else None)
+        else:
+            data = request.get_json(silent=True) or {}
+            params = data.get('params') or {}
+            if not isinstance(params, dict):
+                return jsonify({'error': 'params must be an object'}), 400
+            job = submit_job(data.get('kind'), params, current_user.id)
+        return job_accepted(job)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/jobs', methods=['GET'])
+@login_required
+def list_jobs():
+    job_runner.start()
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    query = Job.query
+    if current_user.role != 'admin' or request.args.get('all') not in ('1', 'true'):
+        query = query.filter(Job.user_id == current_user.id)
+    status = request.args.get('status')
+    if status:
+        if status not in JOB_STATUSES:
+            return jsonify({'error': f'Invalid status. Use one of: {", ".join(JOB_STATUSES)}'}), 400
+        query = query.filter(Job.status == status)
+    jobs = query.order_by(Job.created_at.desc()).limit(limit).all()
+    return jsonify({'jobs': [job_to_dict(job) for job in jobs]})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    job_runner.start()
+    job = get_visible_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job_to_dict(job))
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    job = get_visible_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status in ('queued', 'running'):
+        job_runner.cancel(job_id)
+        db.session.expire(job)
+    return jsonify(job_to_dict(job))
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+@login_required
+def download_job_result(job_id):
+    job = get_visible_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job.status != 'succeeded':
+        return jsonify({'error': f'Job is {job.status}'}), 409
+    if not job.result_file:
+        return jsonify(json.loads(job.result) if job.result else {})
+    path = os.path.join(job_directory(job.id), job.result_file)
+    if not os.path.exists(path):
+        return jsonify({'error': 'Result file has expired'}), 410
+    return send_file(
+        path,
+        mimetype='application/gzip' if job.result_file.endswith('.gz') else 'text/csv',
+        as_attachment=True,
+        download_name=job.result_file
+    )
+
+def parse_transaction_filters(args):
+    """Parse the transactions page filters (date range, type, product, location).
+
+    ``date`` selects the today/week/month presets; explicit ``from``/``to``
+    dates (YYYY-MM-DD, inclusive) take precedence over the preset. The date
+    range comes back as [start, end) datetimes, either of which may be None.
+    ``location`` is a location code or id; without it every location is
+    listed. Raises ValueError on malformed input or an unknown location.
+    """
+    date_range = args.get('date', 'month')
+    transaction_type = args.get('type', 'all')
+    product_id = args.get('product', 'all')
+    date_from = args.get('from')
+    date_to = args.get('to')
+
+    # Date filter, as a range so it can use the date indexes
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    start = end = None
+    if date_from or date_to:
+        if date_from:
+            start = datetime.strptime(date_from, '%Y-%m-%d')
+        if date_to:
+            end = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)
+    elif date_range == 'today':
+        start, end = today, today + timedelta(days=1)
+    elif date_range == 'week':
+        start = today - timedelta(days=7)
+    elif date_range == 'month':
+        start = today - timedelta(days=30)
+
+    return {
+        'start': start,
+        'end': end,
+        'type': transaction_type if transaction_type != 'all' else None,
+        'product_id': int(product_id) if product_id != 'all' else None,
+        'location_id': resolve_location(args['location']) if args.get('location') else None
+    }
+
+def apply_transaction_filters(query, filters, columns=None):
+    """Apply parsed transaction filters to a query over the live table or an archive table."""
+    c = columns if columns is not None else Transaction.__table__.c
+    if filters['start']:
+        query = query.filter(c.date >= filters['start'])
+    if filters['end']:
+        query = query.filter(c.date < filters['end'])
+    if filters['type']:
+        query = query.filter(c.transaction_type == filters['type'])
+    if filters['product_id'] is not None:
+        query = query.filter(c.product_id == filters['product_id'])
+    if filters['location_id'] is not None:
+        query = query.filter(c.location_id == filters['location_id'])
+    return query
+
+# Product id/name pairs for filter dropdowns, refreshed after PRODUCT_CHOICES_TTL
+# seconds or as soon as this process adds, renames or deletes a product.
+_product_choices = {'expires': 0, 'items': []}
+
+def get_product_choices():
+    if time.monotonic() >= _product_choices['expires']:
+        items = db.session.query(Product.id, Product.name).order_by(Product.name).all()
+        _product_choices['items'] = [(pid, name) for pid, name in items]
+        _product_choices['expires'] = time.monotonic() + app.config['PRODUCT_CHOICES_TTL']
+    return _product_choices['items']
+
+@products_changed.connect
+def invalidate_product_choices(sender=None, **kwargs):
+    _product_choices['expires'] = 0
+
+def transaction_page(table, filters, after=None, limit=50):
+    """Select one page of a transaction source, newest first, with product and user names.
+
+    The page is cut from the transaction table alone and only then joined,
+    so the planner walks the date index instead of sorting every matching
+    row. ``after`` is the (date, id) key of the last row already listed.
+    """
+    c = table.c
+    page = apply_transaction_filters(
+        db.select(c.id, c.date, c.quantity, c.transaction_type, c.product_id, c.user_id), filters, c
     )
+    if after:
+        page = page.where(db.tuple_(c.date, c.id) < db.tuple_(*after))
+    page = page.order_by(c.date.desc(), c.id.desc()).limit(limit).subquery()
+    return db.select(
+        page.c.id,
+        page.c.date,
+        page.c.quantity,
+        page.c.transaction_type,
+        Product.name.label('product_name'),
+        User.username
+    ).join(Product, page.c.product_id == Product.id).join(User, page.c.user_id == User.id).order_by(
+        page.c.date.desc(), page.c.id.desc()
+    )
+
+def paginate_transactions(args, cursor=None, limit=50):
+    """Return one page of transaction rows, newest first, and the next cursor.
+
+    Rows are plain column tuples (no ORM objects, so no lazy loads), and pages
+    seek on (date desc, id desc) instead of using OFFSET. A page is read from
+    the live table and, only when that runs out, from the archive months in
+    the filtered date range.
+    """
+    filters = parse_transaction_filters(args)
+    end, after = filters['end'], None
+    if cursor:
+        key, last_id = decode_cursor('transactions', cursor)
+        if not isinstance(key, str):
+            raise ValueError('Invalid cursor')
+        after = (datetime.fromisoformat(key), last_id)
+        # Months newer than the cursor cannot hold the rest of the listing
+        cursor_end = after[0] + timedelta(microseconds=1)
+        end = min(end, cursor_end) if end else cursor_end
+
+    rows = []
+    for table in transaction_sources(db.session, filters['start'], end):
+        rows.extend(db.session.execute(transaction_page(table, filters, after, limit + 1 - len(rows))).all())
+        if len(rows) > limit:
+            break
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor('transactions', rows[-1].date.isoformat(), rows[-1].id)
+    return rows, next_cursor
 
 @app.route('/transactions')
 @login_required
+@conditional_view('transaction', 'product', 'user')
 def transactions():
-    # Get filter parameters
-    date_range = request.args.get('date', 'month')
-    transaction_type = request.args.get('type', 'all')
-    product_id = request.args.get('product', 'all')
-    
-    # Base query
-    query = Transaction.query.join(Product).join(User)  # Join with related tables
-    
-    # Apply date filter
-    today = datetime.now().date()
-    if date_range == 'today':
-        query = query.filter(db.func.date(Transaction.date) == today)
-    elif date_range == 'week':
-        week_ago = today - timedelta(days=7)
-        query = query.filter(Transaction.date >= week_ago)
-    elif date_range == 'month':
-        month_ago = today - timedelta(days=30)
-        query = query.filter(Transaction.date >= month_ago)
-    
-    # Apply type filter
-    if transaction_type != 'all':
-        query = query.filter(Transaction.transaction_type == transaction_type)
-    
-    # Apply product filter
-    if product_id != 'all':
-        query = query.filter(Transaction.product_id == int(product_id))
-    
-    # Get transactions with related data
-    transactions = query.order_by(Transaction.date.desc()).all()
-    products = Product.query.all()
+    limit = app.config['TRANSACTIONS_PER_PAGE']
+    cursor = request.args.get('cursor') or None
+    try:
+        transactions, next_cursor = paginate_transactions(request.args, cursor, limit)
+    except ValueError:
+        flash('Invalid filter values', 'danger')
+        transactions, next_cursor = paginate_transactions({}, None, limit)
     
     return render_template('transactions.html',
         transactions=transactions,
-        products=products
+        products=get_product_choices(),
+        locations=get_locations()[0],
+        next_cursor=next_cursor
     )
 
+def stream_transactions_csv(statements, compress=False, progress=None):
+    """Yield the export CSV in chunks without materialising the result set.
+
+    ``statements(conn)`` yields the statements to export, in order. Rows are
+    fetched from a server-side cursor in ``EXPORT_CHUNK_SIZE`` partitions and
+    each partition is written out as one chunk, optionally gzip-compressed on
+    the fly. All statements run on one connection, so an export sees one
+    snapshot even while months are being archived. ``progress(rows)`` is
+    called with the size of each partition once it is written.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    # Write header
+    writer.writerow(['Date', 'Product', 'Quantity', 'Type', 'User'])
+    yield flush()
+
+    with db.engine.connect() as conn:
+        for stmt in statements(conn):
+            result = conn.execution_options(
+                stream_results=True,
+                yield_per=app.config['EXPORT_CHUNK_SIZE']
+            ).execute(stmt)
+            for rows in result.partitions():
+                writer.writerows(
+                    (tx_date.isoformat(sep=' ', timespec='seconds'), name, quantity, transaction_type, username)
+                    for tx_date, name, quantity, transaction_type, username in rows
+                )
+                if progress:
+                    progress(len(rows))
+                chunk = flush()
+                if chunk:
+                    yield chunk
+
+    if compressor:
+        yield compressor.flush()
+
+def export_statements(filters):
+    """The ``statements(conn)`` callable for stream_transactions_csv, for parsed filters."""
+    def statements(conn):
+        # Select only the exported columns instead of ORM objects
+        for table in transaction_sources(conn, filters['start'], filters['end']):
+            c = table.c
+            stmt = db.select(
+                c.date,
+                Product.name,
+                c.quantity,
+                c.transaction_type,
+                User.username
+            ).join(Product, c.product_id == Product.id).join(User, c.user_id == User.id)
+            stmt = apply_transaction_filters(stmt, filters, c)
+            yield stmt.order_by(c.date.desc(), c.id.desc())
+    return statements
+
+def export_filename(compress):
+    filename = f'transactions_{datetime.now().strftime("%Y%m%d")}.csv'
+    return f'{filename}.gz' if compress else filename
+
 @app.route('/transactions/export')
 @login_required
 def export_transactions():
     try:
-        # Get filter parameters
-        date_range = request.args.get('date', 'month')
-        transaction_type = request.args.get('type', 'all')
-        product_id = request.args.get('product', 'all')
-        
-        # Base query
-        query = Transaction.query.join(Product).join(User)
+        if request.args.get('async') in ('1', 'true'):
+            params = {key: value for key, value in request.args.items() if key != 'async'}
+            return job_accepted(submit_job('export_transactions', params, current_user.id))
+        filters = parse_transaction_filters(request.args)
+        statements = export_statements(filters)
+        compress = request.args.get('gzip') in ('1', 'true')
+        filename = export_filename(compress)
+        headers = {'Content-Disposition': f'attachment; filename={filename}'}
         
-        # Apply date filter
-        today = datetime.now().date()
-        if date_range == 'today':
-            query = query.filter(db.func.date(Transaction.date) == today)
-        elif date_range == 'week':
-            week_ago = today - timedelta(days=7)
-            query = query.filter(Transaction.date >= week_ago)
-        elif date_range == 'month':
-            month_ago = today - timedelta(days=30)
-            query = query.filter(Transaction.date >= month_ago)
-        
-        # Apply type filter
-        if transaction_type != 'all':
-            query = query.filter(Transaction.transaction_type == transaction_type)
-        
-        # Apply product filter
-        if product_id != 'all':
-            query = query.filter(Transaction.product_id == int(product_id))
-        
-        # Get transactions
-        transactions = query.order_by(Transaction.date.desc()).all()
-        
-        # Create CSV
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Write header
-        writer.writerow(['Date', 'Product', 'Quantity', 'Type', 'User'])
-        
-        # Write data
-        for t in transactions:
-            writer.writerow([
-                t.date.strftime('%Y-%m-%d %H:%M:%S'),
-                t.product.name,
-                t.quantity,
-                t.transaction_type,
-                t.user.username
-            ])
-        
-        # Create response
-        output.seek(0)
-        return make_response(
-            output.getvalue(),
-            200,
-            {
-                'Content-Type': 'text/csv',
-                'Content-Disposition': f'attachment; filename=transactions_{datetime.now().strftime("%Y%m%d")}.csv'
-            }
+        return Response(
+            stream_with_context(stream_transactions_csv(statements, compress)),
+            mimetype='application/gzip' if compress else 'text/csv',
+            headers=headers
         )
         
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
-def reset_admin():
-    # Delete existing admin user and their transactions
+# Setup and startup
+#
+# Starting the app does no schema or data work, so a restart costs an import
+# and nothing else. The database is created or migrated and the admin user
+# added by the init-db command, sample products by seed-sample-data; both can
+# be run again safely.
+def reset_admin(password='admin123', only_if_missing=False):
+    """Create the admin user or reset its password and role. Returns whether anything changed.
+
+    An existing admin keeps its id, so its transactions stay attributed to it.
+    """
     admin = User.query.filter_by(username='admin').first()
-    if admin:
-        Transaction.query.filter_by(user_id=admin.id).delete()
-        db.session.delete(admin)
-        db.session.commit()
-    
-    # Create new admin user
-    admin = User(
-        username='admin',
-        role='admin'
-    )
-    admin.set_password('admin123')
-    db.session.add(admin)
+    if admin is not None and only_if_missing:
+        return False
+    if admin is None:
+        admin = User(username='admin')
+        db.session.add(admin)
+    admin.role = 'admin'
+    admin.set_password(password)
     db.session.commit()
+    user_cache.invalidate()
+    return True
 
 def create_sample_products():
-    # First check if products already exist
-    if Product.query.count() > 0:
-        return
+    """Add the sample products to an empty catalogue. Returns the number added."""
+    if db.session.query(Product.id).limit(1).first() is not None:
+        return 0
 
     sample_products = [
         {
@@ -604,26 +5028,67 @@ def create_sample_products():
     ]
     
     for product_data in sample_products:
-        # Check if product with this barcode already exists
-        existing_product = Product.query.filter_by(barcode=product_data['barcode']).first()
-        if not existing_product:
-            product = Product(**product_data)
-            db.session.add(product)
-    
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
+        product = Product(**product_data)
+        product.lots.append(ProductLot(quantity=product.quantity, expiry_date=product.expiry_date))
+        db.session.add(product)
+    db.session.flush()
+    backfill_stock_levels(db.session)
+    db.session.commit()
+    products_changed.send(app, product_ids=None)
+    return len(sample_products)
 
-if __name__ == '__main__':
-    # Delete the database file if it exists
-    if os.path.exists('pharmacy.db'):
-        os.remove('pharmacy.db')
-    
+@app.cli.command('init-db')
+@click.option('--admin-password', default='admin123', show_default=True,
+              help='Password for the admin user, if it has to be created')
+@click.option('--sample-data', is_flag=True, help='Also add the sample products to an empty catalogue')
+def init_db_command(admin_password, sample_data):
+    """Create or migrate the database and add the admin user if missing. Safe to run repeatedly."""
+    for version, description in upgrade_database():
+        print(f'Applied migration {version}: {description}')
+    if reset_admin(admin_password, only_if_missing=True):
+        print('Created admin user')
+    if sample_data:
+        print(f'Added {create_sample_products()} sample products')
+
+@app.cli.command('seed-sample-data')
+def seed_sample_data_command():
+    """Add the sample products if the catalogue is empty."""
+    print(f'Added {create_sample_products()} sample products')
+
+@app.cli.command('reset-admin')
+@click.password_option(help='New password for the admin user')
+def reset_admin_command(password):
+    """Reset the admin user's password and role, creating the user if missing."""
+    reset_admin(password)
+    print('Admin user reset')
+
+def check_app():
+    """Check the database schema and return the module-level application.
+
+    This is not an application factory: config, extensions and routes are
+    bound to ``app`` when this module is imported, and every call returns
+    that same object. WSGI servers can load it with ``gunicorn
+    'app:check_app()'`` to get the check, or ``gunicorn app:app`` without.
+
+    Reads the schema version and logs a warning when the database needs
+    init-db or upgrade-db, but never changes it.
+    """
+    latest = MIGRATIONS[-1][0] if MIGRATIONS else 0
     with app.app_context():
-        db.create_all()
-        reset_admin()
-        create_sample_products()
-    
+        try:
+            with db.engine.connect() as conn:
+                version = get_schema_version(conn)
+        except OperationalError as e:
+            app.logger.warning('Could not read the database schema version: %s', e)
+            return app
+    if version is None:
+        app.logger.warning('The database has no schema yet; run "flask --app app init-db"')
+    elif version < latest:
+        app.logger.warning('Database schema is at version %s, the app needs %s; run "flask --app app upgrade-db"',
+                           version, latest)
+    return app
+
+if __name__ == '__main__':
+    check_app()
     print("Starting server at http://127.0.0.1:5000")
-    app.run(host='127.0.0.1', port=5000, debug=False) 
\ No newline at end of file
+    app.run(host='127.0.0.1', port=5000, debug=False)
@@ -0,0 +1,158 @@
+"""Compare heavy requests run inline against the same work run as background jobs.
+
+Seeds a scratch database with a transaction history, then for a full CSV
+export and a catalogue-wide reorder report measures how long the inline
+request holds a worker, and for the job version how long the submit request
+takes, how long the job runs and how long the result download takes. A probe
+thread keeps requesting a cheap endpoint throughout, to show the latency
+other users see while each heavy operation is in progress.
+
+    python benchmarks/background_jobs.py --products 5000 --transactions 1000000
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'background_jobs.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+os.environ['JOB_RESULTS_DIR'] = os.path.join(os.path.dirname(DB_PATH), 'jobs')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db, User, Product, Transaction, rebuild_daily_movements, upgrade_database  # noqa: E402
+
+OPERATIONS = [
+    ('full export', '/transactions/export?date=all', {'kind': 'export_transactions', 'params': {'date': 'all'}}),
+    ('reorder report', '/api/reports/reorder?within=60', {'kind': 'reorder_report', 'params': {'within': 60}}),
+]
+PROBE_URL = '/api/products?limit=20'
+
+
+def seed(products, transactions, days):
+    rng = np.random.default_rng(0)
+    now = datetime.utcnow()
+    with app.app_context():
+        upgrade_database()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.execute(db.insert(Product), [
+            {'name': f'Product {i:05d}', 'unit_price': 1.0, 'quantity': 100, 'reorder_level': 10}
+            for i in range(products)
+        ])
+        db.session.commit()
+        chunk = 200000
+        for start in range(0, transactions, chunk):
+            n = min(chunk, transactions - start)
+            offsets = np.sort(rng.random(n)) * chunk / transactions + start / transactions
+            stamps = (np.datetime64(now, 'us') - ((1 - offsets) * days * 86400e6).astype('timedelta64[us]')).tolist()
+            with db.engine.begin() as conn:
+                conn.execute(db.insert(Transaction), [
+                    {'product_id': p, 'quantity': 1, 'transaction_type': t, 'date': d, 'user_id': user.id}
+                    for p, t, d in zip(
+                        rng.integers(1, products + 1, n).tolist(),
+                        np.where(rng.random(n) < 0.2, 'in', 'out').tolist(),
+                        stamps
+                    )
+                ])
+        with db.engine.begin() as conn:
+            rebuild_daily_movements(conn)
+            conn.execute(db.text('ANALYZE'))
+
+
+def login():
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    return client
+
+
+class Probe:
+    """Requests PROBE_URL in a loop on its own client, recording latencies."""
+
+    def __init__(self):
+        self.client = login()
+        self.timings = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.perf_counter()
+            self.client.get(PROBE_URL)
+            self.timings.append(time.perf_counter() - start)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def p95_ms(self):
+        if len(self.timings) < 2:
+            return float('nan')
+        return statistics.quantiles(self.timings, n=20)[-1] * 1000
+
+
+def run_inline(client, url):
+    with Probe() as probe:
+        start = time.perf_counter()
+        response = client.get(url)
+        size = len(response.get_data())
+        elapsed = time.perf_counter() - start
+    assert response.status_code == 200, (url, response.status_code)
+    return elapsed * 1000, size, probe.p95_ms()
+
+
+def run_job(client, body):
+    with Probe() as probe:
+        start = time.perf_counter()
+        response = client.post('/api/jobs', json=body)
+        submit = time.perf_counter() - start
+        assert response.status_code == 202, response.get_json()
+        location = response.headers['Location']
+        while True:
+            job = client.get(location).get_json()
+            if job['status'] not in ('queued', 'running'):
+                break
+            time.sleep(0.02)
+        finished = time.perf_counter() - start
+    assert job['status'] == 'succeeded', job
+    start = time.perf_counter()
+    size = len(client.get(job['result_url']).get_data())
+    download = time.perf_counter() - start
+    return submit * 1000, finished * 1000, download * 1000, size, probe.p95_ms()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=365)
+    args = parser.parse_args()
+
+    seed(args.products, args.transactions, args.days)
+    client = login()
+    with Probe() as idle:
+        time.sleep(1)
+    print(f'{PROBE_URL} p95 with nothing else running: {idle.p95_ms():.2f} ms\n')
+
+    print(f"{'operation':<16} {'mode':<7} {'request ms':>11} {'done ms':>9} {'download ms':>12} "
+          f"{'bytes':>11} {'probe p95 ms':>13}")
+    for label, url, body in OPERATIONS:
+        request_ms, size, probe = run_inline(client, url)
+        print(f"{label:<16} {'inline':<7} {request_ms:>11.1f} {request_ms:>9.1f} {'':>12} {size:>11,} {probe:>13.2f}")
+        submit_ms, done_ms, download_ms, size, probe = run_job(client, body)
+        print(f"{label:<16} {'job':<7} {submit_ms:>11.1f} {done_ms:>9.1f} {download_ms:>12.1f} "
+              f"{size:>11,} {probe:>13.2f}")
+
+
+if __name__ == '__main__':
+    main()
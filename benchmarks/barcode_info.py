@@ -0,0 +1,238 @@
+"""Check the barcode lookup client and cache against a local stub server.
+
+Starts a stub of the external barcode database on 127.0.0.1, points
+BARCODE_INFO_URL at it and checks that:
+
+  hit cached        a found barcode is fetched upstream once, then served
+                    from the barcode_lookup table
+  miss cached       a 404 is cached as a miss until BARCODE_INFO_MISS_TTL
+  timeout           a response slower than BARCODE_INFO_TIMEOUT raises
+                    BarcodeLookupError (502 from the endpoint) and is not cached
+  coalesced         concurrent lookups of one barcode make one upstream request
+  prewarm           prewarm_barcode_info counts hits, misses and errors and
+                    keeps at most --workers requests in flight
+
+Exits non-zero if any check fails.
+
+    python benchmarks/barcode_info.py
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'barcode_info.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Read timeout for the client; the stub's slow answers take three times as long
+READ_TIMEOUT = 0.5
+
+
+class Upstream:
+    """Request log and in-flight high-water mark of the stub server."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.inflight = 0
+        self.max_inflight = 0
+
+    def reset(self):
+        # Let answers the client stopped waiting for finish first
+        deadline = time.monotonic() + READ_TIMEOUT * 4
+        while self.inflight and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self.lock:
+            self.requests = {}
+            self.max_inflight = 0
+
+    def count(self, barcode):
+        with self.lock:
+            return self.requests.get(barcode, 0)
+
+
+upstream = Upstream()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Barcodes starting with "miss" are unknown, "slow" answer after the read
+    # timeout, "fail" answer 500 and "wait" take a moment, to overlap requests
+    def do_GET(self):
+        barcode = self.path.rsplit('/', 1)[-1].split('.', 1)[0]
+        with upstream.lock:
+            upstream.requests[barcode] = upstream.requests.get(barcode, 0) + 1
+            upstream.inflight += 1
+            upstream.max_inflight = max(upstream.max_inflight, upstream.inflight)
+        try:
+            if barcode.startswith('slow'):
+                time.sleep(READ_TIMEOUT * 3)
+            elif barcode.startswith('wait'):
+                time.sleep(0.2)
+            if barcode.startswith('miss'):
+                self.reply(404, {'status': 0})
+            elif barcode.startswith('fail'):
+                self.reply(500, {'status': 0})
+            else:
+                self.reply(200, {'status': 1, 'product': {'product_name': f'Product {barcode}', 'brands': 'Stub'}})
+        finally:
+            with upstream.lock:
+                upstream.inflight -= 1
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up waiting
+
+    def log_message(self, format, *args):
+        pass
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+os.environ['BARCODE_INFO_URL'] = f'http://127.0.0.1:{server.server_port}/api/v0/product/{{barcode}}.json'
+
+from app import (  # noqa: E402
+    app, db, User, BarcodeLookup, BarcodeLookupError, lookup_barcode_info, prewarm_barcode_info
+)
+
+
+def seed():
+    app.config['BARCODE_INFO_TIMEOUT'] = (READ_TIMEOUT, READ_TIMEOUT)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.commit()
+
+
+def cached(barcode):
+    with app.app_context():
+        return db.session.get(BarcodeLookup, barcode)
+
+
+def check_hit_cached(client):
+    with app.app_context():
+        first = lookup_barcode_info('100')
+        second = lookup_barcode_info('100')
+    response = client.get('/api/products/barcode/100/info')
+    assert first == second == (True, first[1]) and first[1]['name'] == 'Product 100', (first, second)
+    assert response.status_code == 200 and response.get_json()['success'], response.get_json()
+    assert upstream.count('100') == 1, f"{upstream.count('100')} upstream requests"
+    assert cached('100').found
+
+
+def check_miss_cached(client):
+    with app.app_context():
+        assert lookup_barcode_info('miss1') == (False, None)
+        assert lookup_barcode_info('miss1') == (False, None)
+        assert upstream.count('miss1') == 1, f"{upstream.count('miss1')} upstream requests before expiry"
+        # Age the miss and an older hit past the miss TTL: only the miss is fetched again
+        lookup_barcode_info('101')
+        for barcode in ('miss1', '101'):
+            lookup = db.session.get(BarcodeLookup, barcode)
+            lookup.fetched_at -= app.config['BARCODE_INFO_MISS_TTL'] + timedelta(minutes=1)
+        db.session.commit()
+        assert lookup_barcode_info('miss1') == (False, None)
+        assert lookup_barcode_info('101')[0]
+    assert upstream.count('miss1') == 2, f"{upstream.count('miss1')} upstream requests after expiry"
+    assert upstream.count('101') == 1, f"{upstream.count('101')} upstream requests for a hit within its TTL"
+    assert client.get('/api/products/barcode/miss1/info').get_json()['success'] is False
+
+
+def check_timeout(client):
+    with app.app_context():
+        start = time.perf_counter()
+        try:
+            lookup_barcode_info('slow1')
+        except BarcodeLookupError:
+            pass
+        else:
+            raise AssertionError('no BarcodeLookupError')
+        elapsed = time.perf_counter() - start
+    assert elapsed < READ_TIMEOUT * 2.5, f'took {elapsed:.2f}s'
+    response = client.get('/api/products/barcode/slow1/info')
+    assert response.status_code == 502, response.status_code
+    assert cached('slow1') is None, 'timeout was cached'
+    assert upstream.count('slow1') == 2, f"{upstream.count('slow1')} upstream requests"
+
+
+def check_coalesced(client, lookups=20):
+    results = []
+    barrier = threading.Barrier(lookups)
+
+    def lookup():
+        with app.app_context():
+            barrier.wait()
+            results.append(lookup_barcode_info('wait1'))
+
+    threads = [threading.Thread(target=lookup) for _ in range(lookups)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == lookups and all(found for found, _ in results), results
+    assert upstream.count('wait1') == 1, f"{upstream.count('wait1')} upstream requests for {lookups} lookups"
+
+
+def check_prewarm(client, workers):
+    hits = [f'wait{i}' for i in range(10, 22)]
+    misses = [f'missw{i}' for i in range(6)]
+    failures = [f'fail{i}' for i in range(3)]
+    with app.app_context():
+        lookup_barcode_info('102')
+    upstream.reset()
+    barcodes = hits + misses + failures + hits[:3] + ['102', '']
+    with app.app_context():
+        counts = prewarm_barcode_info(barcodes, workers)
+    assert counts == (len(hits), len(misses), len(failures)), counts
+    assert upstream.count('102') == 0, 'a fresh cached barcode was fetched again'
+    assert all(upstream.count(b) == 1 for b in hits + misses + failures), upstream.requests
+    assert upstream.max_inflight <= workers, f'{upstream.max_inflight} concurrent requests for {workers} workers'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=3, help='prewarm workers')
+    args = parser.parse_args()
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    seed()
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+
+    checks = [
+        ('hit cached', check_hit_cached),
+        ('miss cached', check_miss_cached),
+        ('timeout', check_timeout),
+        ('coalesced', check_coalesced),
+        ('prewarm', lambda client: check_prewarm(client, args.workers)),
+    ]
+    failures = []
+    for label, check in checks:
+        upstream.reset()
+        try:
+            check(client)
+        except AssertionError as e:
+            failures.append(label)
+            print(f'{label:<16} FAIL  {e}')
+        else:
+            print(f'{label:<16} ok')
+    server.shutdown()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
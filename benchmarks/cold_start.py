@@ -0,0 +1,140 @@
+"""Check that a fresh process can import the app and serve its first request within a time budget.
+
+Each run starts a new interpreter, as a gunicorn worker (re)start does, and
+times the import of app.py, check_app() and the first request through the
+test client. The startup path must not touch the schema or the data, so
+the figures should not grow with the size of the database; by default the
+runs go against a scratch database seeded with --products products. It
+also checks that the dependencies app.py imports lazily (LAZY_MODULES) are
+still not loaded once the app is up.
+
+Exits with status 1 when the median time to the first response exceeds
+--budget-ms or a lazy module was loaded, so it can run as a CI step.
+
+    python benchmarks/cold_start.py --runs 10 --budget-ms 1500
+    python benchmarks/cold_start.py --database-url sqlite:////tmp/load.db --imports
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAZY_MODULES = ('numpy', 'requests')
+
+PROBE = f'''
+import json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {ROOT!r})
+import app
+imported = time.perf_counter()
+application = app.check_app()
+created = time.perf_counter()
+response = application.test_client().get('/login')
+served = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({{
+    'import': imported - started,
+    'check_app': created - imported,
+    'first request': served - created,
+    'loaded': [name for name in {LAZY_MODULES!r} if name in sys.modules],
+}}))
+'''
+
+
+def seed(database_url, products):
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, ROOT)
+    from generate_data import generate_products, generate_users
+    from app import app, db, User, Product, ProductLot, reset_admin, upgrade_database
+
+    logging.getLogger('pharmacy.slow_query').setLevel(logging.ERROR)
+    with app.app_context():
+        upgrade_database()
+        reset_admin()
+        generate_users(db, User, 10)
+        generate_products(db, Product, ProductLot, np.random.default_rng(0), products, 3, 20000)
+
+
+def run_probe(env, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', PROBE]
+    start = time.perf_counter()
+    result = subprocess.run(command, env=env, capture_output=True, text=True, check=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process'] = time.perf_counter() - start
+    return timings, result.stderr
+
+
+def slowest_imports(stderr, count):
+    """Top-level imports of app.py by cumulative microseconds, from -X importtime output."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            # A module's imports are listed before the module itself
+            if name.strip() == 'app':
+                break
+            imports = []
+        elif depth == 1:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', help='Existing database to start against (default: a seeded scratch one)')
+    parser.add_argument('--products', type=int, default=100000, help='products in the scratch database')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=1500, help='limit for the median time to first response')
+    parser.add_argument('--imports', action='store_true', help="also list app.py's slowest imports")
+    args = parser.parse_args()
+
+    database_url = args.database_url
+    if database_url is None:
+        database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'cold_start.db')}"
+        seed(database_url, args.products)
+    env = dict(os.environ, DATABASE_URL=database_url, LOG_LEVEL='ERROR')
+
+    runs, loaded = [], set()
+    for _ in range(args.runs):
+        timings, _ = run_probe(env)
+        loaded.update(timings.pop('loaded'))
+        runs.append(timings)
+
+    phases = ('import', 'check_app', 'first request', 'process')
+    print(f"{'phase':<16} {'median ms':>10} {'max ms':>8}")
+    for phase in phases:
+        values = [run[phase] * 1000 for run in runs]
+        print(f'{phase:<16} {statistics.median(values):>10.1f} {max(values):>8.1f}')
+    ready = statistics.median((run['import'] + run['check_app'] + run['first request']) * 1000 for run in runs)
+    print(f'\nFirst response after {ready:.1f} ms (budget {args.budget_ms:.0f} ms)')
+
+    if args.imports:
+        _, stderr = run_probe(env, importtime=True)
+        print(f"\n{'import':<32} {'cumulative ms':>14}")
+        for cumulative, name in slowest_imports(stderr, 10):
+            print(f'{name:<32} {cumulative / 1000:>14.1f}')
+
+    failures = []
+    if ready > args.budget_ms:
+        failures.append(f'startup took {ready:.1f} ms, over the {args.budget_ms:.0f} ms budget')
+    if loaded:
+        failures.append(f'lazily imported modules were loaded at startup: {", ".join(sorted(loaded))}')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
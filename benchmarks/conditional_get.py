@@ -0,0 +1,137 @@
+"""Measure CPU per request for polled pages with and without conditional GETs.
+
+Seeds a scratch database with the generate_data.py generators, then has a
+number of logged-in clients poll the products page, dashboard, transaction
+history and product API in turns while one stock movement is posted every
+--write-every polls. Each mode runs the same poll sequence:
+
+  full             no validators sent, product table fragment cache off
+  full+fragments   no validators sent, product table fragment cache on
+  conditional      clients send back the ETag of their last response
+
+and reports the process CPU time per request for each page, how many
+requests were answered with 304, and the SQL statements per request.
+
+    python benchmarks/conditional_get.py --clients 20 --rounds 20 --write-every 200
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'conditional_get.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_data import generate_products, generate_transactions, generate_users  # noqa: E402
+
+from sqlalchemy import event  # noqa: E402
+
+from app import (  # noqa: E402
+    app, db, User, Product, ProductLot, Transaction, product_table_fragments, rebuild_daily_movements,
+    upgrade_database
+)
+
+URLS = ['/', '/dashboard', '/transactions', '/api/products']
+MODES = [
+    # label, send validators, fragment cache size
+    ('full', False, 0),
+    ('full+fragments', False, app.config['FRAGMENT_CACHE_SIZE']),
+    ('conditional', True, app.config['FRAGMENT_CACHE_SIZE']),
+]
+
+
+def seed(products, transactions, days):
+    rng = np.random.default_rng(0)
+    with app.app_context():
+        upgrade_database()
+        generate_users(db, User, 10)
+        generate_products(db, Product, ProductLot, rng, products, 3, 20000)
+        generate_transactions(db, Transaction, rng, transactions, days, products, 10, 200000)
+        with db.engine.begin() as conn:
+            rebuild_daily_movements(conn)
+            conn.execute(db.text('ANALYZE'))
+
+
+def login():
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    return client
+
+
+def poll(clients, rounds, write_every, conditional, products):
+    """Run the poll sequence; return {url: [cpu seconds, requests, 304s, statements]}."""
+    rng = np.random.default_rng(1)
+    writer = login()
+    etags = [{} for _ in clients]
+    totals = {url: [0.0, 0, 0, 0] for url in URLS}
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    with app.app_context():
+        engine = db.engine
+    polls = 0
+    for _ in range(rounds):
+        for client, client_etags in zip(clients, etags):
+            for url in URLS:
+                headers = {'If-None-Match': client_etags[url]} if conditional and url in client_etags else {}
+                event.listen(engine, 'before_cursor_execute', count)
+                statements[0] = 0
+                start = time.process_time()
+                response = client.get(url, headers=headers)
+                response.get_data()
+                elapsed = time.process_time() - start
+                event.remove(engine, 'before_cursor_execute', count)
+                assert response.status_code in (200, 304), (url, response.status_code)
+                client_etags[url] = response.headers.get('ETag', client_etags.get(url))
+                total = totals[url]
+                total[0] += elapsed
+                total[1] += 1
+                total[2] += response.status_code == 304
+                total[3] += statements[0]
+                polls += 1
+                if write_every and polls % write_every == 0:
+                    product_id = int(rng.integers(1, products + 1))
+                    writer.post(f'/api/products/{product_id}/stock', json={'quantity': 1, 'operation': 'add'})
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--transactions', type=int, default=500000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=10, help='polls of every page by every client')
+    parser.add_argument('--write-every', type=int, default=200, help='polls between stock movements (0: none)')
+    args = parser.parse_args()
+
+    logging.getLogger('pharmacy.slow_query').setLevel(logging.ERROR)
+    seed(args.products, args.transactions, args.days)
+    clients = [login() for _ in range(args.clients)]
+    for client in clients:
+        for url in URLS:
+            client.get(url)  # warm per-process caches
+
+    print(f"{'page':<16} {'mode':<16} {'CPU ms/request':>15} {'304 share':>10} {'SQL/request':>12}")
+    overall = {}
+    for label, conditional, fragments in MODES:
+        product_table_fragments.size = fragments
+        totals = poll(clients, args.rounds, args.write_every, conditional, args.products)
+        for url, (cpu, requests_, not_modified, statements) in totals.items():
+            print(f'{url:<16} {label:<16} {cpu / requests_ * 1000:>15.2f} {not_modified / requests_:>10.0%} '
+                  f'{statements / requests_:>12.2f}')
+        overall[label] = sum(t[0] for t in totals.values()) / sum(t[1] for t in totals.values())
+    print(f"\n{'all pages':<16} {'mode':<16} {'CPU ms/request':>15} {'vs full':>10}")
+    for label, cpu in overall.items():
+        print(f"{'':<16} {label:<16} {cpu * 1000:>15.2f} {cpu / overall['full']:>10.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""Measure FEFO stock removal and lot expiry queries as lots per SKU grow.
+
+For each lot count, two SKUs get the same lots with random expiries. One is
+drained by apply_stock_movement, which reads lots page by page from the
+ix_product_lot_fefo index; the other by a scan that loads and sorts every
+in-stock lot of the product, the obvious implementation. Prints per-removal
+latency, statements and lots touched, then the query plans and latency of
+the dashboard and listing expiry queries over all lots.
+
+    python benchmarks/fefo_lots.py --lots 10 100 500 2000 --removals 300
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'fefo_lots.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+
+from app import (  # noqa: E402
+    app, db, User, Product, ProductLot, Transaction, LOT_IN_STOCK,
+    apply_stock_movement, compute_product_metrics, paginate_products
+)
+
+LOT_SIZE = 10
+
+
+def seed(lot_counts, background_products, background_lots):
+    rng = random.Random(0)
+    today = datetime.now().date()
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.flush()
+
+        def add_product(name, lots):
+            pid = db.session.execute(db.insert(Product).values(
+                name=name, unit_price=1.0, quantity=sum(q for q, _ in lots), reorder_level=0,
+                expiry_date=min(e for _, e in lots)
+            )).inserted_primary_key[0]
+            db.session.execute(db.insert(ProductLot), [
+                {'product_id': pid, 'lot_number': f'L{pid}-{i}', 'quantity': q, 'expiry_date': e}
+                for i, (q, e) in enumerate(lots)
+            ])
+            return pid
+
+        for i in range(background_products):
+            add_product(f'Background {i:06d}', [
+                (rng.randint(1, 50), today + timedelta(days=rng.randint(1, 720)))
+                for _ in range(background_lots)
+            ])
+        targets = {}
+        for count in lot_counts:
+            lots = [(LOT_SIZE, today + timedelta(days=rng.randint(1, 720))) for _ in range(count)]
+            targets[count] = (add_product(f'FEFO {count}', lots), add_product(f'Scan {count}', lots))
+        db.session.commit()
+        with db.engine.begin() as conn:
+            conn.execute(db.text('ANALYZE'))
+        return user.id, targets
+
+
+def scan_stock_movement(product_id, quantity, user_id):
+    # Loads every in-stock lot of the product and sorts them in Python
+    row = db.session.execute(db.update(Product).where(
+        Product.id == product_id, Product.quantity >= quantity
+    ).values(quantity=Product.quantity - quantity).returning(Product.quantity)).first()
+    lots = ProductLot.query.filter(ProductLot.product_id == product_id, ProductLot.quantity > 0).all()
+    lots.sort(key=lambda lot: (lot.expiry_date is None, lot.expiry_date, lot.id))
+    remaining = quantity
+    for lot in lots:
+        take = min(lot.quantity, remaining)
+        lot.quantity -= take
+        remaining -= take
+        if not remaining:
+            break
+    db.session.add(Transaction(product_id=product_id, quantity=quantity, transaction_type='out', user_id=user_id))
+    db.session.commit()
+    return row[0]
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def drain(remove, product_id, removals, seed_value):
+    rng = random.Random(seed_value)
+    timings = []
+    for _ in range(removals):
+        quantity = rng.randint(1, 2 * LOT_SIZE)
+        start = time.perf_counter()
+        remove(product_id, quantity)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings
+
+
+def percentile(timings, p):
+    return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+
+def explain(statement, parameters):
+    raw = db.engine.raw_connection()
+    try:
+        return [row[-1] for row in raw.cursor().execute(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+    finally:
+        raw.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lots', type=int, nargs='+', default=[10, 100, 500, 2000], help='lots per SKU')
+    parser.add_argument('--removals', type=int, default=300, help='removals per SKU')
+    parser.add_argument('--products', type=int, default=5000, help='background products')
+    parser.add_argument('--background-lots', type=int, default=5, help='lots per background product')
+    args = parser.parse_args()
+
+    user_id, targets = seed(args.lots, args.products, args.background_lots)
+
+    with app.app_context():
+        counter = StatementCounter(db.engine)
+        print(f"{'lots/SKU':>9} {'path':>5} {'median ms':>10} {'p99 ms':>8} {'stmts/op':>9} {'lots/op':>8}")
+        for count in args.lots:
+            fefo_id, scan_id = targets[count]
+            # Never ask for more than the SKU holds
+            removals = min(args.removals, count // 2)
+            touched = []
+            for label, product_id, remove in (
+                ('fefo', fefo_id, lambda pid, q: touched.append(len(apply_stock_movement(pid, q, 'out', user_id)[1]))),
+                ('scan', scan_id, lambda pid, q: scan_stock_movement(pid, q, user_id)),
+            ):
+                before = counter.count
+                timings = drain(remove, product_id, removals, count)
+                statements = (counter.count - before) / removals
+                lots_per_op = f'{statistics.mean(touched):.1f}' if label == 'fefo' else f'{count}'
+                print(f'{count:>9} {label:>5} {statistics.median(timings) * 1000:>10.3f} '
+                      f'{percentile(timings, 0.99) * 1000:>8.3f} {statements:>9.1f} {lots_per_op:>8}')
+
+        # Both paths must agree on which lots are left
+        for count in args.lots:
+            fefo_id, scan_id = targets[count]
+            left = [
+                [(e, q) for e, q in db.session.query(ProductLot.expiry_date, ProductLot.quantity).filter(
+                    ProductLot.product_id == pid).order_by(ProductLot.expiry_date, ProductLot.id)]
+                for pid in (fefo_id, scan_id)
+            ]
+            assert left[0] == left[1], f'FEFO and scan disagree for {count} lots'
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        print()
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        for label, run in (
+            ('dashboard expiring count', compute_product_metrics),
+            ('listing ?expiring=1', lambda: paginate_products(expiring=True)),
+            ('listing ?expiring=1&sort=expiry', lambda: paginate_products(sort='expiry', expiring=True)),
+        ):
+            statements.clear()
+            timings = []
+            for _ in range(20):
+                start = time.perf_counter()
+                run()
+                timings.append(time.perf_counter() - start)
+            print(f'{label}: {statistics.median(timings) * 1000:.2f} ms median')
+            for statement, parameters in dict.fromkeys(statements):
+                if 'product_lot' in statement:
+                    print(f"  {' '.join(statement.split())[:110]}")
+                    for line in explain(statement, parameters):
+                        print(f'      {line}')
+        event.remove(db.engine, 'before_cursor_execute', capture)
+        lots = db.session.query(db.func.count(ProductLot.id)).filter(LOT_IN_STOCK).scalar()
+        print(f'\n{lots} lots in stock')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""Build a realistic synthetic pharmacy database for load tests and benchmarks.
+
+Creates users, a product catalogue with barcodes, expiring lots and stock
+levels at the default location, and a transaction history spread over the
+given number of days, with a skewed product popularity and fewer movements
+at weekends. Rows are written with bulk inserts, the transaction indexes
+are dropped during the load and rebuilt afterwards, then the daily movement
+rollups are rebuilt and the tables analysed. The same --seed always
+produces the same data.
+
+Every user's password is "bench"; the "bench" user is an admin.
+
+    python benchmarks/generate_data.py --products 100000 --transactions 10000000 --days 730
+    python benchmarks/generate_data.py --database-url sqlite:////tmp/load.db --products 5000 --transactions 200000
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STEMS = [
+    'Paracetamol', 'Ibuprofen', 'Amoxicillin', 'Azithromycin', 'Ciprofloxacin', 'Doxycycline', 'Metformin',
+    'Glimepiride', 'Sitagliptin', 'Omeprazole', 'Pantoprazole', 'Ranitidine', 'Domperidone', 'Ondansetron',
+    'Cetirizine', 'Loratadine', 'Fexofenadine', 'Montelukast', 'Salbutamol', 'Budesonide', 'Atorvastatin',
+    'Rosuvastatin', 'Amlodipine', 'Losartan', 'Telmisartan', 'Metoprolol', 'Bisoprolol', 'Clopidogrel',
+    'Aspirin', 'Warfarin', 'Levothyroxine', 'Prednisolone', 'Dexamethasone', 'Diclofenac', 'Naproxen',
+    'Tramadol', 'Gabapentin', 'Pregabalin', 'Sertraline', 'Escitalopram', 'Fluoxetine', 'Amitriptyline',
+    'Alprazolam', 'Clonazepam', 'Levetiracetam', 'Vitamin D3', 'Folic Acid', 'Ferrous Sulfate', 'Zinc',
+    'Multivitamin', 'Calcium Carbonate', 'Loperamide', 'Lactulose', 'Fluconazole', 'Acyclovir',
+    'Hydroxychloroquine', 'Insulin Glargine', 'Furosemide', 'Spironolactone', 'Tamsulosin',
+]
+STRENGTHS = ['5mg', '10mg', '20mg', '25mg', '40mg', '50mg', '100mg', '250mg', '500mg', '650mg', '1g']
+FORMS = ['Tablets', 'Capsules', 'Syrup', 'Suspension', 'Injection', 'Cream', 'Drops', 'Inhaler']
+CATEGORIES = [
+    'Pain Relief', 'Antibiotics', 'Diabetes', 'Gastrointestinal', 'Antihistamine', 'Respiratory',
+    'Cardiovascular', 'Hormones', 'Neurology', 'Psychiatry', 'Vitamins', 'Antifungal', 'Antiviral',
+    'Dermatology', 'Urology', 'First Aid',
+]
+
+
+def reset_database(db, upgrade_database):
+    # Reflect rather than use the models, so archive tables and
+    # schema_version go as well
+    metadata = db.MetaData()
+    metadata.reflect(db.engine)
+    metadata.drop_all(db.engine)
+    upgrade_database()
+
+
+def generate_users(db, User, count):
+    # Hashing is deliberately slow, so every user shares one hash
+    admin = User(username='bench', role='admin')
+    admin.set_password('bench')
+    with db.engine.begin() as conn:
+        conn.execute(db.insert(User), [{'username': 'bench', 'password': admin.password, 'role': 'admin'}] + [
+            {'username': f'staff{i:05d}', 'password': admin.password, 'role': 'staff'}
+            for i in range(1, count)
+        ])
+
+
+def generate_products(db, Product, ProductLot, rng, count, max_lots, chunk_size):
+    today = datetime.now().date()
+    created_at = datetime.utcnow() - timedelta(days=3 * 365)
+    lot_id = 0
+    for start in range(0, count, chunk_size):
+        n = min(chunk_size, count - start)
+        ids = np.arange(start + 1, start + n + 1)
+        stems = rng.integers(0, len(STEMS), n)
+        strengths = rng.integers(0, len(STRENGTHS), n)
+        forms = rng.integers(0, len(FORMS), n)
+        categories = rng.integers(0, len(CATEGORIES), n)
+        prices = np.round(rng.lognormal(3.0, 0.9, n), 2) + 0.5
+        reorder_levels = rng.integers(5, 60, n)
+        # Most products are well stocked, a tail is at or below its reorder level
+        quantities = np.where(rng.random(n) < 0.08, rng.integers(0, 10, n), rng.integers(20, 600, n))
+        lot_counts = np.where(quantities > 0, rng.integers(1, max_lots + 1, n), 0)
+
+        products, lots = [], []
+        for i in range(n):
+            pid = int(ids[i])
+            quantity = int(quantities[i])
+            # Split the quantity over the product's lots, each with its own expiry
+            expiries = sorted(today + timedelta(days=int(d)) for d in rng.integers(-20, 900, int(lot_counts[i])))
+            cuts = np.sort(rng.integers(0, quantity + 1, max(int(lot_counts[i]) - 1, 0)))
+            sizes = np.diff(np.concatenate(([0], cuts, [quantity]))) if lot_counts[i] else []
+            for expiry, size in zip(expiries, sizes):
+                if not size:
+                    continue
+                lot_id += 1
+                lots.append({
+                    'product_id': pid, 'lot_number': f'L{lot_id:08d}', 'quantity': int(size),
+                    'expiry_date': expiry, 'received_at': created_at
+                })
+            in_stock = [e for e, size in zip(expiries, sizes) if size]
+            name = f'{STEMS[stems[i]]} {STRENGTHS[strengths[i]]} {FORMS[forms[i]]}'
+            products.append({
+                'name': name,
+                'description': f'{name}, pack {pid % 7 + 1}',
+                'category': CATEGORIES[categories[i]],
+                'unit_price': float(prices[i]),
+                'quantity': quantity,
+                'reorder_level': int(reorder_levels[i]),
+                'barcode': f'89{pid:011d}',
+                'expiry_date': min(in_stock) if in_stock else None,
+                'created_at': created_at
+            })
+        with db.engine.begin() as conn:
+            conn.execute(db.insert(Product), products)
+            if lots:
+                conn.execute(db.insert(ProductLot), lots)
+
+
+def daily_counts(rng, total, days, now):
+    """Split ``total`` transactions over the last ``days`` days, fewer at weekends and only so far today."""
+    first = now.date() - timedelta(days=days - 1)
+    weights = np.array([0.6 if (first + timedelta(days=d)).weekday() >= 5 else 1.0 for d in range(days)])
+    elapsed_today = (now - datetime.combine(now.date(), datetime.min.time())).total_seconds()
+    weights[-1] *= elapsed_today / 86400
+    return first, rng.multinomial(total, weights / weights.sum())
+
+
+def generate_transactions(db, Transaction, rng, total, days, products, users, chunk_size):
+    now = datetime.utcnow()
+    first, counts = daily_counts(rng, total, days, now)
+    # Zipf-like popularity: a few fast movers account for most movements
+    popularity = 1.0 / np.arange(1, products + 1) ** 0.9
+    popularity = rng.permutation(popularity / popularity.sum())
+    limit_today = (now - datetime.combine(now.date(), datetime.min.time())).total_seconds()
+
+    table = Transaction.__table__
+    written, day, started = 0, 0, time.perf_counter()
+    while day < days:
+        # Whole days per chunk, so rows are inserted in date order like real traffic
+        end, n = day, 0
+        while end < days and (n == 0 or n + counts[end] <= chunk_size):
+            n += counts[end]
+            end += 1
+        if n:
+            day_index = np.repeat(np.arange(day, end), counts[day:end])
+            span = np.where(day_index == days - 1, limit_today, 86400)
+            seconds = day_index * 86400 + np.floor(rng.random(n) * span)
+            seconds.sort()
+            stamps = (np.datetime64(first, 'us') + (seconds * 1e6).astype('timedelta64[us]')).tolist()
+            is_in = rng.random(n) < 0.15
+            quantities = np.where(is_in, rng.integers(20, 200, n), rng.integers(1, 6, n)).tolist()
+            product_ids = (rng.choice(products, n, p=popularity) + 1).tolist()
+            user_ids = rng.integers(1, users + 1, n).tolist()
+            types = np.where(is_in, 'in', 'out').tolist()
+            with db.engine.begin() as conn:
+                conn.execute(db.insert(table), [
+                    {'product_id': p, 'quantity': q, 'transaction_type': t, 'date': d, 'user_id': u}
+                    for p, q, t, d, u in zip(product_ids, quantities, types, stamps, user_ids)
+                ])
+            written += n
+            rate = written / (time.perf_counter() - started)
+            print(f'  {written:,} / {total:,} transactions ({rate:,.0f} rows/s)', end='\r', flush=True)
+        day = end
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL', 'sqlite:///loadtest.db'),
+                        help='Target database (default: $DATABASE_URL or instance/loadtest.db)')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=730, help='days of transaction history, ending today')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--max-lots', type=int, default=3, help='lots per product in stock')
+    parser.add_argument('--chunk-size', type=int, default=200000, help='rows per insert batch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--force', action='store_true', help='Replace an existing non-empty database')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    sys.path.insert(0, ROOT)
+    from app import (
+        app, db, User, Product, ProductLot, Transaction, backfill_stock_levels, rebuild_daily_movements,
+        upgrade_database
+    )
+
+    # Bulk inserts are slow statements by design
+    logging.getLogger('pharmacy.slow_query').setLevel(logging.ERROR)
+    rng = np.random.default_rng(args.seed)
+    started = time.perf_counter()
+    with app.app_context():
+        if db.inspect(db.engine).has_table('product') and not args.force:
+            with db.engine.connect() as conn:
+                if conn.execute(db.select(db.func.count()).select_from(Product.__table__)).scalar():
+                    sys.exit(f'{db.engine.url!r} already has products; pass --force to replace it')
+        print(f'Building {db.engine.url!r}')
+        reset_database(db, upgrade_database)
+
+        step = time.perf_counter()
+        generate_users(db, User, max(args.users, 1))
+        generate_products(db, Product, ProductLot, rng, args.products, args.max_lots, args.chunk_size)
+        with db.engine.begin() as conn:
+            backfill_stock_levels(conn)
+        print(f'{args.users:,} users and {args.products:,} products in {time.perf_counter() - step:.1f}s')
+
+        step = time.perf_counter()
+        indexes = list(Transaction.__table__.indexes)
+        for index in indexes:
+            index.drop(db.engine, checkfirst=True)
+        generate_transactions(db, Transaction, rng, args.transactions, args.days, args.products,
+                              max(args.users, 1), args.chunk_size)
+        print(f'{args.transactions:,} transactions in {time.perf_counter() - step:.1f}s')
+
+        step = time.perf_counter()
+        for index in indexes:
+            index.create(db.engine)
+        with db.engine.begin() as conn:
+            rebuild_daily_movements(conn)
+            conn.execute(db.text('ANALYZE'))
+        print(f'Indexes, daily rollup and statistics in {time.perf_counter() - step:.1f}s')
+    print(f'Done in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Show query plans and latency for the hot queries before and after indexing.
+
+Builds a scratch database without the migration-1 indexes, drives the
+dashboard, transactions and predict_restock endpoints through the test
+client while capturing the SQL they run, and prints EXPLAIN QUERY PLAN and
+median latency for each statement. Then applies the migration and repeats.
+
+    python benchmarks/index_plans.py --products 20000 --transactions 300000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'index_plans.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+
+from app import app, db, User, Product, Transaction, MIGRATIONS, upgrade_database, rebuild_daily_movements  # noqa: E402
+
+INDEXED_TABLES = (Product, Transaction)
+
+
+def seed(products, transactions):
+    rng = random.Random(0)
+    today = datetime.now()
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as conn:
+            # Start from the pre-migration schema
+            for model in INDEXED_TABLES:
+                for index in model.__table__.indexes:
+                    index.drop(conn, checkfirst=True)
+            conn.execute(db.text('DROP TABLE IF EXISTS schema_version'))
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.flush()
+        db.session.execute(db.insert(Product), [
+            {
+                'name': f'Product {i:06d}',
+                'unit_price': 1.0 + i % 50,
+                'quantity': rng.randint(0, 200),
+                'reorder_level': 20,
+                'category': f'Category {i % 40}',
+                'barcode': f'{i:013d}',
+                'expiry_date': (today + timedelta(days=rng.randint(-30, 720))).date()
+            }
+            for i in range(products)
+        ])
+        batch = []
+        for i in range(transactions):
+            batch.append({
+                'product_id': rng.randint(1, products),
+                'quantity': rng.randint(1, 10),
+                'transaction_type': rng.choice(('in', 'out')),
+                'date': today - timedelta(minutes=rng.randint(0, 60 * 24 * 365)),
+                'user_id': user.id
+            })
+            if len(batch) == 50000:
+                db.session.execute(db.insert(Transaction), batch)
+                batch = []
+        if batch:
+            db.session.execute(db.insert(Transaction), batch)
+        db.session.commit()
+        with db.engine.begin() as conn:
+            rebuild_daily_movements(conn)
+
+
+def capture(client, url):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        start = time.perf_counter()
+        client.get(url)
+        elapsed = time.perf_counter() - start
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    # Skip the Flask-Login user load
+    return elapsed, [s for s in statements if 'FROM user' not in s[0]]
+
+
+def report(client, urls, label):
+    print(f'\n=== {label} ===')
+    with app.app_context():
+        raw = db.engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        for url in urls:
+            client.get(url)  # warm caches
+            elapsed, statements = capture(client, url)
+            print(f'\n{url}  ({elapsed * 1000:.1f} ms end to end)')
+            for statement, parameters in statements:
+                plan = cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+                timings = []
+                for _ in range(5):
+                    start = time.perf_counter()
+                    cursor.execute(statement, parameters).fetchall()
+                    timings.append(time.perf_counter() - start)
+                print(f"  {statistics.median(timings) * 1000:8.2f} ms  {' '.join(statement.split())[:110]}")
+                for row in plan:
+                    print(f'              {row[-1]}')
+    finally:
+        raw.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--transactions', type=int, default=300000)
+    args = parser.parse_args()
+
+    seed(args.products, args.transactions)
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    product_id = args.products // 2
+    urls = [
+        '/dashboard',
+        '/transactions',
+        f'/transactions?product={product_id}&type=out',
+        f'/api/products/{product_id}/predict_restock',
+        '/?low_stock=1',
+        '/?category=Category%207&sort=name',
+    ]
+
+    report(client, urls, 'before: primary keys and unique constraints only')
+    with app.app_context():
+        applied = upgrade_database()
+        with db.engine.begin() as conn:
+            conn.execute(db.text('ANALYZE'))
+    print(f'\nApplied migrations: {applied} (latest {MIGRATIONS[-1][0]})')
+    report(client, urls, 'after: migration indexes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Measure the per-request cost of the request instrumentation.
+
+Seeds a scratch database and times the same requests through the Flask test
+client with instrumentation switched off and on, alternating rounds so that
+both modes see the same conditions. Prints the median time per request and
+the difference, then a sample of the /metrics output.
+
+    python benchmarks/instrumentation_overhead.py --rounds 10 --requests 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'instrumentation.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db, User, Product, ProductLot, request_metrics  # noqa: E402
+
+URLS = [
+    '/api/products/barcode/0000000000007',
+    '/api/products?limit=50',
+    '/',
+    '/dashboard',
+]
+
+
+def seed(products):
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.add_all([
+            Product(name=f'Product {i:05d}', category=f'Category {i % 10}', unit_price=1.0, quantity=50,
+                    reorder_level=10, barcode=f'{i:013d}', lots=[ProductLot(quantity=50)])
+            for i in range(products)
+        ])
+        db.session.commit()
+
+
+def time_requests(client, url, requests_):
+    start = time.perf_counter()
+    for _ in range(requests_):
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+    return (time.perf_counter() - start) / requests_
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=200, help='requests per URL, mode and round')
+    args = parser.parse_args()
+
+    seed(args.products)
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    for url in URLS:
+        client.get(url)  # warm per-process caches
+
+    print(f"{'url':<40} {'off us':>9} {'on us':>9} {'overhead us':>12}")
+    for url in URLS:
+        timings = {False: [], True: []}
+        for _ in range(args.rounds):
+            for enabled in (False, True):
+                request_metrics.enabled = enabled
+                timings[enabled].append(time_requests(client, url, args.requests))
+        off = statistics.median(timings[False]) * 1e6
+        on = statistics.median(timings[True]) * 1e6
+        print(f'{url:<40} {off:>9.1f} {on:>9.1f} {on - off:>12.1f}')
+
+    request_metrics.enabled = True
+    lines = client.get('/metrics').data.decode().splitlines()
+    print(f'\n/metrics: {len(lines)} lines, for example:')
+    for line in lines:
+        if line.startswith(('http_request_sql_statements_sum', 'template_render_duration_seconds_sum')):
+            print(f'  {line}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Measure the inventory analytics reports on a large catalogue and history.
+
+Seeds a scratch database with the generate_data.py generators, then times a
+full snapshot build, each report served from the snapshot (as a function
+call and through its endpoint), and the incremental refresh that follows a
+batch of stock movements. For comparison it also times valuation by
+category computed in Python over ORM objects, as a dashboard would without
+the analytics module.
+
+    python benchmarks/inventory_analytics.py --products 100000 --transactions 5000000
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'inventory_analytics.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_data import generate_products, generate_transactions, generate_users  # noqa: E402
+
+from app import (  # noqa: E402
+    app, db, User, Product, ProductLot, Transaction, build_inventory_snapshot, expiry_risk_report,
+    inventory_analytics, rebuild_daily_movements, stock_aging_report, turnover_report, upgrade_database,
+    valuation_report
+)
+
+REPORTS = [
+    ('valuation', valuation_report, '/api/analytics/valuation'),
+    ('expiry risk', expiry_risk_report, '/api/analytics/expiry-risk'),
+    ('stock aging', stock_aging_report, '/api/analytics/stock-aging'),
+    ('turnover', turnover_report, '/api/analytics/turnover?limit=100'),
+    ('turnover by value', lambda s: turnover_report(s, 'value'), '/api/analytics/turnover?sort=value&limit=100'),
+]
+
+
+def seed(products, transactions, days):
+    rng = np.random.default_rng(0)
+    with app.app_context():
+        upgrade_database()
+        generate_users(db, User, 10)
+        generate_products(db, Product, ProductLot, rng, products, 3, 20000)
+        generate_transactions(db, Transaction, rng, transactions, days, products, 10, 200000)
+        with db.engine.begin() as conn:
+            rebuild_daily_movements(conn)
+            conn.execute(db.text('ANALYZE'))
+
+
+def median_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def orm_valuation():
+    values = {}
+    for product in Product.query.all():
+        values[product.category] = values.get(product.category, 0) + product.quantity * product.unit_price
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--transactions', type=int, default=2000000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--movements', type=int, default=200, help='stock movements before the incremental refresh')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.getLogger('pharmacy.slow_query').setLevel(logging.ERROR)
+    seed(args.products, args.transactions, args.days)
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+
+    with app.app_context():
+        build_ms = median_ms(lambda: build_inventory_snapshot(app.config['ANALYTICS_TURNOVER_DAYS']), args.repeat)
+        orm_ms = median_ms(orm_valuation, args.repeat)
+        snapshot = inventory_analytics.get()
+        print(f'Full snapshot build: {build_ms:.1f} ms; valuation over ORM objects: {orm_ms:.1f} ms\n')
+
+        print(f"{'report':<20} {'from snapshot ms':>17} {'endpoint ms':>12}")
+        for label, report, url in REPORTS:
+            report_ms = median_ms(lambda: report(snapshot), args.repeat)
+            endpoint_ms = median_ms(lambda: client.get(url), args.repeat)
+            print(f'{label:<20} {report_ms:>17.2f} {endpoint_ms:>12.2f}')
+
+    rng = np.random.default_rng(1)
+    for product_id in rng.integers(1, args.products + 1, args.movements).tolist():
+        client.post(f'/api/products/{product_id}/stock', json={'quantity': 1, 'operation': 'add'})
+    start = time.perf_counter()
+    client.get('/api/analytics/valuation')
+    refresh_ms = (time.perf_counter() - start) * 1000
+    print(f'\nValuation after {args.movements} stock movements (incremental refresh): {refresh_ms:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+"""Drive the main endpoints under concurrency and report throughput and latency percentiles.
+
+Runs each scenario for a fixed time with N concurrent clients, in-process
+through the Flask test client and/or over HTTP (against a local werkzeug
+server started here, or an already running server given by --url), and
+writes a JSON report plus a Markdown table. Reports carry the git commit
+and the database row counts, and --compare puts a previous report's
+numbers next to the current ones.
+
+Build the database first with generate_data.py; stock scenarios write to it.
+When --url is given the server must use the same database, since request
+targets are sampled from it.
+
+    python benchmarks/generate_data.py --products 100000 --transactions 10000000
+    python benchmarks/load_test.py --threads 8 --duration 10 --output before.json
+    python benchmarks/load_test.py --threads 8 --duration 10 --output after.json --compare before.json
+    python benchmarks/load_test.py --modes http --url http://127.0.0.1:8000 --scenarios barcode dashboard
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (method, path or path template, expected status codes). Templates
+# are filled from the sampled targets: {product}, {barcode}, {barcodes}
+SCENARIOS = {
+    'products': ('GET', '/', (200,)),
+    'dashboard': ('GET', '/dashboard', (200,)),
+    'transactions': ('GET', '/transactions', (200,)),
+    'transactions_filtered': ('GET', '/transactions?date=week&type=out&product={product}', (200,)),
+    'export_today': ('GET', '/transactions/export?date=today', (200,)),
+    'barcode': ('GET', '/api/products/barcode/{barcode}', (200,)),
+    'barcodes_batch': ('GET', '/api/products/barcodes?barcodes={barcodes}', (200,)),
+    # A removal larger than the stock is refused with 400, which is a valid answer
+    'stock': ('POST', '/api/products/{product}/stock', (200, 400)),
+    'predict_restock': ('GET', '/api/products/{product}/predict_restock', (200,)),
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return f'{commit}-dirty' if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def sample_targets(db, Product, rng, count):
+    """Pick the products and barcodes that requests will hit."""
+    with db.engine.connect() as conn:
+        max_id = conn.execute(db.select(db.func.max(Product.id))).scalar() or 0
+        ids = [rng.randint(1, max_id) for _ in range(count)] if max_id else []
+        rows = conn.execute(db.select(Product.id, Product.barcode).where(Product.id.in_(ids))).all()
+    if not rows:
+        sys.exit('The database has no products; run benchmarks/generate_data.py first')
+    return {
+        'products': [pid for pid, _ in rows],
+        'barcodes': [barcode for _, barcode in rows if barcode] or ['0'],
+    }
+
+
+def row_counts(db, models):
+    with db.engine.connect() as conn:
+        return {
+            model.__tablename__: conn.execute(db.select(db.func.count()).select_from(model.__table__)).scalar()
+            for model in models
+        }
+
+
+def build_request(name, targets, rng):
+    method, path, expected = SCENARIOS[name]
+    path = path.format(
+        product=rng.choice(targets['products']),
+        barcode=rng.choice(targets['barcodes']),
+        barcodes=','.join(rng.sample(targets['barcodes'], min(50, len(targets['barcodes']))))
+    )
+    body = None
+    if name == 'stock':
+        body = {'quantity': rng.randint(1, 5), 'operation': rng.choice(['add', 'remove'])}
+    return method, path, body, expected
+
+
+class TestClientSession:
+    """Requests through the Flask test client, in this process."""
+
+    def __init__(self, app, username, password):
+        self.client = app.test_client()
+        self.client.post('/login', data={'username': username, 'password': password})
+
+    def send(self, method, path, body):
+        response = self.client.open(path, method=method, json=body)
+        response.get_data()  # drain streamed responses
+        status = response.status_code
+        response.close()
+        return status
+
+
+class HTTPSession:
+    """Requests over HTTP with a keep-alive connection."""
+
+    def __init__(self, base_url, username, password):
+        import requests
+
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        response = self.session.post(f'{self.base_url}/login', data={'username': username, 'password': password})
+        if not self.session.cookies:
+            raise SystemExit(f'Login to {self.base_url} failed ({response.status_code})')
+
+    def send(self, method, path, body):
+        response = self.session.request(method, self.base_url + path, json=body)
+        return response.status_code
+
+
+def run_scenario(name, make_session, targets, threads, duration, seed, warmup):
+    latencies, unexpected = [], []
+    lock = threading.Lock()
+    sessions = [make_session() for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(session, worker_seed):
+        rng = random.Random(worker_seed)
+        local, failed = [], []
+        # Untimed requests first, so lazily built caches are not charged to the scenario
+        for _ in range(warmup):
+            try:
+                session.send(*build_request(name, targets, rng)[:3])
+            except Exception:
+                pass  # counted when it happens again in the timed run
+        barrier.wait()
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            method, path, body, expected = build_request(name, targets, rng)
+            start = time.perf_counter()
+            try:
+                status = session.send(method, path, body)
+            except Exception as e:
+                status = type(e).__name__
+            local.append(time.perf_counter() - start)
+            if status not in expected:
+                failed.append(status)
+        with lock:
+            latencies.extend(local)
+            unexpected.extend(failed)
+
+    workers = [threading.Thread(target=worker, args=(s, seed + i)) for i, s in enumerate(sessions)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(unexpected),
+        'error_statuses': sorted({str(s) for s in unexpected}),
+        'rps': len(latencies) / elapsed,
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+def start_local_server(app):
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def format_change(current, previous, lower_is_better=False):
+    if not previous:
+        return ''
+    change = (current - previous) / previous * 100
+    if lower_is_better:
+        change = -change
+    return f'{change:+.0f}%'
+
+
+def markdown_report(report, baseline=None):
+    meta = report['meta']
+    lines = [
+        f"# Load test {meta['commit'] or 'unknown commit'} ({meta['started_at']})",
+        '',
+        f"{meta['threads']} concurrent clients, {meta['duration']:g}s per scenario, "
+        f"database `{meta['database']}`, Python {meta['python']}, SQLite {meta['sqlite']}.",
+        '',
+        'Rows: ' + ', '.join(f'{table} {count:,}' for table, count in meta['rows'].items()),
+    ]
+    if baseline:
+        lines += ['', f"Compared with {baseline['meta']['commit'] or 'unknown commit'} "
+                      f"({baseline['meta']['started_at']}); positive changes are improvements."]
+    for mode, results in report['results'].items():
+        previous = (baseline or {}).get('results', {}).get(mode, {})
+        header = '| scenario | req/s | p50 ms | p90 ms | p99 ms | max ms | errors |'
+        rule = '|---|---:|---:|---:|---:|---:|---:|'
+        if baseline:
+            header += ' baseline req/s | req/s change | p99 change |'
+            rule += '---:|---:|---:|'
+        lines += ['', f'## {mode}', '', header, rule]
+        for name, stats in results.items():
+            row = (f"| {name} | {stats['rps']:.1f} | {stats['p50_ms']:.1f} | {stats['p90_ms']:.1f} | "
+                   f"{stats['p99_ms']:.1f} | {stats['max_ms']:.1f} | {stats['errors']} |")
+            if baseline:
+                old = previous.get(name)
+                row += (f" {old['rps']:.1f} | {format_change(stats['rps'], old['rps'])} | "
+                        f"{format_change(stats['p99_ms'], old['p99_ms'], lower_is_better=True)} |"
+                        if old else ' | | |')
+            lines.append(row)
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL', 'sqlite:///loadtest.db'),
+                        help='Database built by generate_data.py (default: $DATABASE_URL or instance/loadtest.db)')
+    parser.add_argument('--modes', nargs='+', default=['inprocess', 'http'], choices=['inprocess', 'http'])
+    parser.add_argument('--url', help='Benchmark this running server instead of starting one (http mode)')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--threads', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per scenario and mode')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed requests per client before each scenario')
+    parser.add_argument('--targets', type=int, default=1000, help='products sampled as request targets')
+    parser.add_argument('--username', default='bench')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='load_test.json', help='JSON report; the Markdown goes next to it')
+    parser.add_argument('--compare', help='Previous JSON report to compare against')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    sys.path.insert(0, ROOT)
+    from app import app, db, User, Product, ProductLot, Transaction, DailyProductMovement
+
+    # Lock waits under concurrent writers would flood the output; they are
+    # still counted in slow_queries_total on /metrics
+    logging.getLogger('pharmacy.slow_query').setLevel(logging.ERROR)
+
+    with app.app_context():
+        targets = sample_targets(db, Product, random.Random(args.seed), args.targets)
+        rows = row_counts(db, [Product, ProductLot, Transaction, DailyProductMovement, User])
+        database = db.engine.url.render_as_string(hide_password=True)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'database': database,
+            'rows': rows,
+            'threads': args.threads,
+            'duration': args.duration,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'results': {},
+    }
+    print(f"{'mode':<10} {'scenario':<22} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'errors':>7}")
+    for mode in args.modes:
+        server = None
+        if mode == 'inprocess':
+            def make_session():
+                return TestClientSession(app, args.username, args.password)
+        else:
+            base_url = args.url
+            if not base_url:
+                server, base_url = start_local_server(app)
+
+            def make_session():
+                return HTTPSession(base_url, args.username, args.password)
+        results = report['results'][mode] = {}
+        try:
+            for name in args.scenarios:
+                stats = results[name] = run_scenario(
+                    name, make_session, targets, args.threads, args.duration, args.seed, args.warmup
+                )
+                print(f"{mode:<10} {name:<22} {stats['rps']:>8.1f} {stats['p50_ms']:>8.1f} "
+                      f"{stats['p90_ms']:>8.1f} {stats['p99_ms']:>8.1f} {stats['max_ms']:>8.1f} "
+                      f"{stats['errors']:>7}")
+        finally:
+            if server:
+                server.shutdown()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    markdown_path = os.path.splitext(args.output)[0] + '.md'
+    with open(markdown_path, 'w') as f:
+        f.write(markdown_report(report, baseline))
+    print(f'\nReport written to {args.output} and {markdown_path}')
+
+
+if __name__ == '__main__':
+    main()
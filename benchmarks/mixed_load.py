@@ -0,0 +1,141 @@
+"""Mixed read/write load benchmark across database configurations.
+
+Runs dashboard readers and stock-update writers concurrently through the
+Flask test client and reports throughput and p50/p99 latency per operation.
+Each configuration runs in its own process, because engine settings are
+read when the app is imported.
+
+    python benchmarks/mixed_load.py                      # rollback journal vs WAL
+    python benchmarks/mixed_load.py --configs wal --readers 8 --writers 4
+    python benchmarks/mixed_load.py --database-url postgresql://user:pw@localhost/pharmacy
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIGS = {
+    # SQLite defaults: rollback journal, full fsync on every commit
+    'rollback': {
+        'SQLITE_JOURNAL_MODE': 'DELETE',
+        'SQLITE_SYNCHRONOUS': 'FULL',
+        'SQLITE_MMAP_SIZE': '0',
+        'SQLITE_CACHE_SIZE': '-2000',
+    },
+    # The app defaults
+    'wal': {},
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def child(args):
+    sys.path.insert(0, ROOT)
+    from app import app, db, User, Product, ProductLot, upgrade_database
+
+    with app.app_context():
+        db.drop_all()
+        db.session.execute(db.text('DROP TABLE IF EXISTS schema_version'))
+        db.session.commit()
+        upgrade_database()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.execute(db.insert(Product), [
+            {'name': f'Load {i}', 'unit_price': 1.0, 'quantity': 10 ** 6, 'reorder_level': 10,
+             'category': f'C{i % 20}'}
+            for i in range(args.products)
+        ])
+        db.session.execute(db.insert(ProductLot), [
+            {'product_id': pid, 'quantity': 10 ** 6} for pid in range(1, args.products + 1)
+        ])
+        db.session.commit()
+
+    latencies = {'dashboard': [], 'stock': []}
+    errors = {'dashboard': 0, 'stock': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def run(kind, seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        client.post('/login', data={'username': 'bench', 'password': 'bench'})
+        local, failed = [], 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if kind == 'dashboard':
+                response = client.get('/dashboard')
+            else:
+                response = client.post(f'/api/products/{rng.randint(1, args.products)}/stock', json={
+                    'quantity': rng.randint(1, 5), 'operation': rng.choice(['add', 'remove'])})
+            local.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                failed += 1
+        with lock:
+            latencies[kind].extend(local)
+            errors[kind] += failed
+
+    threads = [threading.Thread(target=run, args=('dashboard', i)) for i in range(args.readers)]
+    threads += [threading.Thread(target=run, args=('stock', 1000 + i)) for i in range(args.writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(json.dumps({
+        kind: {
+            'requests': len(values),
+            'errors': errors[kind],
+            'per_second': len(values) / args.duration,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+        }
+        for kind, values in latencies.items()
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument('--database-url', help='Benchmark this database URL instead of scratch SQLite files')
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per configuration')
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    runs = [('url', {'DATABASE_URL': args.database_url})] if args.database_url else [
+        (name, dict(CONFIGS[name], DATABASE_URL=f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'load.db')}"))
+        for name in args.configs
+    ]
+    print(f'{args.readers} dashboard readers + {args.writers} stock writers, {args.duration:.0f}s per configuration\n')
+    print(f"{'config':<10} {'operation':<10} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, env in runs:
+        output = subprocess.run(
+            [sys.executable, __file__, '--child', '--readers', str(args.readers), '--writers', str(args.writers),
+             '--duration', str(args.duration), '--products', str(args.products)],
+            env=dict(os.environ, **env), capture_output=True, text=True, check=True
+        ).stdout
+        for kind, stats in json.loads(output.strip().splitlines()[-1]).items():
+            print(f"{name:<10} {kind:<10} {stats['per_second']:>8.1f} {stats['p50_ms']:>8.1f} "
+                  f"{stats['p99_ms']:>8.1f} {stats['errors']:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Measure per-location and network-wide stock queries across many locations.
+
+Seeds a scratch database with the generate_data.py generators, then spreads
+the catalogue over --locations locations: each location stocks a --coverage
+share of the products, with one stock level and one lot per product held,
+and the transaction history is dealt out over the locations. It times,
+through the test client unless noted:
+
+  network low stock       first page of /api/stock/low over every location
+  network low stock paged following the cursor for --pages pages, per page
+  low stock per location  one location's first page, every location in turn,
+                          as separate per-branch databases would answer the
+                          network question (total for all locations)
+  location list           /api/locations with low-stock counts per location
+  product stock levels    /api/products/<id>/stock-levels across locations
+  metrics, one location   dashboard metrics recomputed for one location
+  metrics, network        the same for the whole network
+  predict, one location   /api/products/<id>/predict_restock?location=...
+  stock out               POST /api/products/<id>/stock at a location
+  transfer                POST /api/stock/transfer between two locations
+
+and prints the query plans of the low-stock queries.
+
+    python benchmarks/multi_location.py --locations 300 --products 100000 --coverage 0.3
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'multi_location.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_data import generate_products, generate_transactions, generate_users  # noqa: E402
+
+from app import (  # noqa: E402
+    app, db, User, Location, Product, ProductLot, StockLevel, Transaction, compute_product_metrics,
+    compute_transaction_metrics, low_stock_levels, rebuild_daily_movements, upgrade_database
+)
+
+
+def seed(locations, products, coverage, transactions, days, chunk_size=200000):
+    rng = np.random.default_rng(0)
+    today = datetime.now().date()
+    received_at = datetime.utcnow() - timedelta(days=365)
+    with app.app_context():
+        upgrade_database()
+        generate_users(db, User, 10)
+        generate_products(db, Product, ProductLot, rng, products, 1, chunk_size)
+        generate_transactions(db, Transaction, rng, transactions, days, products, 10, chunk_size)
+        with db.engine.begin() as conn:
+            conn.execute(db.insert(Location), [
+                {'code': f'B{i:03d}', 'name': f'Branch {i:03d}'} for i in range(2, locations + 1)
+            ])
+            reorder_levels = np.array(conn.execute(
+                db.select(Product.reorder_level).order_by(Product.id)
+            ).scalars().all())
+            conn.execute(db.delete(ProductLot))
+
+            # Every product is held somewhere; each location holds a random share of the catalogue
+            per_chunk = max(chunk_size // locations, 1)
+            lot_id = 0
+            for start in range(0, products, per_chunk):
+                n = min(per_chunk, products - start)
+                held = rng.random((n, locations)) < coverage
+                held[np.arange(n), rng.integers(0, locations, n)] = True
+                rows, columns = np.nonzero(held)
+                reorder = reorder_levels[start + rows]
+                # A tail of the stock levels is at or below its reorder level
+                quantities = np.where(rng.random(len(rows)) < 0.08, rng.integers(0, 10, len(rows)),
+                                      rng.integers(20, 300, len(rows)))
+                expiries = rng.integers(-20, 900, len(rows))
+                levels, lots = [], []
+                for row, column, quantity, reorder_level, expiry in zip(rows, columns, quantities, reorder, expiries):
+                    product_id, location_id, quantity = start + int(row) + 1, int(column) + 1, int(quantity)
+                    levels.append({
+                        'location_id': location_id, 'product_id': product_id,
+                        'quantity': quantity, 'reorder_level': int(reorder_level)
+                    })
+                    if quantity:
+                        lot_id += 1
+                        lots.append({
+                            'product_id': product_id, 'location_id': location_id, 'lot_number': f'L{lot_id:08d}',
+                            'quantity': quantity, 'expiry_date': today + timedelta(days=int(expiry)),
+                            'received_at': received_at
+                        })
+                conn.execute(db.insert(StockLevel), levels)
+                conn.execute(db.insert(ProductLot), lots)
+
+            # The product row carries the network total and the earliest expiry held anywhere
+            conn.execute(db.text(
+                'UPDATE product SET '
+                'quantity = (SELECT SUM(quantity) FROM stock_level WHERE product_id = product.id), '
+                'expiry_date = (SELECT MIN(expiry_date) FROM product_lot '
+                'WHERE product_id = product.id AND quantity > 0)'
+            ))
+            conn.execute(db.text('UPDATE "transaction" SET location_id = id % :locations + 1'),
+                         {'locations': locations})
+            rebuild_daily_movements(conn)
+            conn.execute(db.text('ANALYZE'))
+
+
+def median_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def get_ok(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, (url, response.status_code, response.get_data(as_text=True))
+    return response.get_json()
+
+
+def post_ok(client, url, payload):
+    response = client.post(url, json=payload)
+    assert response.status_code == 200, (url, response.status_code, response.get_data(as_text=True))
+    return response.get_json()
+
+
+def page_through(client, pages):
+    url, cursor = '/api/stock/low?limit=100', None
+    for _ in range(pages):
+        data = get_ok(client, url + (f'&cursor={cursor}' if cursor else ''))
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+
+
+def print_plans(location_id):
+    c = StockLevel.__table__.c
+    low = db.select(c.location_id, c.product_id).where(c.quantity <= c.reorder_level)
+    statements = [
+        ('network low stock', low.order_by(c.location_id, c.product_id).limit(101)),
+        ('one location', low.where(c.location_id == location_id).order_by(c.product_id).limit(101)),
+        ('counts per location', db.select(c.location_id, db.func.count()).where(
+            c.quantity <= c.reorder_level
+        ).group_by(c.location_id)),
+    ]
+    print(f"\n{'query':<24} plan")
+    for label, stmt in statements:
+        compiled = stmt.compile(db.engine, compile_kwargs={'literal_binds': True})
+        for i, row in enumerate(db.session.execute(db.text(f'EXPLAIN QUERY PLAN {compiled}'))):
+            print(f"{label if i == 0 else '':<24} {row[-1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--locations', type=int, default=200)
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--coverage', type=float, default=0.3, help='share of the catalogue each location holds')
+    parser.add_argument('--transactions', type=int, default=500000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--pages', type=int, default=50, help='low-stock pages to follow')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    logging.getLogger('pharmacy.slow_query').setLevel(logging.ERROR)
+    started = time.perf_counter()
+    seed(args.locations, args.products, args.coverage, args.transactions, args.days)
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    rng = np.random.default_rng(1)
+
+    with app.app_context():
+        levels = db.session.query(db.func.count()).select_from(StockLevel).scalar()
+        low = db.session.query(db.func.count()).select_from(StockLevel).filter(
+            StockLevel.quantity <= StockLevel.reorder_level
+        ).scalar()
+        # A product held at two locations with enough stock to move between them
+        product_id, source, destination = db.session.execute(db.text(
+            'SELECT a.product_id, a.location_id, b.location_id FROM stock_level a '
+            'JOIN stock_level b ON b.product_id = a.product_id AND b.location_id != a.location_id '
+            'WHERE a.quantity >= :needed ORDER BY a.product_id LIMIT 1'
+        ), {'needed': 4 * args.repeat}).one()
+    print(f'{args.locations:,} locations, {args.products:,} products, {levels:,} stock levels '
+          f'({low:,} low) seeded in {time.perf_counter() - started:.1f}s\n')
+
+    def per_location():
+        with app.app_context():
+            for location_id in range(1, args.locations + 1):
+                low_stock_levels(location_id, limit=100)
+            db.session.remove()
+
+    def one_location_metrics():
+        with app.app_context():
+            compute_product_metrics(int(rng.integers(1, args.locations + 1)))
+            compute_transaction_metrics(int(rng.integers(1, args.locations + 1)))
+
+    def network_metrics():
+        with app.app_context():
+            compute_product_metrics()
+            compute_transaction_metrics()
+
+    def random_product():
+        return int(rng.integers(1, args.products + 1))
+
+    cases = [
+        ('network low stock', lambda: get_ok(client, '/api/stock/low?limit=100')),
+        ('network low stock paged', lambda: page_through(client, args.pages)),
+        ('low stock per location', per_location),
+        ('location list', lambda: get_ok(client, '/api/locations')),
+        ('product stock levels', lambda: get_ok(client, f'/api/products/{random_product()}/stock-levels')),
+        ('metrics, one location', one_location_metrics),
+        ('metrics, network', network_metrics),
+        ('predict, one location', lambda: get_ok(
+            client, f'/api/products/{random_product()}/predict_restock?location={source}'
+        )),
+        ('stock out', lambda: post_ok(client, f'/api/products/{product_id}/stock', {
+            'quantity': 1, 'operation': 'remove', 'location': source
+        })),
+        ('transfer', lambda: post_ok(client, '/api/stock/transfer', {
+            'product_id': product_id, 'quantity': 1, 'from': source, 'to': destination
+        })),
+    ]
+    print(f"{'case':<36} {'median ms':>10}")
+    for label, fn in cases:
+        elapsed = median_ms(fn, args.repeat)
+        if label == 'network low stock paged':
+            elapsed /= max(min(args.pages, -(-low // 100)), 1)
+            label += ' (per page)'
+        print(f'{label:<36} {elapsed:>10.2f}')
+
+    with app.app_context():
+        print_plans(source)
+
+
+if __name__ == '__main__':
+    main()
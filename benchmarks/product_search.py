@@ -0,0 +1,99 @@
+"""Measure product search and typeahead latency on a large catalogue.
+
+Seeds a scratch catalogue with the generate_data.py product generator, then
+times typical typeahead queries (prefixes, several terms, typos, barcode
+prefixes) through search_products() and through the typeahead endpoint,
+next to the LIKE '%...%' scan they replace.
+
+    python benchmarks/product_search.py --products 100000 --repeat 50
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'product_search.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate_data import generate_products, generate_users  # noqa: E402
+
+from app import (  # noqa: E402
+    app, db, User, Product, ProductLot, search_products, search_terms, search_vocabulary, upgrade_database
+)
+
+QUERIES = [
+    'pa',
+    'paracet',
+    'paracet 500',
+    'amox caps',
+    'omeprazole 20mg',
+    'vitamin d3 drops',
+    'antibiotics',
+    'paracetmol',
+    'ibuprofn 400',
+    'cetrizine syrup',
+    '890000001',
+    'nothing like this',
+]
+
+
+def seed(products):
+    with app.app_context():
+        upgrade_database()
+        generate_users(db, User, 1)
+        generate_products(db, Product, ProductLot, np.random.default_rng(0), products, 1, 20000)
+        with db.engine.begin() as conn:
+            conn.execute(db.text('ANALYZE'))
+
+
+def like_scan(text):
+    query = Product.query.with_entities(Product.id, Product.name)
+    for term in search_terms(text):
+        query = query.filter(db.or_(Product.name.ilike(f'%{term}%'), Product.description.ilike(f'%{term}%')))
+    return query.order_by(Product.name).limit(10).all()
+
+
+def median_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return statistics.median(timings) * 1000, timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    seed(args.products)
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+
+    with app.app_context():
+        start = time.perf_counter()
+        search_vocabulary.has_prefix('a')
+        print(f'Vocabulary of {search_vocabulary.stats()["entries"]:,} terms loaded in '
+              f'{(time.perf_counter() - start) * 1000:.1f} ms\n')
+
+        print(f"{'query':<20} {'hits':>5} {'suggestion':<20} {'search ms':>10} {'p99':>7} "
+              f"{'endpoint ms':>12} {'LIKE ms':>8}")
+        for text in QUERIES:
+            rows, suggestion = search_products(text, 10)
+            search, search_p99 = median_ms(lambda: search_products(text, 10), args.repeat)
+            endpoint, _ = median_ms(lambda: client.get('/api/products/search', query_string={'q': text}), args.repeat)
+            like, _ = median_ms(lambda: like_scan(text), max(3, args.repeat // 10))
+            print(f'{text:<20} {len(rows):>5} {suggestion or "":<20} {search:>10.2f} {search_p99:>7.2f} '
+                  f'{endpoint:>12.2f} {like:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
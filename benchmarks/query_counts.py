@@ -0,0 +1,98 @@
+"""Check that page views issue a bounded number of SQL statements.
+
+Seeds a scratch database, requests each page and counts the statements the
+engine executes. The count must not exceed the budget below and must not
+grow with the number of rows on the page, so N+1 regressions exit non-zero.
+
+    python benchmarks/query_counts.py
+"""
+import os
+import sys
+import tempfile
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'query_counts.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+
+from app import (  # noqa: E402
+    app, db, User, Product, Transaction, invalidate_product_choices, product_table_fragments, user_cache
+)
+
+# Maximum statements per request; the Flask-Login user load is served from
+# the user cache after the first request
+BUDGETS = {
+    '/transactions': 2,
+    '/transactions?date=week&type=in': 2,
+    '/': 2,
+    '/api/products': 1,
+}
+
+
+def seed(products, transactions):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.flush()
+        db.session.execute(db.insert(Product), [
+            {'name': f'Product {i}', 'unit_price': 1.0, 'quantity': 5, 'reorder_level': 10, 'category': f'C{i % 7}'}
+            for i in range(products)
+        ])
+        db.session.execute(db.insert(Transaction), [
+            {'product_id': i % products + 1, 'quantity': 1, 'transaction_type': 'in', 'user_id': user.id}
+            for i in range(transactions)
+        ])
+        db.session.commit()
+    invalidate_product_choices()
+    user_cache.invalidate()
+
+
+def count_queries(client, url):
+    counter = [0]
+
+    def before_cursor_execute(*args):
+        counter[0] += 1
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    assert response.status_code == 200, (url, response.status_code)
+    return counter[0]
+
+
+def main():
+    # Count the statements behind the pages rather than fragment cache hits
+    product_table_fragments.size = 0
+    failures = []
+    counts = {}
+    # At least one full page of transactions: a page the live table cannot
+    # fill costs one more statement, to look for archived months
+    for products, transactions in ((10, 60), (200, 200)):
+        seed(products, transactions)
+        client = app.test_client()
+        client.post('/login', data={'username': 'bench', 'password': 'bench'})
+        for url in BUDGETS:
+            client.get(url)  # warm per-process caches
+        for url in BUDGETS:
+            counts.setdefault(url, []).append(count_queries(client, url))
+
+    for url, budget in BUDGETS.items():
+        small, large = counts[url]
+        status = 'ok'
+        if large > budget or large != small:
+            status = 'FAIL'
+            failures.append(url)
+        print(f'{url:<40} {small:>3} -> {large:>3} queries (budget {budget})  {status}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""Compare scanner barcode lookups: the previous ORM endpoint against the in-memory index.
+
+Seeds a scratch catalogue and scans random barcodes through the Flask test
+client, reporting lookups/sec and latency percentiles for the previous
+endpoint (one ORM query and a jsonify per scan), the indexed endpoint, the
+indexed endpoint revalidated with If-None-Match, and the batch endpoint.
+The same scans are then timed in-process, without HTTP or the login check,
+to show the cost of the lookup itself.
+
+    python benchmarks/scanner_lookup.py --products 50000 --lookups 5000 --threads 4
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'scanner_lookup.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify  # noqa: E402
+from flask_login import login_required  # noqa: E402
+
+from app import app, db, User, Product, barcode_index, product_to_dict  # noqa: E402
+
+
+@app.route('/bench/previous/barcode/<barcode>')
+@login_required
+def previous_barcode_lookup(barcode):
+    # The endpoint as it was before the barcode index, kept for comparison
+    product = Product.query.filter_by(barcode=barcode).first()
+    if product:
+        return jsonify({'product': product_to_dict(product)})
+    return jsonify({'product': None})
+
+
+def seed(products):
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.execute(db.insert(Product), [
+            {
+                'name': f'Product {i:06d}',
+                'description': f'Scanner benchmark product {i}',
+                'category': f'Category {i % 40}',
+                'unit_price': 1.0 + i % 50,
+                'quantity': 100,
+                'reorder_level': 10,
+                'barcode': f'{i:013d}'
+            }
+            for i in range(products)
+        ])
+        db.session.commit()
+
+
+def client():
+    c = app.test_client()
+    c.post('/login', data={'username': 'bench', 'password': 'bench'})
+    return c
+
+
+def percentiles(timings):
+    timings.sort()
+    return [timings[min(len(timings) - 1, int(len(timings) * p))] * 1000 for p in (0.5, 0.99)]
+
+
+def run_in_process(label, lookup, scans):
+    timings = []
+    with app.test_request_context():
+        start = time.perf_counter()
+        for barcode in scans:
+            t = time.perf_counter()
+            lookup(barcode)
+            timings.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+    p50, p99 = percentiles(timings)
+    print(f'{label:<34} {len(scans) / elapsed:>12.0f} {p50:>9.3f} {p99:>9.3f}')
+
+
+def run(label, requests_, lookups_per_request, threads):
+    """Send requests_ (callables taking a test client) from ``threads`` clients; returns lookups/sec."""
+    timings = []
+    lock = threading.Lock()
+
+    def worker(part):
+        c = client()
+        local = []
+        for send in part:
+            start = time.perf_counter()
+            response = send(c)
+            local.append(time.perf_counter() - start)
+            assert response.status_code in (200, 304), response.status_code
+        with lock:
+            timings.extend(local)
+
+    parts = [requests_[i::threads] for i in range(threads)]
+    workers = [threading.Thread(target=worker, args=(part,)) for part in parts]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    p50, p99 = percentiles(timings)
+    lookups = len(requests_) * lookups_per_request
+    print(f'{label:<34} {lookups / elapsed:>12.0f} {p50:>9.3f} {p99:>9.3f}')
+    return lookups / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=50000)
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--batch', type=int, default=100, help='barcodes per batch request')
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+
+    seed(args.products)
+    rng = random.Random(0)
+    # Scanner traffic is skewed: most scans hit a small set of fast movers
+    hot = [f'{rng.randrange(args.products):013d}' for _ in range(200)]
+    scans = [
+        rng.choice(hot) if rng.random() < 0.8 else f'{rng.randrange(args.products):013d}'
+        for _ in range(args.lookups)
+    ]
+    etags = {}
+    warm = client()
+    for barcode in set(scans):
+        etags[barcode] = warm.get(f'/api/products/barcode/{barcode}').headers['ETag']
+
+    print(f"{'endpoint':<34} {'lookups/s':>12} {'p50 ms':>9} {'p99 ms':>9}")
+    previous = run('previous (ORM per scan)', [
+        lambda c, b=b: c.get(f'/bench/previous/barcode/{b}') for b in scans
+    ], 1, args.threads)
+    indexed = run('indexed', [
+        lambda c, b=b: c.get(f'/api/products/barcode/{b}') for b in scans
+    ], 1, args.threads)
+    run('indexed, If-None-Match (304)', [
+        lambda c, b=b: c.get(f'/api/products/barcode/{b}', headers={'If-None-Match': etags[b]}) for b in scans
+    ], 1, args.threads)
+    batches = [scans[i:i + args.batch] for i in range(0, len(scans), args.batch)]
+    run(f'batch POST ({args.batch} per request)', [
+        lambda c, b=b: c.post('/api/products/barcodes', json={'barcodes': b}) for b in batches
+    ], args.batch, args.threads)
+    print(f'\nindexed speedup over previous: {indexed / previous:.1f}x\n')
+
+    run_in_process('in-process: ORM query + jsonify', lambda b: jsonify(
+        {'product': product_to_dict(Product.query.filter_by(barcode=b).first())}
+    ), scans)
+    run_in_process('in-process: barcode index', barcode_index.get, scans)
+
+
+if __name__ == '__main__':
+    main()
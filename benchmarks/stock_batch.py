@@ -0,0 +1,97 @@
+"""Compare the per-line stock endpoint with the batch endpoint.
+
+Sends the same N stock movements once as N calls to
+/api/products/<id>/stock and once as a single /api/stock/batch request,
+through the Flask test client against a scratch database.
+
+    python benchmarks/stock_batch.py --lines 1000 10000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'stock_batch.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db, User, Product, ProductLot, Transaction  # noqa: E402
+
+
+def reset(products):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.add_all([
+            Product(name=f'Batch {i}', unit_price=1.0, quantity=10 ** 6, reorder_level=0, barcode=f'BB{i:08d}',
+                    lots=[ProductLot(quantity=10 ** 6)])
+            for i in range(products)
+        ])
+        db.session.commit()
+
+
+def make_lines(n, products, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(n):
+        pid = rng.randint(1, products)
+        line = {'quantity': rng.randint(1, 5), 'operation': rng.choice(['add', 'remove'])}
+        if rng.random() < 0.5:
+            line['product_id'] = pid
+        else:
+            line['barcode'] = f'BB{pid - 1:08d}'
+        lines.append(line)
+    return lines
+
+
+def client():
+    c = app.test_client()
+    c.post('/login', data={'username': 'bench', 'password': 'bench'})
+    return c
+
+
+def run_per_line(lines, products):
+    reset(products)
+    c = client()
+    with app.app_context():
+        ids = dict(db.session.query(Product.barcode, Product.id))
+    start = time.perf_counter()
+    for line in lines:
+        pid = line.get('product_id') or ids[line['barcode']]
+        c.post(f'/api/products/{pid}/stock', json={'quantity': line['quantity'], 'operation': line['operation']})
+    return time.perf_counter() - start
+
+
+def run_batch(lines, products):
+    reset(products)
+    c = client()
+    start = time.perf_counter()
+    response = c.post('/api/stock/batch', json={'lines': lines})
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200, response.get_json()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--products', type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'lines':>8} {'per-line (s)':>14} {'batch (s)':>10} {'speedup':>8} {'batch lines/s':>14}")
+    for n in args.lines:
+        lines = make_lines(n, args.products)
+        per_line = run_per_line(lines, args.products)
+        batch = run_batch(lines, args.products)
+        with app.app_context():
+            assert Transaction.query.count() == n
+        print(f"{n:>8} {per_line:>14.2f} {batch:>10.3f} {per_line / batch:>7.1f}x {n / batch:>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Multi-threaded stress benchmark for the stock mutation service.
+
+Hammers a handful of products from many threads with a mix of stock-in and
+stock-out movements, then checks that the final quantities match the sum of
+the successful movements and that no product was oversold.
+
+    python benchmarks/stock_stress.py --threads 8 --ops 500
+    python benchmarks/stock_stress.py --naive   # old read-modify-write path
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'stock_stress.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+from app import app, db, User, Product, ProductLot, Transaction, StockError, apply_stock_movement  # noqa: E402
+
+
+def naive_stock_movement(product_id, quantity, transaction_type, user_id):
+    # The pre-service implementation, kept for comparison
+    product = db.session.get(Product, product_id)
+    if transaction_type == 'in':
+        product.quantity += quantity
+    else:
+        if product.quantity < quantity:
+            raise StockError('Insufficient stock')
+        product.quantity -= quantity
+    db.session.add(Transaction(
+        product_id=product_id,
+        quantity=quantity,
+        transaction_type=transaction_type,
+        user_id=user_id
+    ))
+    db.session.commit()
+    return product.quantity
+
+
+def setup(products, initial_quantity):
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.add_all([
+            Product(name=f'Stress {i}', unit_price=1.0, quantity=initial_quantity, reorder_level=0,
+                    lots=[ProductLot(quantity=initial_quantity)])
+            for i in range(products)
+        ])
+        db.session.commit()
+        return user.id, [p.id for p in Product.query.order_by(Product.id)]
+
+
+def worker(mutate, user_id, product_ids, ops, seed, applied, failures):
+    rng = random.Random(seed)
+    local = {pid: 0 for pid in product_ids}
+    with app.app_context():
+        for _ in range(ops):
+            pid = rng.choice(product_ids)
+            quantity = rng.randint(1, 5)
+            transaction_type = 'in' if rng.random() < 0.4 else 'out'
+            try:
+                mutate(pid, quantity, transaction_type, user_id)
+            except StockError:
+                continue
+            except OperationalError:
+                db.session.rollback()
+                failures.append(1)
+                continue
+            local[pid] += quantity if transaction_type == 'in' else -quantity
+        db.session.remove()
+    applied.append(local)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=500, help='movements per thread')
+    parser.add_argument('--products', type=int, default=4)
+    parser.add_argument('--initial', type=int, default=200)
+    parser.add_argument('--naive', action='store_true', help='benchmark the old read-modify-write path')
+    args = parser.parse_args()
+
+    user_id, product_ids = setup(args.products, args.initial)
+    mutate = naive_stock_movement if args.naive else apply_stock_movement
+    applied, failures = [], []
+    threads = [
+        threading.Thread(target=worker, args=(mutate, user_id, product_ids, args.ops, seed, applied, failures))
+        for seed in range(args.threads)
+    ]
+
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        actual = dict(db.session.query(Product.id, Product.quantity))
+        tx_count = Transaction.query.count()
+        lot_totals = dict(db.session.query(ProductLot.product_id, db.func.sum(ProductLot.quantity)).group_by(ProductLot.product_id))
+
+    expected = {pid: args.initial + sum(a[pid] for a in applied) for pid in product_ids}
+    successes = tx_count
+    ok = expected == actual and min(actual.values()) >= 0
+    if not args.naive:
+        # The naive path predates lots and leaves them untouched
+        ok = ok and all(lot_totals.get(pid, 0) == qty for pid, qty in actual.items())
+
+    print(f"mode:          {'naive read-modify-write' if args.naive else 'atomic conditional update'}")
+    print(f"threads:       {args.threads} x {args.ops} ops on {args.products} products")
+    print(f"committed:     {successes} movements ({len(failures)} lock failures)")
+    print(f"elapsed:       {elapsed:.2f}s")
+    print(f"throughput:    {successes / elapsed:.0f} updates/sec")
+    for pid in product_ids:
+        print(f"product {pid}:     expected {expected[pid]}, actual {actual[pid]}")
+    print(f"result:        {'OK' if ok else 'MISMATCH (lost updates or oversell)'}")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
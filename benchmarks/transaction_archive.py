@@ -0,0 +1,135 @@
+"""Measure transaction history queries before and after archiving old months.
+
+Seeds a scratch database with a long transaction history, times listing
+pages, exports and a product delete through the Flask test client, then
+moves everything older than the archive horizon into the monthly archive
+tables and times the same requests again. Listings and exports must return
+the same rows in both states.
+
+    python benchmarks/transaction_archive.py --transactions 2000000 --days 730 --horizon 365
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'transaction_archive.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import (  # noqa: E402
+    app, db, User, Product, Transaction, TransactionArchive, archive_transactions, encode_cursor,
+    rebuild_daily_movements, upgrade_database
+)
+
+
+def seed(products, transactions, days):
+    rng = np.random.default_rng(0)
+    now = datetime.utcnow()
+    with app.app_context():
+        upgrade_database()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.execute(db.insert(Product), [
+            {'name': f'Product {i:05d}', 'unit_price': 1.0, 'quantity': 100, 'reorder_level': 10}
+            for i in range(products)
+        ])
+        db.session.commit()
+        chunk = 200000
+        for start in range(0, transactions, chunk):
+            n = min(chunk, transactions - start)
+            # Chunks walk forward in time so ids follow dates, as in production
+            offsets = np.sort(rng.random(n)) * chunk / transactions + start / transactions
+            stamps = (np.datetime64(now, 'us') - ((1 - offsets) * days * 86400e6).astype('timedelta64[us]')).tolist()
+            with db.engine.begin() as conn:
+                conn.execute(db.insert(Transaction), [
+                    {'product_id': p, 'quantity': 1, 'transaction_type': t, 'date': d, 'user_id': user.id}
+                    for p, t, d in zip(
+                        rng.integers(1, products + 1, n).tolist(),
+                        np.where(rng.random(n) < 0.2, 'in', 'out').tolist(),
+                        stamps
+                    )
+                ])
+        with db.engine.begin() as conn:
+            rebuild_daily_movements(conn)
+            conn.execute(db.text('ANALYZE'))
+    return now
+
+
+def requests_for(now, days):
+    old = now - timedelta(days=days * 3 // 4)
+    deep_cursor = encode_cursor('transactions', old.isoformat(), 2 ** 62)
+    month_from = (now - timedelta(days=days - 45)).strftime('%Y-%m-%d')
+    month_to = (now - timedelta(days=days - 75)).strftime('%Y-%m-%d')
+    return [
+        ('listing, last 30 days', '/transactions'),
+        ('listing, all dates', '/transactions?date=all'),
+        ('listing, all dates, page in old history', f'/transactions?date=all&cursor={deep_cursor}'),
+        ('listing, one product, all dates', '/transactions?date=all&product=7'),
+        ('export, today', '/transactions/export?date=today'),
+        ('export, one old month', f'/transactions/export?from={month_from}&to={month_to}'),
+    ]
+
+
+def time_request(client, url, repeat):
+    timings, body = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        body = response.get_data()
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, (url, response.status_code)
+    return statistics.median(timings) * 1000, body
+
+
+def time_delete(client, product_id):
+    start = time.perf_counter()
+    response = client.delete(f'/api/products/{product_id}')
+    assert response.status_code == 200, response.get_json()
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--transactions', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=730, help='days of history')
+    parser.add_argument('--horizon', type=int, default=365, help='archive months older than this many days')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    now = seed(args.products, args.transactions, args.days)
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    requests_ = requests_for(now, args.days)
+
+    delete_before = time_delete(client, 1)
+    before = {label: time_request(client, url, args.repeat) for label, url in requests_}
+
+    with app.app_context():
+        start = time.perf_counter()
+        moved = archive_transactions(now - timedelta(days=args.horizon))
+        elapsed = time.perf_counter() - start
+        live = Transaction.query.count()
+        months = TransactionArchive.query.count()
+    print(f'Archived {sum(moved.values()):,} transactions in {len(moved)} months in {elapsed:.1f}s; '
+          f'{live:,} left live, {months} archive months\n')
+
+    after = {label: time_request(client, url, args.repeat) for label, url in requests_}
+    delete_after = time_delete(client, 2)
+
+    print(f"{'request':<42} {'before ms':>10} {'after ms':>10}")
+    for label, _ in requests_:
+        assert before[label][1] == after[label][1], f'{label}: different rows after archiving'
+        print(f'{label:<42} {before[label][0]:>10.2f} {after[label][0]:>10.2f}')
+    print(f"{'delete product with its history':<42} {delete_before:>10.2f} {delete_after:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Count the SQL statements the session user cache saves on hot API endpoints.
+
+Seeds a scratch database, then requests each endpoint with the user cache
+disabled and enabled, counting the statements the engine executes per
+request and timing the requests through the Flask test client.
+
+    python benchmarks/user_cache.py --requests 500
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), 'user_cache.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DB_PATH}'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+
+from app import app, db, User, Product, ProductLot, user_cache  # noqa: E402
+
+ENDPOINTS = [
+    ('GET', '/api/products/barcode/0000000000007', None),
+    ('GET', '/api/products/barcodes?barcodes=0000000000001,0000000000002,0000000000003', None),
+    ('GET', '/api/products?limit=20', None),
+    ('GET', '/api/products/7/lots', None),
+    ('POST', '/api/products/7/stock', {'quantity': 1, 'operation': 'add'}),
+    ('GET', '/api/dashboard/metrics', None),
+]
+
+
+def seed(products):
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', role='admin')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.add_all([
+            Product(name=f'Product {i:05d}', category=f'Category {i % 10}', unit_price=1.0, quantity=50,
+                    reorder_level=10, barcode=f'{i:013d}', lots=[ProductLot(quantity=50)])
+            for i in range(products)
+        ])
+        db.session.commit()
+
+
+def measure(client, method, url, body, requests_):
+    counter = [0]
+
+    def before_cursor_execute(*args):
+        counter[0] += 1
+
+    send = client.post if method == 'POST' else client.get
+    send(url, json=body)  # warm per-process caches
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        start = time.perf_counter()
+        for _ in range(requests_):
+            response = send(url, json=body)
+            assert response.status_code == 200, (url, response.status_code)
+        elapsed = time.perf_counter() - start
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return counter[0] / requests_, elapsed / requests_ * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint and mode')
+    args = parser.parse_args()
+
+    seed(args.products)
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench'})
+    size = user_cache.size
+
+    print(f"{'endpoint':<80} {'queries/request':>16} {'ms/request':>16}")
+    print(f"{'':<80} {'off':>7} {'on':>8} {'off':>7} {'on':>8}")
+    saved = []
+    for method, url, body in ENDPOINTS:
+        user_cache.size = 0
+        user_cache.invalidate()
+        off_queries, off_ms = measure(client, method, url, body, args.requests)
+        user_cache.size = size
+        on_queries, on_ms = measure(client, method, url, body, args.requests)
+        saved.append(off_queries - on_queries)
+        print(f'{method + " " + url:<80} {off_queries:>7.2f} {on_queries:>8.2f} {off_ms:>7.3f} {on_ms:>8.3f}')
+
+    print(f'\nqueries saved per request: {min(saved):.2f} to {max(saved):.2f}')
+
+
+if __name__ == '__main__':
+    main()